@@ -0,0 +1,231 @@
+#!/usr/bin/env python3
+import argparse
+import json
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+from dataset import DISTRIBUTIONS, Dataset
+from grenier.backend_bup import BupBackend, encfs_command
+from grenier.backend_restic import ResticBackend
+from grenier.checks import external_binaries_available
+from grenier.encryption import derive_key, encrypt_file, native_encryption_available, new_key_parameters
+from grenier.helpers import umount
+from grenier.manifest import list_files
+from grenier.remote import GrenierRemote
+from grenier.source import GrenierSource
+
+# slower than the baseline by more than this is a regression
+TOLERANCE = 0.2
+
+
+def create_small_sources(root, number_of_sources, files_per_source):
+    sources = []
+    for i in range(number_of_sources):
+        source_dir = Path(root, "source%03d" % i)
+        source_dir.mkdir(parents=True)
+        for j in range(files_per_source):
+            Path(source_dir, "file%04d.txt" % j).write_text("source %d file %d\n" % (i, j) * 20)
+        sources.append(GrenierSource("source%03d" % i, source_dir))
+    return sources
+
+
+def benchmark_bup_batch_save(number_of_sources, files_per_source):
+    root = Path(tempfile.mkdtemp(prefix="grenier_benchmark_"))
+    try:
+        sources = create_small_sources(Path(root, "sources"), number_of_sources, files_per_source)
+        timings = {}
+        for batch_save in [False, True]:
+            repository_path = Path(root, "repository_batch_%s" % batch_save)
+            repository_path.mkdir()
+            backend = BupBackend(repository_path, batch_save=batch_save)
+            success, output = backend.init()
+            assert success, output
+            start = time.time()
+            success, output = backend.save(sources, display=False)
+            assert success, output
+            timings[batch_save] = time.time() - start
+        print("bup save, %s sources of %s files:" % (number_of_sources, files_per_source))
+        print("\tone source at a time: %.2fs" % timings[False])
+        print("\tbatched:              %.2fs" % timings[True])
+        print("\tspeedup:              x%.2f" % (timings[False] / timings[True]))
+    finally:
+        shutil.rmtree(str(root))
+
+
+def create_packs(root, megabytes, number_of_files):
+    # incompressible, like bup packs
+    root.mkdir(parents=True)
+    size = megabytes * 1024 * 1024 // number_of_files
+    for i in range(number_of_files):
+        Path(root, "pack-%04d.pack" % i).write_bytes(os.urandom(size))
+    return megabytes * 1024 * 1024
+
+
+def read_all(root):
+    for path in Path(root).rglob("*"):
+        if path.is_file():
+            with path.open("rb") as f:
+                while f.read(1024 * 1024):
+                    pass
+
+
+def benchmark_cloud_export(megabytes, number_of_files):
+    # what rclone reads: the encfs reverse mount, or files encrypted by grenier
+    root = Path(tempfile.mkdtemp(prefix="grenier_benchmark_"))
+    try:
+        repository_path = Path(root, "repository")
+        total = create_packs(repository_path, megabytes, number_of_files)
+        print("cloud export encryption, %s files, %sMb:" % (number_of_files, megabytes))
+        if native_encryption_available():
+            staging = Path(root, "staging")
+            staging.mkdir()
+            start = time.time()
+            key = derive_key("benchmark", new_key_parameters())
+            for path in repository_path.iterdir():
+                encrypt_file(key, path, Path(staging, path.name))
+            duration = time.time() - start
+            print("\tnative (AES-GCM):     %.2fs, %.1fMb/s" % (duration, total / duration / 1024 ** 2))
+        else:
+            print("\tnative: cryptography is not installed.")
+        if external_binaries_available("encfs"):
+            mount = Path(root, "encfs")
+            mount.mkdir()
+            start = time.time()
+            success, output = encfs_command(repository_path, mount, "benchmark", reverse=True, quiet=True)
+            assert success, output
+            read_all(mount)
+            duration = time.time() - start
+            umount(mount)
+            print("\tencfs reverse mount:  %.2fs, %.1fMb/s" % (duration, total / duration / 1024 ** 2))
+    finally:
+        shutil.rmtree(str(root))
+
+
+def run_measured(action):
+    # in a forked process: peak RSS are high-water marks for the whole life of a process, each step
+    # gets its own. Returns success, output, and the peak RSS in kilobytes (on linux) of grenier
+    # itself and of the largest of bup/restic/rsync.
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read_fd)
+        try:
+            success, output = action()
+        except Exception as err:
+            success, output = False, str(err)
+        with os.fdopen(write_fd, "w") as f:
+            json.dump([success, output, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                       resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss], f)
+        os._exit(0)
+    os.close(write_fd)
+    with os.fdopen(read_fd) as f:
+        result = f.read()
+    os.waitpid(pid, 0)
+    if not result:
+        return False, "benchmark process died", 0, 0
+    return tuple(json.loads(result))
+
+
+def scale_backend(name, repository_path):
+    if name == "bup":
+        backend = BupBackend(repository_path)
+    else:
+        backend = ResticBackend(repository_path, "benchmark")
+    repository_path.mkdir()
+    success, output = backend.init()
+    assert success, output
+    return backend
+
+
+def benchmark_scale(dataset_dir, files, distribution, runs, backends, baseline=None, save_baseline=None,
+                    tolerance=TOLERANCE):
+    # save, sync to a local directory and restore, after churn for every run but the first
+    root = Path(tempfile.mkdtemp(prefix="grenier_benchmark_"))
+    results = {}
+    try:
+        if dataset_dir is not None and Path(dataset_dir).exists():
+            dataset = Dataset.load(dataset_dir)
+        else:
+            dataset = Dataset(dataset_dir or Path(root, "dataset"), files, distribution)
+            start = time.time()
+            dataset.generate()
+            print("dataset generated in %.2fs." % (time.time() - start))
+        available = [el for el in backends if external_binaries_available(el)]
+        repositories = {el: scale_backend(el, Path(root, "repository_%s" % el)) for el in available}
+        sources = [GrenierSource("dataset", dataset.data)]
+        for run in range(runs):
+            if run > 0:
+                modified, deleted, added, written = dataset.churn()
+                print("run %s: %s files modified, %s deleted, %s added." % (run, modified, deleted, added))
+            size = sum([el[0] for el in list_files(dataset.data).values()])
+            print("run %s: %s files, %.1fMb:" % (run, dataset.next_index, size / 1024 ** 2))
+            for name, backend in repositories.items():
+                remote = GrenierRemote(str(Path(root, "remote_%s" % name)), None)
+                restore = Path(root, "restore_%s" % name)
+                restore.mkdir()
+                phases = [("save", lambda: backend.save(sources, display=False)),
+                          ("sync", lambda: backend.sync_to_folder(name, remote, display=False)),
+                          ("restore", lambda: backend.restore(sources, restore, display=False))]
+                for phase, action in phases:
+                    start = time.time()
+                    success, output, rss, children_rss = run_measured(action)
+                    duration = time.time() - start
+                    assert success, output
+                    key = "%s %s run %s" % (name, phase, run)
+                    results[key] = {"duration": duration, "throughput": size / max(duration, 0.001),
+                                    "peak_rss": rss, "children_peak_rss": children_rss}
+                    flag = ""
+                    if baseline is not None and key in baseline:
+                        if duration > baseline[key]["duration"] * (1 + tolerance) or \
+                                rss > baseline[key]["peak_rss"] * (1 + tolerance):
+                            results[key]["regression"] = True
+                            flag = "\tREGRESSION (baseline: %.2fs, %.0fMb)" % (baseline[key]["duration"],
+                                                                              baseline[key]["peak_rss"] / 1024)
+                    print("\t%s\t%s\t%.2fs, %.1fMb/s, peak RSS %.0fMb (commands: %.0fMb)%s" % (
+                        name, phase, duration, size / max(duration, 0.001) / 1024 ** 2, rss / 1024,
+                        children_rss / 1024, flag))
+                shutil.rmtree(str(restore))
+    finally:
+        shutil.rmtree(str(root))
+    if save_baseline is not None:
+        with open(save_baseline, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    return not any([el.get("regression") for el in results.values()])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Grenier benchmarks.')
+    parser.add_argument('--sources', dest='sources', type=int, default=50)
+    parser.add_argument('--files', dest='files', type=int, default=10)
+    parser.add_argument('--export-size', dest='export_size', type=int, default=500, metavar="MB")
+    parser.add_argument('--benchmarks', dest='benchmarks', nargs="+",
+                        choices=["batch_save", "cloud_export", "scale"], default=["batch_save", "cloud_export"])
+    parser.add_argument('--dataset', dest='dataset', metavar="DIRECTORY",
+                        help='dataset for the scale benchmark, generated there if it does not exist.')
+    parser.add_argument('--scale-files', dest='scale_files', type=int, default=10000)
+    parser.add_argument('--distribution', dest='distribution', choices=sorted(DISTRIBUTIONS), default="mixed")
+    parser.add_argument('--runs', dest='runs', type=int, default=3)
+    parser.add_argument('--backends', dest='backends', nargs="+", choices=["bup", "restic"],
+                        default=["bup", "restic"])
+    parser.add_argument('--baseline', dest='baseline', metavar="JSON_FILE",
+                        help='flag what is slower, or uses more memory, than these results.')
+    parser.add_argument('--save-baseline', dest='save_baseline', metavar="JSON_FILE")
+    parser.add_argument('--tolerance', dest='tolerance', type=float, default=TOLERANCE)
+    args = parser.parse_args()
+    if "batch_save" in args.benchmarks:
+        benchmark_bup_batch_save(args.sources, args.files)
+    if "cloud_export" in args.benchmarks:
+        benchmark_cloud_export(args.export_size, args.files)
+    if "scale" in args.benchmarks:
+        baseline = None
+        if args.baseline:
+            with open(args.baseline) as f:
+                baseline = json.load(f)
+        if not benchmark_scale(args.dataset, args.scale_files, args.distribution, args.runs, args.backends,
+                               baseline, args.save_baseline, args.tolerance):
+            sys.exit(1)
@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+import argparse
+import hashlib
+import json
+import math
+import random
+from pathlib import Path
+
+# median and spread of file sizes, in bytes
+DISTRIBUTIONS = {"small": (4 * 1024, 1.0),
+                 "mixed": (32 * 1024, 1.5),
+                 "large": (4 * 1024 * 1024, 1.0)}
+MAX_FILE_SIZE = 64 * 1024 * 1024
+# 16 symbols: about 4 bits of entropy per byte, compresses to roughly half
+COMPRESSIBLE = bytes.maketrans(bytes(range(256)), b"etaoinshrdlu \n.," * 16)
+STATE_FILE = "dataset.json"
+
+
+class Dataset(object):
+    # files generated from a seed: the same parameters give the same files, each with unique
+    # content so that deduplication only finds what churn leaves unchanged.
+    def __init__(self, root, files=1000, distribution="mixed", depth=3, fanout=16, compressible=0.5,
+                 seed=0):
+        self.root = Path(root)
+        self.files = files
+        if distribution not in DISTRIBUTIONS:
+            raise Exception("Unknown distribution %s, expected one of: %s." % (distribution,
+                                                                              ", ".join(DISTRIBUTIONS)))
+        self.distribution = distribution
+        self.depth = depth
+        self.fanout = fanout
+        self.compressible = compressible
+        self.seed = seed
+        # files are numbered, new files by churn come after the others
+        self.next_index = files
+        self.runs = 0
+
+    @classmethod
+    def load(cls, root):
+        with Path(root, STATE_FILE).open() as f:
+            state = json.load(f)
+        dataset = cls(root, state["files"], state["distribution"], state["depth"], state["fanout"],
+                      state["compressible"], state["seed"])
+        dataset.next_index = state["next_index"]
+        dataset.runs = state["runs"]
+        return dataset
+
+    def save_state(self):
+        state = {"files": self.files, "distribution": self.distribution, "depth": self.depth,
+                 "fanout": self.fanout, "compressible": self.compressible, "seed": self.seed,
+                 "next_index": self.next_index, "runs": self.runs}
+        with Path(self.root, STATE_FILE).open("w") as f:
+            json.dump(state, f)
+
+    @property
+    def data(self):
+        # where the files are, the state file is not part of the dataset
+        return Path(self.root, "data")
+
+    def path(self, index):
+        # depth levels of fanout directories, files spread evenly
+        parts = []
+        remaining = index
+        for level in range(self.depth):
+            parts.append("d%02d" % (remaining % self.fanout))
+            remaining //= self.fanout
+        return Path(self.data, *parts, "file%08d.bin" % index)
+
+    def size(self, rng):
+        median, sigma = DISTRIBUTIONS[self.distribution]
+        return min(MAX_FILE_SIZE, int(rng.lognormvariate(math.log(median), sigma)))
+
+    def content(self, index, version, size, compressible):
+        data = hashlib.shake_256(b"%d-%d-%d" % (self.seed, index, version)).digest(size)
+        if compressible:
+            return data.translate(COMPRESSIBLE)
+        return data
+
+    def write(self, index, version, rng):
+        path = self.path(index)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        size = self.size(rng)
+        path.write_bytes(self.content(index, version, size, rng.random() < self.compressible))
+        return size
+
+    def generate(self):
+        # returns the number of bytes written
+        self.root.mkdir(parents=True, exist_ok=True)
+        rng = random.Random(self.seed)
+        total = 0
+        for index in range(self.files):
+            total += self.write(index, 0, rng)
+        self.save_state()
+        return total
+
+    def churn(self, modified=0.05, deleted=0.01, added=0.02):
+        # fractions of the original number of files, different for each run.
+        # returns the number of files modified, deleted and added, and the bytes written.
+        self.runs += 1
+        rng = random.Random("%s-churn-%s" % (self.seed, self.runs))
+        counts = [0, 0, 0]
+        written = 0
+        candidates = rng.sample(range(self.next_index), min(self.next_index,
+                                                            int(self.files * (modified + deleted))))
+        number_modified = int(self.files * modified)
+        for index in candidates[:number_modified]:
+            if self.path(index).exists():
+                written += self.write(index, self.runs, rng)
+                counts[0] += 1
+        for index in candidates[number_modified:]:
+            path = self.path(index)
+            if path.exists():
+                path.unlink()
+                counts[1] += 1
+        for i in range(int(self.files * added)):
+            written += self.write(self.next_index, 0, rng)
+            self.next_index += 1
+            counts[2] += 1
+        self.save_state()
+        return counts[0], counts[1], counts[2], written
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Generate a synthetic dataset for grenier scale tests.')
+    parser.add_argument('root', metavar="DIRECTORY")
+    parser.add_argument('--files', dest='files', type=int, default=1000)
+    parser.add_argument('--distribution', dest='distribution', choices=sorted(DISTRIBUTIONS), default="mixed")
+    parser.add_argument('--depth', dest='depth', type=int, default=3)
+    parser.add_argument('--fanout', dest='fanout', type=int, default=16)
+    parser.add_argument('--compressible', dest='compressible', type=float, default=0.5,
+                        help='share of compressible files.')
+    parser.add_argument('--seed', dest='seed', type=int, default=0)
+    parser.add_argument('--churn', dest='churn', action='store_true', default=False,
+                        help='modify, delete and add files of an existing dataset.')
+    args = parser.parse_args()
+    if args.churn:
+        dataset = Dataset.load(args.root)
+        modified, deleted, added, written = dataset.churn()
+        print("run %s: %s files modified, %s deleted, %s added, %.1fMb written." % (dataset.runs, modified,
+                                                                                     deleted, added,
+                                                                                     written / 1024 ** 2))
+    else:
+        dataset = Dataset(args.root, args.files, args.distribution, args.depth, args.fanout,
+                          args.compressible, args.seed)
+        total = dataset.generate()
+        print("%s files, %.1fMb." % (args.files, total / 1024 ** 2))
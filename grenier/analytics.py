@@ -0,0 +1,61 @@
+def _sources(event):
+    return event["details"].get("sources", {})
+
+
+def _total(values):
+    if not values or None in values:
+        return None
+    return sum(values)
+
+
+def save_rows(events):
+    # one row per save, oldest first: source size, bytes read, bytes added to the repository
+    rows = []
+    for event in reversed(events):
+        sources = _sources(event).values()
+        processed = _total([el.get("processed_bytes") for el in sources])
+        added = event["bytes"]
+        if added is None:
+            added = _total([el.get("stored_bytes") for el in sources])
+        ratio = None
+        if processed and added is not None:
+            ratio = added / float(processed)
+        rows.append({"end": event["end"],
+                     "duration": event["duration"],
+                     "scanned": _total([el.get("scanned_bytes") for el in sources]),
+                     "processed": processed,
+                     "added": added,
+                     "ratio": ratio})
+    return rows
+
+
+def source_growth(events):
+    # per source, over these saves: what it added to the repository, and its share of the growth
+    totals = {}
+    # most recent first: the size of each source is the last one known
+    for event in events:
+        for name, stats in _sources(event).items():
+            total = totals.setdefault(name, {"saves": 0, "scanned": None, "processed": 0, "added": 0})
+            total["saves"] += 1
+            if total["scanned"] is None:
+                total["scanned"] = stats.get("scanned_bytes")
+            total["processed"] += stats.get("processed_bytes", 0)
+            total["added"] += stats.get("stored_bytes", 0)
+    growth = sum([max(0, el["added"]) for el in totals.values()])
+    for total in totals.values():
+        total["share"] = max(0, total["added"]) / float(growth) if growth else 0
+        total["ratio"] = total["added"] / float(total["processed"]) if total["processed"] else None
+    return totals
+
+
+def upload_volume(events):
+    # number of syncs, and bytes uploaded or copied
+    return len(events), sum([el["details"].get("processed_bytes", 0) for el in events])
+
+
+def compression_ratio(event):
+    # of the whole repository, when the backend reports it
+    stats = event["details"].get("repository", {})
+    if stats.get("stored_bytes") and stats.get("uncompressed_bytes"):
+        return stats["stored_bytes"] / float(stats["uncompressed_bytes"])
+    return None
@@ -1,8 +1,25 @@
+import shutil
+import struct
+import tempfile
+
 from grenier.helpers import *
-from grenier.backend_default import Backend, rclone_command
+from grenier.backend_default import Backend, rclone_command, rclone_dry_run, rclone_sync
+from grenier.engine import engine
+from grenier.encryption import KEY_FILE, NAMES_FILE, decrypt_file, decrypt_names, derive_key, encrypt_file, \
+    encrypt_names, encrypted_size, encrypted_stream, read_key_parameters, remote_name
+from grenier import export
+from grenier.manifest import list_files
+from grenier.compression import compression_level
+from grenier.retention import select_snapshots
+from grenier.transfer import Checkpoint, backoff, classify_error
+
+BUP_SAVE_FORMAT = "%Y-%m-%d-%H%M%S"
+# native exports save their state every EXPORT_BATCH uploaded files
+EXPORT_BATCH = 64
 
 
-def encfs_command(directory1, directory2, password, encfs_xml_path=None, reverse=False, quiet=False):
+def encfs_command(directory1, directory2, password, encfs_xml_path=None, reverse=False, quiet=False,
+                  resources=None):
     # dirs must be absolute
     directory1 = absolute_path(directory1)
     directory2 = absolute_path(directory2)
@@ -15,74 +32,284 @@ def encfs_command(directory1, directory2, password, encfs_xml_path=None, reverse
         cmd.extend(["--standard", "--reverse"])
     else:
         env["ENCFS6_CONFIG"] = str(encfs_xml_path)
+    if resources:
+        cmd = resources.wrap(cmd)
     log_cmd(cmd)
-    p = Popen(cmd,
-              stdin=PIPE,
-              stdout=PIPE,
-              stderr=PIPE,
-              bufsize=1,
-              env=env)
-    stdout_data, stderr_data = p.communicate(password.encode("utf-8"))
-    output = ""
-    for line in stderr_data.decode("utf8").strip().split("\n"):
-        output += line
-        if not quiet:
-            logger.warning("\t !!! " + line.rstrip())
-        else:
-            logger.debug("\t !!! " + line.rstrip())
+    output = []
 
-    if p.returncode == 0:
-        return True, output
+    def on_line(line, stream):
+        if stream == "stderr":
+            output.append(line)
+            if not quiet:
+                logger.warning("\t !!! " + line.rstrip())
+            else:
+                logger.debug("\t !!! " + line.rstrip())
+
+    returncode = engine.run_command(cmd, env=env, input_data=password.encode("utf-8"),
+                                    on_line=on_line, timeout=getattr(resources, "timeout", None))
+    if returncode == 0:
+        return True, "".join(output)
     else:
-        return False, output
+        return False, "".join(output)
+
+
+def bup_line_path(line):
+    # bup index/save -vv lines: status, then path
+    line = line.rstrip("\n")
+    if len(line) > 2 and line[1] == " ":
+        line = line[2:]
+    return line.strip()
+
+
+def lines_under(lines, root):
+    # lines whose path is root or inside it, not in a sibling sharing its name as a prefix
+    root = str(root).rstrip("/")
+    return [el for el in lines
+            if bup_line_path(el).rstrip("/") == root or bup_line_path(el).startswith(root + "/")]
+
+
+def bup_line_size(line):
+    path = bup_line_path(line)
+    if not path or path.endswith("/"):
+        return 0
+    try:
+        return os.lstat(path).st_size
+    except OSError:
+        return 0
 
 
 def bup_command(cmd, repository_path, quiet=False, number_of_items=None,
-                pbar_title="", save_output=True):
-    log_cmd(cmd)
+                pbar_title="", save_output=True, resources=None, progress=None):
+    cmd = ["bup"] + cmd
     env_dict = {"BUP_DIR": str(repository_path)}
-    output = ""
+    if resources:
+        cmd = resources.wrap(cmd)
+        env_dict = resources.environment(env_dict)
+    log_cmd(cmd)
+    output = []
+    counter = {"items": 0}
 
-    if number_of_items and not quiet:
-        cpt = 0
+    if progress is not None:
+        progress.start()
+    elif number_of_items and not quiet:
         pbar = generate_pbar(pbar_title, number_of_items).start()
 
-    with Popen(["bup"] + cmd,
-               stdout=PIPE,
-               stderr=STDOUT,
-               bufsize=1,
-               env=env_dict) as p:
-        for line in p.stdout:
-            if number_of_items and not quiet:
-                cpt += 1
-                if cpt < number_of_items:
-                    pbar.update(cpt)
-            elif not quiet:
-                logger.info("\t" + line.decode("utf8").rstrip())
-            if save_output:
-                output += line.decode("utf8")
-    if number_of_items and not quiet:
+    def on_line(line, stream):
+        # stdout and stderr alike
+        if progress is not None:
+            progress.add(bup_line_size(line))
+        elif number_of_items and not quiet:
+            counter["items"] += 1
+            if counter["items"] < number_of_items:
+                pbar.update(counter["items"])
+        elif not quiet:
+            logger.info("\t" + line.rstrip())
+        if save_output:
+            output.append(line + "\n")
+
+    returncode = engine.run_command(cmd, env=env_dict, on_line=on_line,
+                                    timeout=getattr(resources, "timeout", None))
+    if progress is not None:
+        progress.finish()
+    elif number_of_items and not quiet:
         pbar.finish()
-    if p.returncode == 0:
-        return True, output
+    if returncode == 0:
+        return True, "".join(output)
     else:
-        return False, output
+        return False, "".join(output)
+
+
+def git_command(cmd, repository_path, resources=None, on_stdout=None):
+    # bup repositories are git repositories, read directly for large listings
+    cmd = ["git", "--git-dir=%s" % repository_path, "-c", "core.quotePath=false"] + cmd
+    if resources:
+        cmd = resources.wrap(cmd)
+    log_cmd(cmd)
+    output = []
+
+    def on_line(line, stream):
+        if stream == "stdout" and on_stdout is not None:
+            on_stdout(line)
+        else:
+            output.append(line + "\n")
+
+    returncode = engine.run_command(cmd, on_line=on_line, timeout=getattr(resources, "timeout", None))
+    return returncode == 0, "".join(output)
+
+
+def demangle_bup_path(path):
+    # bup stores large files as trees of chunks named file.bup, and adds .bupl to names
+    # already ending like this. Returns the original path and whether path is a chunk of
+    # a file, or None for .bupm metadata files.
+    parts = path.split("/")
+    if parts[-1] == ".bupm":
+        return None, False
+    names = []
+    for part in parts:
+        if part.endswith(".bupl"):
+            names.append(part[:-len(".bupl")])
+        elif part.endswith(".bup"):
+            names.append(part[:-len(".bup")])
+            return "/".join(names), True
+        else:
+            names.append(part)
+    return "/".join(names), False
+
+
+def midx_index_names(path):
+    # names of the .idx files a midx covers, listed at its end (bup midx format version 4)
+    try:
+        with path.open("rb") as f:
+            header = f.read(12)
+            if len(header) < 12 or header[:4] != b"MIDX" or struct.unpack("!I", header[4:8])[0] != 4:
+                return []
+            bits = struct.unpack("!I", header[8:12])[0]
+            # last entry of the fanout table: number of objects
+            f.seek(12 + (2 ** bits - 1) * 4)
+            objects = struct.unpack("!I", f.read(4))[0]
+            f.seek(12 + 2 ** bits * 4 + objects * 24)
+            return [el.decode("utf8", "replace") for el in f.read().split(b"\0") if el]
+    except (OSError, struct.error):
+        return []
 
 
 class BupBackend(Backend):
-    def __init__(self, repository_path):
-        super().__init__("bup", repository_path)
+    def __init__(self, repository_path, resources=None, batch_save=False, midx_threshold=100,
+                 cloud_encryption="encfs", cloud_staging=False):
+        super().__init__("bup", repository_path, resources=resources)
+        self.batch_save = batch_save
+        # encfs reverse mount, or native: encrypted by grenier, streamed to rclone rcat
+        self.cloud_encryption = cloud_encryption
+        # native: encrypt to temp_dir first, then rclone move
+        self.cloud_staging = cloud_staging
+        # number of packs not covered by a midx before rebuilding midx/bloom files
+        self.midx_threshold = midx_threshold
+
+    def _pack_files(self, suffix):
+        repository_objects = Path(self.repository_path, "objects", "pack")
+        if not repository_objects.exists():
+            return []
+        return [el for el in repository_objects.iterdir() if el.suffix == suffix]
+
+    def stored_bytes(self):
+        return sum([el.stat().st_size for el in self._pack_files(".pack")])
+
+    def maintain(self, display=True):
+        packs = self._pack_files(".pack")
+        midx = self._pack_files(".midx")
+        covered = set()
+        for path in midx:
+            covered.update(midx_index_names(path))
+        uncovered = [el for el in packs if el.stem + ".idx" not in covered]
+        details = {"packs": len(packs), "midx_before": len(midx), "uncovered_packs": len(uncovered)}
+        if len(uncovered) < self.midx_threshold:
+            return True, "", None
+
+        yellow("+ Rebuilding midx and bloom files (%s packs, %s not in a midx)." % (len(packs),
+                                                                                  len(uncovered)),
+               display)
+        midx_success, midx_output = bup_command(["midx", "-f"], self.repository_path, quiet=True,
+                                                resources=self.resources)
+        bloom_success, bloom_output = bup_command(["bloom"], self.repository_path, quiet=True,
+                                                  resources=self.resources)
+        details["midx_after"] = len(self._pack_files(".midx"))
+        return midx_success and bloom_success, midx_output + bloom_output, details
+
+    def saves(self, branch):
+        # (name, timestamp) of the saves of a branch
+        success, output = bup_command(["ls", "/%s" % branch], self.repository_path, quiet=True,
+                                      resources=self.resources)
+        saves = []
+        if not success:
+            return saves
+        for name in output.split():
+            try:
+                saves.append((name, time.mktime(time.strptime(name, BUP_SAVE_FORMAT))))
+            except ValueError:
+                # "latest"
+                pass
+        return saves
+
+    def catalog_snapshots(self, sources):
+        # one branch per source, one commit per save
+        success, output = git_command(["for-each-ref", "--format=%(refname:short)", "refs/heads/"],
+                                      self.repository_path, resources=self.resources)
+        if not success:
+            return False, output, []
+        branches = output.split()
+        catalog = []
+        for source in sources:
+            if source.name not in branches:
+                continue
+            log_success, log_output = git_command(["log", "--format=%H %ct", "refs/heads/%s" % source.name],
+                                                  self.repository_path, resources=self.resources)
+            if not log_success:
+                return False, log_output, []
+            for line in log_output.split("\n"):
+                if line.strip():
+                    commit, timestamp = line.split()
+                    catalog.append((commit, source.name, float(timestamp)))
+        return True, output, catalog
+
+    def catalog_files(self, snapshot, root):
+        # saves are stripped of their source directory, paths are put back under root
+        files = {}
+
+        def on_stdout(line):
+            # <mode> <type> <object> <size>\t<path>
+            infos, _, path = line.partition("\t")
+            infos = infos.split()
+            if len(infos) != 4 or infos[1] != "blob" or not infos[0].startswith("100"):
+                return
+            path, chunk = demangle_bup_path(path)
+            if path is None:
+                return
+            size = int(infos[3])
+            if chunk:
+                files[path] = files.get(path, 0) + size
+            else:
+                files[path] = size
+
+        success, output = git_command(["ls-tree", "-r", "-l", snapshot], self.repository_path,
+                                      resources=self.resources, on_stdout=on_stdout)
+        return success, output, [(str(Path(root, path)), size) for path, size in sorted(files.items())]
+
+    def apply_retention(self, sources, policy, dry_run=False, display=True):
+        # one branch per source: remove old saves, then their unreachable objects
+        to_remove = []
+        for source in sources:
+            keep, remove = select_snapshots(self.saves(source.name), policy)
+            yellow("+ %s: keeping %s saves, removing %s." % (source.name, len(keep), len(remove)), display)
+            for name in remove:
+                logger.info("\t- /%s/%s" % (source.name, name))
+            to_remove.extend(["/%s/%s" % (source.name, name) for name in remove])
+        if dry_run or not to_remove:
+            return True, "", to_remove
+
+        rm_success, output = bup_command(["rm", "--unsafe"] + to_remove, self.repository_path,
+                                         quiet=True, resources=self.resources)
+        if not rm_success:
+            return False, output, []
+        yellow("+ Removing unreachable objects.", display)
+        gc_success, gc_output = bup_command(["gc", "--unsafe"], self.repository_path, quiet=True,
+                                            resources=self.resources)
+        output += gc_output
+        # par2 files of rewritten packs are useless, new packs need theirs
+        packs = set([el.stem for el in self._pack_files(".pack")])
+        for par2 in self._pack_files(".par2"):
+            if par2.name.split(".")[0] not in packs:
+                par2.unlink()
+        fsck_success, fsck_output = self.check(generate=True, display=display)
+        return gc_success and fsck_success, output + fsck_output, to_remove
 
     def init(self, quiet=True):
-        return bup_command(["init"], self.repository_path, quiet=quiet)
+        return bup_command(["init"], self.repository_path, quiet=quiet, resources=self.resources)
 
     def check(self, generate=False, display=True):
         # get number of .pack files
         # each .pack has its own par2 files
-        repository_objects = Path(self.repository_path, "objects", "pack")
-        packs = [el for el in repository_objects.iterdir()
-                 if el.suffix == ".pack"]
-        cmd = ["fsck", "-v", "-j8"]
+        packs = self._pack_files(".pack")
+        cmd = ["fsck", "-v", "-j%d" % self.resources.jobs]
         if generate:
             cmd.append("-g")
             title = "Generating: "
@@ -92,47 +319,132 @@ class BupBackend(Backend):
         return bup_command(cmd, self.repository_path, quiet=not display,
                            number_of_items=len(packs),
                            pbar_title=title,
-                           save_output=False)
+                           save_output=False,
+                           resources=self.resources)
+
+    def verification_items(self, period):
+        return sorted([el.name for el in self._pack_files(".pack")])
+
+    def verify_items(self, items, display=True):
+        # fsck only the selected packs, against their par2 files
+        repository_objects = Path(self.repository_path, "objects", "pack")
+        cmd = ["fsck", "-v", "-j%d" % self.resources.jobs, "-r"]
+        cmd.extend([str(Path(repository_objects, el)) for el in items])
+        return bup_command(cmd, self.repository_path, quiet=not display,
+                           number_of_items=len(items),
+                           pbar_title="Checking: ",
+                           save_output=False,
+                           resources=self.resources)
+
+    def save(self, sources, display=True):
+        if not self.batch_save or len(sources) < 2:
+            return super().save(sources, display)
+        # one index for all sources, one redundancy generation at the end
+        blue(">> %s -> %s." % (", ".join([str(el.target_dir) for el in sources]),
+                               self.repository_path), display)
+        yellow("+ Indexing %s sources." % len(sources), display)
+        overall_success, indexed = self._bup_index(sources)
+        output = ""
+        for source in sources:
+            yellow("+ Saving %s." % source.name, display)
+            save_success, save_output = self._bup_save(source, indexed[source.name], display=display)
+            if not save_success:
+                red("!! Error saving %s!! " % source.name)
+            overall_success = overall_success and save_success
+            output += save_output
+        yellow("+ Generating redundancy files.", display)
+        fsck_success, fsck_output = self.check(generate=True, display=display)
+        return overall_success and fsck_success, output + fsck_output
 
     def _save_source(self, source, display=True):
         blue(">> %s -> %s." % (source.target_dir, self.repository_path), display)
         yellow("+ Indexing.", display)
-        index_success, number_of_files = self._bup_index(source)
+        index_success, indexed = self._bup_index([source])
         yellow("+ Saving.", display)
-        save_success, output = self._bup_save(source, number_of_files, display=display)
+        save_success, output = self._bup_save(source, indexed[source.name], display=display)
         yellow("+ Generating redundancy files.", display)
         fsck_success, fsck_output = self.check(generate=True, display=display)
         return index_success and save_success and fsck_success, output + fsck_output
 
-    def _bup_index(self, source):
+    def _bup_index(self, sources):
         cmd = ["index", "-vv"]
-        if source.excluded_extensions:
-            cmd.append(r"--exclude-rx=^.*\.(%s)$" % r"|".join(source.excluded_extensions))
-        cmd.append(str(source.target_dir))
-        success, output = bup_command(cmd, self.repository_path, quiet=True)
-        # returns succes and number of files/folders
-        return success, len(output.strip().split("\n"))
-
-    def _bup_save(self, source, number_of_files, display=True):
-        return bup_command(["save", "-vv",
-                            str(source.target_dir),
-                            "-n", source.name,
-                            '--strip-path=%s' % str(source.target_dir),
-                            '-9'],
-                           self.repository_path,
-                           quiet=not display,
-                           number_of_items=number_of_files,
-                           pbar_title="Saving: ",
-                           save_output=False)
+        with tempfile.TemporaryDirectory(prefix="grenier_exclusions_") as exclusions_dir:
+            for source in sources:
+                # regexes are anchored to each source, all sources share the same exclude files
+                for argument in source.exclusions.bup_arguments(exclusions_dir):
+                    if argument not in cmd:
+                        cmd.append(argument)
+            cmd.extend([str(source.target_dir) for source in sources])
+            success, output = bup_command(cmd, self.repository_path, quiet=True,
+                                          resources=self.resources)
+        # returns success and number of files/folders and bytes per source
+        indexed_paths = output.strip().split("\n")
+        indexed = {}
+        for source in sources:
+            paths = lines_under(indexed_paths, source.target_dir.resolve())
+            indexed[source.name] = (len(paths), sum([bup_line_size(el) for el in paths]))
+        return success, indexed
+
+    def plan_save(self, sources):
+        # index diff, on a copy of the index: lists what is not saved yet, without changing anything
+        with tempfile.TemporaryDirectory(prefix="grenier_plan_") as plan_dir:
+            index = Path(plan_dir, "bupindex")
+            for suffix in ["", ".meta", ".hlink"]:
+                original = Path(self.repository_path, "bupindex" + suffix)
+                if original.exists():
+                    shutil.copy2(str(original), "%s%s" % (index, suffix))
+            cmd = ["index", "-u", "-m", "-f", str(index)]
+            for source in sources:
+                for argument in source.exclusions.bup_arguments(plan_dir):
+                    if argument not in cmd:
+                        cmd.append(argument)
+            cmd.extend([str(source.target_dir) for source in sources])
+            success, output = bup_command(cmd, self.repository_path, quiet=True,
+                                          resources=self.resources)
+        if not success:
+            logger.debug("Could not plan save: %s" % output)
+            return None
+        modified = [el for el in output.strip().split("\n") if el and not el.endswith("/")]
+        return {"files": len(modified), "bytes": sum([bup_line_size(el) for el in modified])}
+
+    def _bup_save(self, source, indexed, display=True):
+        number_of_files, number_of_bytes = indexed
+        level = self.compression_levels.get(source.name)
+        if level is None:
+            level = compression_level(source.compression, source.exclusions)
+        if source.compression == "auto":
+            yellow("+ Compression level: %s." % level, display)
+        stored_before = self.stored_bytes()
+        start = time.time()
+        progress = self._progress("Saving: ", number_of_bytes, display=display)
+        success, output = bup_command(["save", "-vv",
+                                       str(source.target_dir),
+                                       "-n", source.name,
+                                       '--strip-path=%s' % str(source.target_dir),
+                                       '-%d' % level],
+                                      self.repository_path,
+                                      quiet=not display,
+                                      save_output=False,
+                                      resources=self.resources,
+                                      progress=progress)
+        self._processed(progress)
+        # bup only reports the pack delta, deduplication and compression together
+        self._source_stats(source, level, progress.done, self.stored_bytes() - stored_before,
+                           time.time() - start, scanned=number_of_bytes)
+        return success, output
 
     def _restore_source(self, source, target, display=True):
         sub_target = Path(target, source.name)
         return bup_command(["restore", "-C", str(sub_target), "/%s/latest/." % source.name],
                            self.repository_path,
-                           quiet=not display)
+                           quiet=not display,
+                           resources=self.resources)
 
     def sync_to_cloud(self, repository_name, remote, rclone_config_file, encfs_mount=None,
                       password="", display=True):
+        if self.cloud_encryption == "native":
+            return self._export_to_cloud(repository_name, remote, rclone_config_file, encfs_mount,
+                                         password, display)
 
         backup_success = False
         rclone_success = False
@@ -141,25 +453,204 @@ class BupBackend(Backend):
         assert create_or_check_if_empty(encfs_mount)
         assert not is_fuse_mounted(encfs_mount)
         success, output_encfs = encfs_command(self.repository_path, encfs_mount,
-                                              password, reverse=True, quiet=True)
+                                              password, reverse=True, quiet=True,
+                                              resources=self.resources)
         if success:
+            # unmounted if grenier is interrupted
+            engine.track_mount(encfs_mount)
             # save xml
             backup_success = backup_encfs_xml(Path(self.repository_path, ".encfs6.xml"), repository_name)
             # sync to cloud
-            rclone_success, output_rclone = rclone_command(rclone_config_file,
-                                                           "sync",
-                                                           encfs_mount,
-                                                           "%s:%s" % (remote.name, repository_name),
-                                                           quiet=True)
+            progress = self._progress("Uploading: ", display=display)
+            rclone_success, output_rclone = rclone_sync(rclone_config_file,
+                                                        encfs_mount,
+                                                        "%s:%s" % (remote.name, repository_name),
+                                                        Checkpoint(repository_name, remote.name),
+                                                        quiet=True,
+                                                        resources=self.resources,
+                                                        progress=progress,
+                                                        since=self.last_success)
+            self._processed(progress)
             # unmount
             umount(encfs_mount)
+            engine.untrack_mount(encfs_mount)
 
         return success and backup_success and rclone_success, output_encfs + output_rclone
 
+    def plan_sync_to_cloud(self, repository_name, remote, rclone_config_file, encfs_mount=None,
+                           password=""):
+        if self.cloud_encryption == "native":
+            files, to_upload, to_delete = export.changes(self.repository_path,
+                                                         export.load_state(repository_name, remote.name))
+            return {"files": len(to_upload),
+                    "bytes": sum([encrypted_size(files[path][0]) for path in to_upload])}
+        # the dry-run compares the encrypted view, as uploaded
+        if not create_or_check_if_empty(encfs_mount) or is_fuse_mounted(encfs_mount):
+            logger.debug("Could not plan sync to %s: %s is in use." % (remote.name, encfs_mount))
+            return None
+        success, output = encfs_command(self.repository_path, encfs_mount, password, reverse=True,
+                                        quiet=True, resources=self.resources)
+        if not success:
+            logger.debug("Could not plan sync to %s: %s" % (remote.name, output))
+            return None
+        engine.track_mount(encfs_mount)
+        success, plan = rclone_dry_run(rclone_config_file, encfs_mount,
+                                       "%s:%s" % (remote.name, repository_name),
+                                       resources=self.resources)
+        umount(encfs_mount)
+        engine.untrack_mount(encfs_mount)
+        if not success:
+            logger.debug("Could not plan sync to %s: %s" % (remote.name, plan))
+            return None
+        return plan
+
+    def staged_bytes(self, repository_name, remote):
+        # native staging encrypts everything to upload to temp_dir first
+        if self.cloud_encryption != "native" or not self.cloud_staging:
+            return 0
+        return self.plan_sync_to_cloud(repository_name, remote, None)["bytes"]
+
+    def _export_to_cloud(self, repository_name, remote, rclone_config_file, temp_dir, password,
+                         display=True):
+        # only new or modified files are encrypted and uploaded, deleted files are removed.
+        # remote names are keyed hashes of the paths, the encrypted NAMES_FILE maps them back.
+        parameters_path, parameters = export.key_parameters(repository_name)
+        key = derive_key(password, parameters)
+        state = export.load_state(repository_name, remote.name)
+        files, to_upload, to_delete = export.changes(self.repository_path, state)
+        container = "%s:%s" % (remote.name, repository_name)
+        rclone = ["rclone", "--config=%s" % str(rclone_config_file)]
+        timeout = self.resources.timeout
+        errors = {}
+
+        def on_error(path):
+            return lambda line, stream: errors.setdefault(path, []).append(line)
+
+        yellow("+ Encrypting %s files, removing %s." % (len(to_upload), len(to_delete)), display)
+        # not secret, needed with the passphrase for recovery
+        commands = [(self.resources.wrap(rclone + ["copyto", str(parameters_path),
+                                                   "%s/%s" % (container, KEY_FILE)]),
+                     {"on_line": on_error(KEY_FILE), "timeout": timeout})]
+        key_success = engine.run_commands(commands) == [0]
+
+        total = sum([encrypted_size(files[path][0]) for path in to_upload])
+        progress = self._progress("Uploading: ", total, display=display)
+        if self.cloud_staging:
+            staging = Path(temp_dir, "export")
+            for path in to_upload:
+                Path(staging, remote_name(key, path)).parent.mkdir(parents=True, exist_ok=True)
+                encrypt_file(key, Path(self.repository_path, path), Path(staging, remote_name(key, path)),
+                             name=path)
+            if to_upload:
+                success, output = rclone_command(rclone_config_file, "move", staging, container,
+                                                 quiet=True, resources=self.resources,
+                                                 progress=progress)
+                if not success:
+                    errors["rclone move"] = [output]
+            # rclone move removes what was uploaded
+            uploaded = [path for path in to_upload if not Path(staging, remote_name(key, path)).exists()]
+            shutil.rmtree(str(staging), ignore_errors=True)
+        else:
+            progress.start()
+            uploaded = []
+            pending = to_upload
+            for attempt in range(self.resources.retries + 1):
+                failed = []
+                for i in range(0, len(pending), EXPORT_BATCH):
+                    batch = pending[i:i + EXPORT_BATCH]
+                    commands = [(self.resources.wrap(rclone + ["rcat", "%s/%s" % (container,
+                                                                                 remote_name(key, path))]),
+                                 {"input_data": encrypted_stream(key, Path(self.repository_path, path),
+                                                                 progress, name=path),
+                                  "on_line": on_error(path), "timeout": timeout})
+                                for path in batch]
+                    returncodes = engine.run_commands(commands)
+                    done = [path for path, returncode in zip(batch, returncodes) if returncode == 0]
+                    failed.extend([path for path in batch if path not in done])
+                    # an interrupted export resumes after the last batch
+                    for path in done:
+                        state[path] = list(files[path])
+                    export.save_state(repository_name, remote.name, state)
+                    uploaded.extend(done)
+                pending = [path for path in failed if classify_error("\n".join(errors.get(path, []))) == "transient"]
+                if not pending or attempt == self.resources.retries:
+                    break
+                delay = backoff(attempt)
+                yellow("+ %s transient errors, retrying in %.0fs (%s/%s)." % (len(pending), delay, attempt + 1,
+                                                                             self.resources.retries), display)
+                time.sleep(delay)
+                for path in pending:
+                    errors.pop(path, None)
+            progress.finish()
+        self._processed(progress)
+
+        commands = [(self.resources.wrap(rclone + ["deletefile", "%s/%s" % (container, remote_name(key, path))]),
+                     {"on_line": on_error(path), "timeout": timeout})
+                    for path in to_delete]
+        returncodes = engine.run_commands(commands)
+        deleted = [path for path, returncode in zip(to_delete, returncodes) if returncode == 0]
+
+        for path in uploaded:
+            state[path] = list(files[path])
+        for path in deleted:
+            del state[path]
+        export.save_state(repository_name, remote.name, state)
+
+        names = {remote_name(key, path): path for path in state}
+        commands = [(self.resources.wrap(rclone + ["rcat", "%s/%s" % (container, NAMES_FILE)]),
+                     {"input_data": encrypt_names(key, names), "on_line": on_error(NAMES_FILE),
+                      "timeout": timeout})]
+        names_success = engine.run_commands(commands) == [0]
+
+        failed = [path for path in to_upload + to_delete if path not in uploaded and path not in deleted]
+        output = ""
+        for path in failed + [el for el in errors if el not in to_upload + to_delete]:
+            output += "%s: %s\n" % (path, " ".join(errors.get(path, ["failed"])))
+        return key_success and names_success and not failed and not errors.get("rclone move"), output
+
+    def _recover_native(self, repository_name, remote, target, rclone_config_file, encfs_path,
+                        password, display=True):
+        rclone_success, rclone_log = rclone_command(rclone_config_file, "copy", encfs_path,
+                                                    "%s:%s" % (remote.name, repository_name),
+                                                    quiet=not display,
+                                                    resources=self.resources)
+        if not rclone_success:
+            return False, rclone_log
+        for name in [KEY_FILE, NAMES_FILE]:
+            if not Path(encfs_path, name).exists():
+                output = "%s not found on %s, not exported with native encryption?" % (name, remote.name)
+                red("!!! %s" % output, display)
+                return False, output
+        parameters = read_key_parameters(Path(encfs_path, KEY_FILE))
+        key = derive_key(password, parameters)
+        try:
+            names = decrypt_names(key, Path(encfs_path, NAMES_FILE), parameters["chunk_size"])
+        except ValueError as err:
+            # also a wrong passphrase
+            output = "%s: %s" % (NAMES_FILE, err)
+            red("!!! %s" % output, display)
+            return False, output
+        downloaded = list_files(encfs_path)
+        output = ""
+        for name, path in sorted(names.items(), key=lambda el: el[1]):
+            if name not in downloaded:
+                output += "%s: missing from %s\n" % (path, remote.name)
+                continue
+            Path(target, path).parent.mkdir(parents=True, exist_ok=True)
+            try:
+                decrypt_file(key, Path(encfs_path, name), Path(target, path), parameters["chunk_size"], name=path)
+            except ValueError as err:
+                output += "%s: %s\n" % (path, err)
+        return output == "", output
+
     def recover_from_cloud(self, repository_name, remote, target, rclone_config_file,
                            display=True, encfs_path=None, password=None):
         if not create_or_check_if_empty(target):
             return False, "Directory %s is not empty, not doing anything." % target
+        if self.cloud_encryption == "native":
+            assert create_or_check_if_empty(Path(encfs_path))
+            return self._recover_native(repository_name, remote, target, rclone_config_file,
+                                        Path(encfs_path), password, display)
 
         # create encfs_path
         encfs_path = Path(encfs_path)
@@ -168,7 +659,8 @@ class BupBackend(Backend):
         # rclone copy
         rclone_success, rclone_log = rclone_command(rclone_config_file, "copy", encfs_path,
                                                     "%s:%s" % (remote.name, repository_name),
-                                                    quiet=not display)
+                                                    quiet=not display,
+                                                    resources=self.resources)
         if rclone_success:
             # find encfs xml
             xml_backup_dir = Path(xdg.BaseDirectory.save_data_path("grenier"), "encfs_xml")
@@ -177,13 +669,15 @@ class BupBackend(Backend):
             # encfs with password to restore_path
             encfs_success, encfs_log = encfs_command(encfs_path, target, password,
                                                      encfs_xml_path, reverse=False,
-                                                     quiet=not display)
+                                                     quiet=not display,
+                                                     resources=self.resources)
             return encfs_success, encfs_log
         else:
             return False, rclone_log
 
     def fuse(self, mount_path, display=True):
         if create_or_check_if_empty(mount_path):
-            return bup_command(["fuse", str(mount_path)], self.repository_path, quiet=True)
+            return bup_command(["fuse", str(mount_path)], self.repository_path, quiet=True,
+                               resources=self.resources)
         else:
             return False, "!!! Could not mount %s. Mount path exists and is not empty." % mount_path
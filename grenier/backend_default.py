@@ -1,8 +1,25 @@
+import re
+import tempfile
+
 from grenier.helpers import *
 from grenier.logger import *
+from grenier.resources import ResourcePolicy
+from grenier.progress import ByteProgress, parse_human_size
+from grenier.engine import engine
+from grenier.manifest import list_files
+from grenier.transfer import RCLONE_DONE, Checkpoint, error_report, retry
+
+RCLONE_STATS = re.compile(r"([\d.]+\s*[KMGT]?i?B(ytes)?)\s*/\s*([\d.]+\s*[KMGT]?i?B(ytes)?),\s*(\d+)%")
+RSYNC_PROGRESS = re.compile(r"^\s*([\d,]+)\s+(\d+)%")
+RSYNC_FILES = re.compile(r"^Number of regular files transferred: ([\d,]+)", re.MULTILINE)
+RSYNC_BYTES = re.compile(r"^Total transferred file size: ([\d,]+) bytes", re.MULTILINE)
+RCLONE_DRY_RUN = re.compile(r"Skipped copy as --dry-run is set(?: \(size ([^)]+)\))?")
 
 
-def rclone_command(rclone_config_file, operation, directory=None, container=None, quiet=False):
+def rclone_command(rclone_config_file, operation, directory=None, container=None, quiet=False,
+                   resources=None, progress=None, arguments=None, on_done=None):
+    # "upload" copies directory to container, "copy" copies container to directory.
+    # on_done(path) is called for each file transferred.
     if directory is None and container is None and operation != "config":
         raise Exception("Wrong operation!")
     if operation == "config":
@@ -11,54 +28,221 @@ def rclone_command(rclone_config_file, operation, directory=None, container=None
         assert directory is not None and directory.exists()
         assert container is not None
         cmd = ["rclone", "--config=%s" % str(rclone_config_file),
-               operation, "--transfers=16"]
-        # TODO add poption "--stats=1s" and parse to make progressbar
-        if operation == "sync":
+               "copy" if operation == "upload" else operation, "--transfers=16"]
+        if progress is not None:
+            cmd.extend(["--stats=1s", "--stats-one-line", "--stats-log-level=NOTICE"])
+        if on_done is not None:
+            cmd.append("-v")
+        if arguments:
+            cmd.extend(arguments)
+        if operation in ["sync", "move", "upload"]:
             cmd.extend([str(directory), container])
         elif operation == "copy":
             cmd.extend([container, str(directory)])
+        if resources:
+            cmd = resources.wrap(cmd)
         log_cmd(cmd)
-        p = Popen(cmd, stdout=PIPE, stderr=PIPE, bufsize=1)
-        output = ""
-        for line in iter(p.stderr.readline, b''):
-            output += line.decode("utf8")
+        output = []
+
+        def on_line(line, stream):
+            if stream == "stdout":
+                logger.debug("\t" + line)
+                return
+            if on_done is not None and "INFO" in line:
+                done = RCLONE_DONE.search(line)
+                if done:
+                    on_done(done.group(1))
+                return
+            if progress is not None:
+                stats = RCLONE_STATS.search(line)
+                if stats:
+                    progress.set_total(parse_human_size(stats.group(3)))
+                    progress.update(parse_human_size(stats.group(1)))
+                    return
+            output.append(line + "\n")
             if not quiet:
-                logger.warning("\t !!! " + line.decode("utf8").rstrip())
+                logger.warning("\t !!! " + line)
             else:
-                logger.debug("\t !!! " + line.decode("utf8").rstrip())
-        p.communicate()
-        if p.returncode == 0:
-            return True, output
+                logger.debug("\t !!! " + line)
+
+        if progress is not None:
+            progress.start()
+        returncode = engine.run_command(cmd, on_line=on_line, timeout=getattr(resources, "timeout", None))
+        if progress is not None:
+            progress.finish()
+        if returncode == 0:
+            return True, "".join(output)
         else:
-            return False, output
+            return False, "".join(output)
 
 
-def rsync_command(cmd, quiet=False, save_output=True):
-    complete_cmd = ["rsync", "-a", "--delete", "--human-readable",
+def pending_uploads(directory, checkpoint, since=None):
+    # files modified since the last successful sync (all of them if there was none), not yet
+    # copied by the interrupted one. The others are already on the remote.
+    return sorted([path for path, (size, mtime) in list_files(directory).items()
+                   if path not in checkpoint.completed and (since is None or mtime / 1e9 >= since)])
+
+
+def rclone_sync(rclone_config_file, directory, container, checkpoint, quiet=False, resources=None,
+                progress=None, since=None):
+    # retried after transient errors. Files copied by an interrupted sync, even by a previous
+    # run, are in the checkpoint: the files modified since the last successful sync (since, a
+    # timestamp) which are not are uploaded first, without listing the remote, then the sync
+    # itself only has deletions and changed files left.
+    retries = getattr(resources, "retries", 0)
+    # retries are done here, with a backoff
+    arguments = ["--retries=1"]
+
+    def attempt():
+        if checkpoint.completed:
+            pending = pending_uploads(directory, checkpoint, since)
+            if pending:
+                with tempfile.NamedTemporaryFile("w", prefix="grenier_pending_", suffix=".txt") as f:
+                    f.write("\n".join(pending) + "\n")
+                    f.flush()
+                    success, output = rclone_command(rclone_config_file, "upload", directory, container,
+                                                     quiet=quiet, resources=resources, progress=progress,
+                                                     arguments=arguments + ["--files-from=%s" % f.name,
+                                                                            "--no-traverse"],
+                                                     on_done=checkpoint.add)
+                if not success:
+                    return success, output
+        return rclone_command(rclone_config_file, "sync", directory, container, quiet=quiet,
+                              resources=resources, progress=progress, arguments=arguments,
+                              on_done=checkpoint.add)
+
+    if checkpoint.completed:
+        logger.info("\tResuming: %s files already transferred." % len(checkpoint.completed))
+    success, output, kind = retry(attempt, retries, display=not quiet)
+    if success:
+        checkpoint.clear()
+        return True, output
+    checkpoint.close()
+    return False, error_report(output, kind)
+
+
+def rsync_command(cmd, quiet=False, save_output=True, resources=None, progress=None):
+    # parsed progress needs exact byte counts: --human-readable sizes are in powers of 1000
+    complete_cmd = ["rsync", "-a", "--delete", "--human-readable" if progress is None else "--no-human-readable",
                     "--info=progress2", "--force"] + cmd
+    if resources:
+        complete_cmd = resources.wrap(complete_cmd)
     log_cmd(complete_cmd)
-    output = ""
-    if quiet:
-        p = Popen(complete_cmd, stdout=PIPE, stderr=PIPE, bufsize=1)
-    else:
-        p = Popen(complete_cmd, stderr=PIPE, bufsize=1)
+    output = []
 
-    for line in iter(p.stderr.readline, b''):
+    def on_line(line, stream):
+        if progress is not None:
+            # progress2 lines end with \r
+            match = RSYNC_PROGRESS.match(line)
+            if match:
+                done = parse_human_size(match.group(1))
+                percentage = int(match.group(2))
+                if done is not None and percentage > 0:
+                    progress.set_total(done * 100 // percentage)
+                progress.update(done)
+                return
+        elif stream == "stdout":
+            return
         if not quiet:
-            logger.warning("\t !!! " + line.decode("utf8").rstrip())
+            logger.warning("\t !!! " + line)
         if save_output:
-            output += line.decode("utf8")
-    p.communicate()
-    if p.returncode == 0:
-        return True, output
+            output.append(line + "\n")
+
+    if progress is not None:
+        progress.start()
+    # without progress, rsync talks to the terminal unless quiet
+    returncode = engine.run_command(complete_cmd, on_line=on_line,
+                                    capture_stdout=progress is not None or quiet,
+                                    timeout=getattr(resources, "timeout", None))
+    if progress is not None:
+        progress.finish()
+    if returncode == 0:
+        return True, "".join(output)
     else:
-        return False, output
+        return False, "".join(output)
+
+
+def rsync_dry_run(cmd, resources=None):
+    # files and bytes rsync would transfer
+    complete_cmd = ["rsync", "-a", "--delete", "--force", "-n", "--stats"] + cmd
+    if resources:
+        complete_cmd = resources.wrap(complete_cmd)
+    log_cmd(complete_cmd)
+    outputs = {"stdout": [], "stderr": []}
+    returncode = engine.run_command(complete_cmd,
+                                    on_line=lambda line, stream: outputs[stream].append(line),
+                                    timeout=getattr(resources, "timeout", None))
+    output = "\n".join(outputs["stdout"])
+    files = RSYNC_FILES.search(output)
+    transferred = RSYNC_BYTES.search(output)
+    if returncode != 0 or files is None or transferred is None:
+        return False, "\n".join(outputs["stderr"])
+    return True, {"files": int(files.group(1).replace(",", "")),
+                  "bytes": int(transferred.group(1).replace(",", ""))}
+
+
+def rclone_dry_run(rclone_config_file, directory, container, resources=None):
+    # files and bytes rclone sync would upload, from its dry-run notices
+    cmd = ["rclone", "--config=%s" % str(rclone_config_file), "sync", "--dry-run",
+           str(directory), container]
+    if resources:
+        cmd = resources.wrap(cmd)
+    log_cmd(cmd)
+    lines = []
+    returncode = engine.run_command(cmd,
+                                    on_line=lambda line, stream: lines.append(line),
+                                    timeout=getattr(resources, "timeout", None))
+    if returncode != 0:
+        return False, "\n".join(lines)
+    plan = {"files": 0, "bytes": 0}
+    for line in lines:
+        skipped = RCLONE_DRY_RUN.search(line)
+        if skipped:
+            plan["files"] += 1
+            if skipped.group(1):
+                plan["bytes"] += parse_human_size(skipped.group(1).replace("i", "")) or 0
+    return True, plan
 
 
 class Backend(object):
-    def __init__(self, name, repository_path, *args):
+    def __init__(self, name, repository_path, *args, resources=None):
         self.name = name
         self.repository_path = repository_path
+        if resources is None:
+            resources = ResourcePolicy()
+        self.resources = resources
+        # set by the repository before each operation
+        self.run_progress = None
+        self.progress_rate = None
+        # bytes processed the last time, when the total is not known in advance
+        self.progress_total = None
+        # start of the last successful run of the operation
+        self.last_success = None
+        # auto compression levels of the sources, sampled or cached
+        self.compression_levels = {}
+        self.processed_bytes = 0
+        # per source: sizes, compression level, throughput and ratio of the last save
+        self.source_stats = {}
+
+    def _progress(self, title, total=None, display=True):
+        return ByteProgress(title, total or self.progress_total, rate=self.progress_rate,
+                            run=self.run_progress, display=display)
+
+    def _processed(self, progress):
+        self.processed_bytes += progress.done
+
+    def _source_stats(self, source, level, processed, stored, duration, scanned=None, deduplicated=None):
+        # scanned: size of the source, processed: what was read, deduplicated: what was new,
+        # before compression, stored: what the repository grew by
+        stats = {"level": level, "processed_bytes": processed, "stored_bytes": stored,
+                 "throughput": processed / max(duration, 0.001)}
+        if scanned is not None:
+            stats["scanned_bytes"] = scanned
+        if deduplicated is not None:
+            stats["deduplicated_bytes"] = deduplicated
+        if processed:
+            stats["ratio"] = stored / float(processed)
+        self.source_stats[source.name] = stats
 
     def init(self):
         pass
@@ -66,6 +250,63 @@ class Backend(object):
     def check(self):
         pass
 
+    def stored_bytes(self):
+        # size of the stored data, if cheap to get
+        return None
+
+    def staged_bytes(self, repository_name, remote):
+        # bytes a cloud sync writes to temp_dir before uploading them
+        return 0
+
+    def repository_stats(self):
+        # sizes of the whole repository, as reported by the backend, if available
+        return None
+
+    def maintain(self, display=True):
+        # returns success, output, and details if maintenance was needed
+        return True, "", None
+
+    def plan_save(self, sources):
+        # files and bytes the next save would add, None if it cannot be predicted
+        return None
+
+    def plan_sync_to_folder(self, remote):
+        success, plan = rsync_dry_run([str(self.repository_path), str(remote.full_path)],
+                                      resources=self.resources)
+        if not success:
+            logger.debug("Could not plan sync to %s: %s" % (remote.name, plan))
+            return None
+        return plan
+
+    def plan_sync_to_cloud(self, repository_name, remote, rclone_config_file, encfs_mount=None,
+                           password=""):
+        success, plan = rclone_dry_run(rclone_config_file, self.repository_path,
+                                       "%s:%s" % (remote.name, repository_name),
+                                       resources=self.resources)
+        if not success:
+            logger.debug("Could not plan sync to %s: %s" % (remote.name, plan))
+            return None
+        return plan
+
+    def apply_retention(self, sources, policy, dry_run=False, display=True):
+        # returns success, output, and the removed snapshots
+        return True, "Retention not supported.", []
+
+    def catalog_snapshots(self, sources):
+        # returns success, output, and (snapshot, source name, timestamp) of every snapshot
+        return True, "Catalog not supported.", []
+
+    def catalog_files(self, snapshot, root):
+        # returns success, output, and (path, size) of the files of a snapshot of root
+        return True, "", []
+
+    def verification_items(self, period):
+        # items which, verified one part at a time, cover the whole repository
+        return []
+
+    def verify_items(self, items, display=True):
+        return True, ""
+
     def save(self, sources, display=True):
         output = ""
         overall_success = True
@@ -100,8 +341,12 @@ class Backend(object):
     def sync_to_folder(self, repository_name, remote, display=True):
         if not remote.full_path.exists():
             remote.full_path.mkdir(parents=True)
+        progress = self._progress("Syncing: ", display=display)
         success, err_log = rsync_command([str(self.repository_path), str(remote.full_path)],
-                                         quiet=not display)
+                                         quiet=not display,
+                                         resources=self.resources,
+                                         progress=progress)
+        self._processed(progress)
         if success:
             update_or_create_sync_file(Path(remote.full_path, "last_synced.yaml"),
                                        repository_name)
@@ -109,11 +354,17 @@ class Backend(object):
 
     def sync_to_cloud(self, repository_name, remote, rclone_config_file, encfs_mount=None,
                       password="", display=True):
-        return rclone_command(rclone_config_file,
-                              "sync",
-                              self.repository_path,
-                              "%s:%s" % (remote.name, repository_name),
-                              quiet=not display)
+        progress = self._progress("Uploading: ", display=display)
+        success, output = rclone_sync(rclone_config_file,
+                                      self.repository_path,
+                                      "%s:%s" % (remote.name, repository_name),
+                                      Checkpoint(repository_name, remote.name),
+                                      quiet=not display,
+                                      resources=self.resources,
+                                      progress=progress,
+                                      since=self.last_success)
+        self._processed(progress)
+        return success, output
 
     def recover_from_folder(self, remote, target, display=True):
         if not create_or_check_if_empty(target):
@@ -122,7 +373,8 @@ class Backend(object):
         if not remote_path.exists():
             return False, "No remote files found."
 
-        return rsync_command([str(remote_path), str(target)], quiet=not display)
+        return rsync_command([str(remote_path), str(target)], quiet=not display,
+                             resources=self.resources)
 
     def recover_from_cloud(self, repository_name, remote, target, rclone_config_file,
                            display=True, encfs_path=None, password=None):
@@ -132,7 +384,8 @@ class Backend(object):
                               "copy",
                               target,
                               "%s:%s" % (remote.name, repository_name),
-                              quiet=not display)
+                              quiet=not display,
+                              resources=self.resources)
 
     def fuse(self, mount_path):
         pass
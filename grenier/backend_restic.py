@@ -1,62 +1,277 @@
 from datetime import datetime
+import json
+import re
+import signal
+import tempfile
 
 from grenier.helpers import *
 from grenier.backend_default import Backend
+from grenier.engine import engine
+from grenier.compression import compression_level, restic_compression
+from grenier.retention import restic_arguments
 
+# seconds to wait for restic mount to mount, or to unmount
+MOUNT_TIMEOUT = 30
+# 2023-01-02T10:11:12.123456789+01:00, nanoseconds are too precise for strptime
+RESTIC_TIME = re.compile(r"^(\d{4}-\d\d-\d\dT\d\d:\d\d:\d\d)(?:\.\d+)?(Z|[+-]\d\d:?\d\d)?$")
 
-def restic_command(cmd, repository_path, passphrase):
-    log_cmd(cmd)
-    output = ""
+
+def restic_command(cmd, repository_path, passphrase, resources=None, progress=None):
     env_dict = {"RESTIC_REPOSITORY": str(repository_path),
                 "RESTIC_PASSWORD": passphrase}
-    if cmd[0] == "backup":
-        redirect = None
+    # backup talks to the terminal
+    capture = cmd[0] != "backup" or progress is not None or "--dry-run" in cmd
+    if progress is not None:
+        cmd = cmd[:1] + ["--json"] + cmd[1:]
+    complete_cmd = ["restic"] + cmd
+    if resources:
+        complete_cmd = resources.wrap(complete_cmd)
+        env_dict = resources.environment(env_dict)
+        # restic parallelism
+        env_dict["GOMAXPROCS"] = str(resources.jobs)
+    log_cmd(complete_cmd)
+    if progress is not None:
+        return restic_json_command(complete_cmd, env_dict, progress, getattr(resources, "timeout", None))
+    outputs = {"stdout": [], "stderr": []}
+    returncode = engine.run_command(complete_cmd, env=env_dict,
+                                    on_line=lambda line, stream: outputs[stream].append(line + "\n"),
+                                    capture_stdout=capture, capture_stderr=capture,
+                                    timeout=getattr(resources, "timeout", None))
+    output = "".join(outputs["stdout"] + outputs["stderr"])
+    if returncode == 0:
+        return True, output
     else:
-        redirect = PIPE
-    with Popen(["restic"] + cmd, stdout=redirect, stderr=redirect, env=env_dict) as p:
-        stdout, stderr = p.communicate()
-        if stdout:
-            output = stdout.decode("utf8")
-        if stderr:
-            output += stderr.decode("utf8")
-        if p.returncode == 0:
-            return True, output
+        return False, output
+
+
+def restic_json_command(complete_cmd, env_dict, progress, timeout=None):
+    # --json status messages give bytes done and total bytes
+    output = []
+
+    def on_line(line, stream):
+        try:
+            message = json.loads(line)
+        except ValueError:
+            message = None
+        if isinstance(message, dict) and message.get("message_type") == "status":
+            progress.set_total(message.get("total_bytes"))
+            progress.update(message.get("bytes_done"))
         else:
-            return False, output
+            if isinstance(message, dict) and message.get("message_type") == "summary":
+                progress.update(message.get("total_bytes_processed"))
+            # errors, and the final summary
+            output.append(line + "\n")
+
+    progress.start()
+    returncode = engine.run_command(complete_cmd, env=env_dict, on_line=on_line, timeout=timeout)
+    progress.finish()
+    if returncode == 0:
+        return True, "".join(output)
+    else:
+        return False, "".join(output)
+
+
+def restic_ls(snapshot, repository_path, passphrase, resources=None):
+    # files are parsed as they are listed, large snapshots are not kept as text
+    complete_cmd = ["restic", "ls", "--json", snapshot]
+    env_dict = {"RESTIC_REPOSITORY": str(repository_path),
+                "RESTIC_PASSWORD": passphrase}
+    if resources:
+        complete_cmd = resources.wrap(complete_cmd)
+        env_dict = resources.environment(env_dict)
+    log_cmd(complete_cmd)
+    files = []
+    errors = []
+
+    def on_line(line, stream):
+        if stream == "stderr":
+            errors.append(line + "\n")
+            return
+        try:
+            node = json.loads(line)
+        except ValueError:
+            return
+        if isinstance(node, dict) and node.get("type") == "file":
+            files.append((node["path"], node.get("size", 0)))
+
+    returncode = engine.run_command(complete_cmd, env=env_dict, on_line=on_line,
+                                    timeout=getattr(resources, "timeout", None))
+    return returncode == 0, "".join(errors), files
+
+
+def restic_time(value):
+    match = RESTIC_TIME.match(value)
+    if match is None:
+        return 0
+    zone = (match.group(2) or "+00:00").replace("Z", "+00:00").replace(":", "")
+    return datetime.strptime(match.group(1) + zone, "%Y-%m-%dT%H:%M:%S%z").timestamp()
+
+
+def restic_summary(output):
+    # last summary message of a --json command
+    summary = None
+    for line in output.split("\n"):
+        try:
+            message = json.loads(line)
+        except ValueError:
+            continue
+        if isinstance(message, dict) and message.get("message_type") == "summary":
+            summary = message
+    return summary
 
 
 class ResticBackend(Backend):
-    def __init__(self, repository_path, passphrase):
-        super().__init__("restic", repository_path)
+    def __init__(self, repository_path, passphrase, resources=None, mount_state=None):
+        super().__init__("restic", repository_path, resources=resources)
         self.passphrase = passphrase
+        # state of the background restic mount
+        self.mount_state = mount_state
 
     def init(self, quiet=True):
-        return restic_command(["init"], self.repository_path, self.passphrase)
+        return restic_command(["init"], self.repository_path, self.passphrase,
+                              resources=self.resources)
 
     def check(self, display=True):
-        return restic_command(["check"], self.repository_path, self.passphrase)
+        return restic_command(["check"], self.repository_path, self.passphrase,
+                              resources=self.resources)
 
-    def _save_source(self, source, display=True):
-        yellow("+ Saving %s to %s" % (source.target_dir, self.repository_path), display)
-        if source.excluded_extensions:
-            excluded = ""
-            for ext in source.excluded_extensions:
-                excluded += "-e=*.{ext} ".format(ext=ext)
-            cmd = ["backup", excluded, str(source.target_dir)]
+    def stored_bytes(self):
+        data = Path(self.repository_path, "data")
+        if not data.exists():
+            return 0
+        return sum([el.stat().st_size for el in data.rglob("*") if el.is_file()])
+
+    def repository_stats(self):
+        # only reads the index. total_uncompressed_size needs restic >= 0.14
+        success, output = restic_command(["stats", "--json", "--mode", "raw-data"], self.repository_path,
+                                         self.passphrase, resources=self.resources)
+        if not success:
+            return None
+        try:
+            stats = json.loads(output.split("\n")[0])
+        except ValueError:
+            return None
+        return {"stored_bytes": stats.get("total_size"),
+                "uncompressed_bytes": stats.get("total_uncompressed_size"),
+                "snapshots": stats.get("snapshots_count")}
+
+    def apply_retention(self, sources, policy, dry_run=False, display=True):
+        # restic selects snapshots itself, per host and paths
+        cmd = ["forget", "--json"] + restic_arguments(policy)
+        if dry_run:
+            cmd.append("--dry-run")
         else:
-            cmd = ["backup", str(source.target_dir)]
+            cmd.append("--prune")
+        success, output = restic_command(cmd, self.repository_path, self.passphrase,
+                                         resources=self.resources)
+        removed = []
+        for line in output.split("\n"):
+            try:
+                groups = json.loads(line)
+            except ValueError:
+                continue
+            if isinstance(groups, list):
+                for group in groups:
+                    removed.extend([el.get("short_id", el.get("id")) for el in group.get("remove") or []])
+        for snapshot in removed:
+            logger.info("\t- %s" % snapshot)
+        return success, output, removed
 
-        success, output = restic_command(cmd, self.repository_path, self.passphrase)
+    def catalog_snapshots(self, sources):
+        success, output = restic_command(["snapshots", "--json"], self.repository_path, self.passphrase,
+                                         resources=self.resources)
+        if not success:
+            return False, output, []
+        try:
+            snapshots = json.loads(output.split("\n")[0])
+        except ValueError:
+            return False, output, []
+        directories = {str(absolute_path(el.target_dir)): el.name for el in sources}
+        catalog = []
+        for snapshot in snapshots:
+            paths = snapshot.get("paths") or []
+            source_name = None
+            for path in paths:
+                source_name = directories.get(path, source_name)
+            if source_name is None and paths:
+                source_name = paths[0]
+            catalog.append((snapshot["id"], source_name, restic_time(snapshot["time"])))
+        return True, output, catalog
+
+    def catalog_files(self, snapshot, root):
+        # restic paths are already absolute
+        return restic_ls(snapshot, self.repository_path, self.passphrase, resources=self.resources)
+
+    def verification_items(self, period):
+        # one subset of the data packs per run
+        return ["%d/%d" % (i, period) for i in range(1, period + 1)]
+
+    def verify_items(self, items, display=True):
+        success = True
+        output = ""
+        for subset in items:
+            yellow("+ Reading data subset %s." % subset, display)
+            subset_success, subset_output = restic_command(["check", "--read-data-subset=%s" % subset],
+                                                           self.repository_path, self.passphrase,
+                                                           resources=self.resources)
+            success = success and subset_success
+            output += subset_output
+        return success, output
+
+    def _save_source(self, source, display=True):
+        yellow("+ Saving %s to %s" % (source.target_dir, self.repository_path), display)
+        with tempfile.TemporaryDirectory(prefix="grenier_exclusions_") as exclusions_dir:
+            cmd = ["backup"] + source.exclusions.restic_arguments(exclusions_dir)
+            level = None
+            if source.compression is not None:
+                # needs restic >= 0.14
+                level = self.compression_levels.get(source.name)
+                if level is None:
+                    level = compression_level(source.compression, source.exclusions)
+                cmd.append("--compression=%s" % restic_compression(level))
+            cmd.append(str(source.target_dir))
+            start = time.time()
+            progress = self._progress("Saving: ", display=display)
+            success, output = restic_command(cmd, self.repository_path, self.passphrase,
+                                             resources=self.resources,
+                                             progress=progress)
+            self._processed(progress)
+            summary = restic_summary(output)
+            if summary is not None:
+                self._source_stats(source, level, summary.get("total_bytes_processed", 0),
+                                   summary.get("data_added_packed", summary.get("data_added", 0)),
+                                   time.time() - start,
+                                   scanned=summary.get("total_bytes_processed", 0),
+                                   deduplicated=summary.get("data_added", 0))
         if success:
             # optimize
             optimize_success, optimize_output = restic_command(["optimize"],
                                                                self.repository_path,
-                                                               self.passphrase)
+                                                               self.passphrase,
+                                                               resources=self.resources)
             success = success and optimize_success
             output += optimize_output
 
         return success, output
 
+    def plan_save(self, sources):
+        # backup --dry-run needs restic >= 0.13
+        plan = {"files": 0, "bytes": 0}
+        for source in sources:
+            with tempfile.TemporaryDirectory(prefix="grenier_exclusions_") as exclusions_dir:
+                cmd = ["backup", "--dry-run", "--json"] + \
+                      source.exclusions.restic_arguments(exclusions_dir) + [str(source.target_dir)]
+                success, output = restic_command(cmd, self.repository_path, self.passphrase,
+                                                 resources=self.resources)
+            if not success:
+                logger.debug("Could not plan save: %s" % output)
+                return None
+            summary = restic_summary(output)
+            if summary is not None:
+                plan["files"] += summary.get("files_new", 0) + summary.get("files_changed", 0)
+                plan["bytes"] += summary.get("data_added", 0)
+        return plan
+
     def _restore_source(self, source, target, display=True):
         success, output = self.list(display)
         if not success:
@@ -78,18 +293,68 @@ class ResticBackend(Backend):
                                                                  snapshot_hash,
                                                                  latest_date.strftime("%Y-%m-%d %H:%M:%S")))
         return restic_command(["restore", snapshot_hash, "--target", str(target)],
-                              self.repository_path, self.passphrase)
+                              self.repository_path, self.passphrase,
+                              resources=self.resources)
+
+    def _read_mount_state(self):
+        if self.mount_state is None or not self.mount_state.exists():
+            return None
+        with self.mount_state.open() as f:
+            return json.load(f)
+
+    def _mount_process_alive(self, state):
+        # the pid may have been reused since
+        try:
+            cmdline = Path("/proc/%d/cmdline" % state["pid"]).read_bytes()
+        except (FileNotFoundError, ProcessLookupError):
+            return False
+        return b"restic" in cmdline and b"mount" in cmdline
 
     def fuse(self, mount_path, display=True):
-        # TODO: restic only mounts the repo while active, quitting the command unmounts.
-        # TODO: see what can be done about that.
-        return False, "Mounting not supported with restic. Use 'restic -r /path/to/repo mount'."
-        # if create_or_check_if_empty(mount_path):
-        #     return restic_command(["mount", str(mount_path)],
-        #                           self.repository_path, self.passphrase)
-        # else:
-        #     return False, "!!! Could not mount %s. Path exists and is not empty." % mount_path
+        # restic mount only mounts while running: it is started in the background
+        mount_path = absolute_path(mount_path)
+        state = self._read_mount_state()
+        if state is not None and self._mount_process_alive(state):
+            return False, "!!! Already mounted to %s (pid %s)." % (state["mount_path"], state["pid"])
+        if not create_or_check_if_empty(mount_path):
+            return False, "!!! Could not mount %s. Mount path exists and is not empty." % mount_path
+
+        cmd = self.resources.wrap(["restic", "mount", str(mount_path)])
+        env_dict = self.resources.environment({"RESTIC_REPOSITORY": str(self.repository_path),
+                                               "RESTIC_PASSWORD": self.passphrase})
+        log_path = Path(str(self.mount_state) + ".log")
+        log_cmd(cmd)
+        with log_path.open("w") as log_file:
+            p = Popen(cmd, stdin=DEVNULL, stdout=log_file, stderr=STDOUT, env=env_dict,
+                      start_new_session=True)
+        start = time.time()
+        while not is_fuse_mounted(mount_path):
+            if p.poll() is not None or time.time() - start > MOUNT_TIMEOUT:
+                if p.poll() is None:
+                    p.terminate()
+                return False, "!!! restic mount failed: %s" % log_path.read_text()[-2000:]
+            time.sleep(0.5)
+        with self.mount_state.open("w") as f:
+            json.dump({"pid": p.pid, "mount_path": str(mount_path), "started": start,
+                       "log": str(log_path)}, f)
+        return True, ""
+
+    def unfuse(self, mount_path):
+        mount_path = absolute_path(mount_path)
+        state = self._read_mount_state()
+        if state is not None and state["mount_path"] == str(mount_path) and self._mount_process_alive(state):
+            # restic unmounts cleanly when interrupted
+            os.kill(state["pid"], signal.SIGINT)
+            start = time.time()
+            while self._mount_process_alive(state) and time.time() - start < MOUNT_TIMEOUT:
+                time.sleep(0.5)
+            if self._mount_process_alive(state):
+                os.kill(state["pid"], signal.SIGTERM)
+        umount(mount_path)
+        if state is not None and state["mount_path"] == str(mount_path):
+            self.mount_state.unlink()
 
     def list(self, display=True):
-        return restic_command(["snapshots"], self.repository_path, self.passphrase)
+        return restic_command(["snapshots"], self.repository_path, self.passphrase,
+                              resources=self.resources)
 
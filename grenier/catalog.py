@@ -0,0 +1,92 @@
+import sqlite3
+
+from grenier.history import SQLiteDatabase
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS snapshots (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    repository TEXT NOT NULL,
+    snapshot TEXT NOT NULL,
+    source TEXT,
+    time REAL NOT NULL,
+    files INTEGER NOT NULL,
+    UNIQUE (repository, snapshot)
+);
+"""
+# trigram full text index: substring and glob searches without scanning all paths
+FILES_FTS = "CREATE VIRTUAL TABLE IF NOT EXISTS files USING fts5(path, snapshot_id UNINDEXED, " \
+            "size UNINDEXED, tokenize='trigram')"
+# sqlite < 3.34 has no trigram tokenizer, only prefix searches use the index
+FILES_TABLE = "CREATE TABLE IF NOT EXISTS files (path TEXT NOT NULL, snapshot_id INTEGER NOT NULL, " \
+              "size INTEGER); CREATE INDEX IF NOT EXISTS files_path ON files (path); " \
+              "CREATE INDEX IF NOT EXISTS files_snapshot ON files (snapshot_id);"
+GLOB_CHARACTERS = "*?["
+
+
+class GrenierCatalog(SQLiteDatabase):
+    # paths and sizes of the files of every snapshot, of every repository
+    def __init__(self, db_path):
+        super().__init__(db_path)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.executescript(SCHEMA)
+        try:
+            self.db.execute(FILES_FTS)
+        except sqlite3.OperationalError:
+            self.db.executescript(FILES_TABLE)
+
+    def indexed_snapshots(self, repository):
+        return set([el[0] for el in self.db.execute("SELECT snapshot FROM snapshots WHERE repository = ?",
+                                                    (repository,))])
+
+    def add_snapshot(self, repository, snapshot, source, timestamp, files):
+        # files: list of (path, size), all added in one transaction. A snapshot indexed again
+        # replaces its files.
+        with self.db:
+            self.db.execute("BEGIN IMMEDIATE")
+            self._delete_snapshot(repository, snapshot)
+            cursor = self.db.execute("INSERT INTO snapshots (repository, snapshot, source, time, files) "
+                                     "VALUES (?, ?, ?, ?, ?)",
+                                     (repository, snapshot, source, timestamp, len(files)))
+            snapshot_id = cursor.lastrowid
+            self.db.executemany("INSERT INTO files (path, snapshot_id, size) VALUES (?, ?, ?)",
+                                [(path, snapshot_id, size) for (path, size) in files])
+
+    def remove_missing(self, repository, existing):
+        # snapshots removed from the repository since they were indexed
+        removed = self.indexed_snapshots(repository) - set(existing)
+        with self.db:
+            self.db.execute("BEGIN IMMEDIATE")
+            for snapshot in removed:
+                self._delete_snapshot(repository, snapshot)
+        return sorted(removed)
+
+    def _delete_snapshot(self, repository, snapshot):
+        # in the caller's transaction
+        for (snapshot_id,) in self.db.execute("SELECT id FROM snapshots WHERE repository = ? AND snapshot = ?",
+                                              (repository, snapshot)).fetchall():
+            self.db.execute("DELETE FROM files WHERE snapshot_id = ?", (snapshot_id,))
+            self.db.execute("DELETE FROM snapshots WHERE id = ?", (snapshot_id,))
+
+    def find(self, pattern, repositories=None, limit=None):
+        # glob patterns match whole paths, anything else is a case insensitive substring.
+        # returns {(repository, path, size): [(snapshot, source, time), ...]}, oldest snapshots first
+        if any([el in pattern for el in GLOB_CHARACTERS]):
+            condition, parameter = "files.path GLOB ?", pattern
+        else:
+            condition, parameter = "files.path LIKE ?", "%" + pattern + "%"
+        query = "SELECT snapshots.repository, files.path, files.size, snapshots.snapshot, snapshots.source, " \
+                "snapshots.time FROM files JOIN snapshots ON snapshots.id = files.snapshot_id WHERE " + condition
+        parameters = [parameter]
+        if repositories is not None:
+            query += " AND snapshots.repository IN (%s)" % ", ".join(["?"] * len(repositories))
+            parameters.extend(repositories)
+        query += " ORDER BY snapshots.repository, files.path, snapshots.time"
+        matches = {}
+        for repository, path, size, snapshot, source, timestamp in self.db.execute(query, parameters):
+            key = (repository, path, size)
+            if key not in matches:
+                if limit is not None and len(matches) >= limit:
+                    break
+                matches[key] = []
+            matches[key].append((snapshot, source, timestamp))
+        return matches
@@ -1,3 +1,5 @@
+import os
+import shutil
 import sys
 from subprocess import call, DEVNULL
 
@@ -21,10 +23,27 @@ def check_third_party_modules():
 
 # -- External binaries
 # install: rclone, encfs, rsync, bup, restic
+# binaries which ran: name -> [path, mtime], kept with the configuration cache
+known_binaries = {}
+
+
+def binary_signature(p):
+    path = shutil.which(p)
+    if path is None:
+        return None
+    return [path, os.stat(path).st_mtime]
+
+
 def external_binaries_available(p):
+    # not run again if known, and not replaced since
+    signature = binary_signature(p)
+    if signature is not None and known_binaries.get(p) == signature:
+        return True
     try:
         assert call([p, "--version"], stdout=DEVNULL, stderr=DEVNULL) == 0 \
             or call([p, "version"], stdout=DEVNULL, stderr=DEVNULL) == 0
+        if signature is not None:
+            known_binaries[p] = signature
         return True
     except FileNotFoundError:
         print("%s must be installed!" % p)
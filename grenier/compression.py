@@ -0,0 +1,94 @@
+import math
+import os
+import random
+from collections import Counter
+
+# formats which are already compressed, not worth reading
+COMPRESSED_EXTENSIONS = ["7z", "aac", "avi", "bz2", "docx", "epub", "flac", "gif", "gz", "heic",
+                         "jpeg", "jpg", "m4a", "m4v", "mkv", "mov", "mp3", "mp4", "odp", "ods",
+                         "odt", "ogg", "opus", "png", "pptx", "rar", "webm", "webp", "xlsx", "xz",
+                         "zip", "zst"]
+# bits per byte above which data is considered incompressible
+ENTROPY_THRESHOLD = 7.5
+SAMPLE_FILES = 200
+SAMPLE_BYTES = 64 * 1024
+DEFAULT_LEVEL = 9
+# (share of compressible bytes, zlib level)
+AUTO_LEVELS = [(0.1, 0), (0.5, 1), (1.0, 6)]
+
+
+def byte_entropy(data):
+    if not data:
+        return 0.0
+    counts = Counter(data)
+    total = float(len(data))
+    return -sum([c / total * math.log(c / total, 2) for c in counts.values()])
+
+
+def is_compressible(path):
+    if os.path.splitext(path)[1].lower().lstrip(".") in COMPRESSED_EXTENSIONS:
+        return False
+    try:
+        with open(path, "rb") as f:
+            return byte_entropy(f.read(SAMPLE_BYTES)) < ENTROPY_THRESHOLD
+    except OSError:
+        return True
+
+
+def sample_files(exclusions, max_files=SAMPLE_FILES):
+    # reservoir sample of (path, size), the same for a given source
+    rng = random.Random(str(exclusions.root))
+    sample = []
+    seen = 0
+    for directory, dirs, files in os.walk(str(exclusions.root.resolve())):
+        dirs[:] = [d for d in dirs if not exclusions.is_excluded(os.path.join(directory, d), is_dir=True)]
+        for f in files:
+            path = os.path.join(directory, f)
+            if exclusions.is_excluded(path):
+                continue
+            try:
+                size = os.lstat(path).st_size
+            except OSError:
+                continue
+            seen += 1
+            if len(sample) < max_files:
+                sample.append((path, size))
+            else:
+                i = rng.randrange(seen)
+                if i < max_files:
+                    sample[i] = (path, size)
+    return sample
+
+
+def compressible_share(exclusions, max_files=SAMPLE_FILES):
+    # share of the sampled bytes which would gain from compression
+    sample = sample_files(exclusions, max_files)
+    total = sum([size for (path, size) in sample])
+    if not total:
+        return 1.0
+    return sum([size for (path, size) in sample if is_compressible(path)]) / float(total)
+
+
+def choose_level(share):
+    for max_share, level in AUTO_LEVELS:
+        if share <= max_share:
+            return level
+    return AUTO_LEVELS[-1][1]
+
+
+def compression_level(setting, exclusions):
+    # setting: None, a zlib level, or "auto"
+    if setting is None:
+        return DEFAULT_LEVEL
+    if setting == "auto":
+        return choose_level(compressible_share(exclusions))
+    return int(setting)
+
+
+def restic_compression(level):
+    # restic (repository v2) only knows off/auto/max
+    if level == 0:
+        return "off"
+    if level >= 9:
+        return "max"
+    return "auto"
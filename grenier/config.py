@@ -0,0 +1,202 @@
+import getpass
+import json
+import os
+from pathlib import Path
+
+import yaml
+import xdg.BaseDirectory
+
+from grenier import checks
+from grenier.logger import logger
+from grenier.resources import IONICE_CLASSES
+
+# the C loader is much faster, when libyaml is available
+YamlLoader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+CACHE_VERSION = 2
+BACKENDS = ["bup", "restic"]
+
+# key: (accepted types, required)
+REPOSITORY_SCHEMA = {
+    "backend": (str, True),
+    "repository_path": (str, True),
+    "sources": (dict, True),
+    "kdb_file": (str, False),
+    "passphrase": (str, False),
+    "temp_dir": (str, False),
+    "rclone_config_file": (str, False),
+    "remotes": (list, False),
+    "verify_period": (int, False),
+    "priority": (int, False),
+    "batch_save": (bool, False),
+    "midx_threshold": (int, False),
+    "resources": (dict, False),
+    "retention": (dict, False),
+    "cloud_encryption": (str, False),
+    "cloud_staging": (bool, False),
+}
+SOURCE_SCHEMA = {
+    "dir": (str, True),
+    "excluded": (list, False),
+    "exclude": (list, False),
+    "exclude_dirs": (list, False),
+    "max_size": ((str, int), False),
+    "exclude_caches": (bool, False),
+    "compression": ((int, str), False),
+}
+RETENTION_SCHEMA = {
+    "keep_last": (int, False),
+    "keep_daily": (int, False),
+    "keep_weekly": (int, False),
+    "keep_monthly": (int, False),
+}
+RESOURCES_SCHEMA = {
+    "nice": (int, False),
+    "ionice": (str, False),
+    "ionice_level": (int, False),
+    "jobs": (int, False),
+    "cpu_quota": (str, False),
+    "memory_max": ((str, int), False),
+    "timeout": (int, False),
+    "retries": (int, False),
+}
+
+
+def load_yaml(path):
+    with path.open() as f:
+        return yaml.load(f, Loader=YamlLoader)
+
+
+def check_keys(values, schema, where):
+    errors = []
+    for key, (types, required) in schema.items():
+        if key not in values:
+            if required:
+                errors.append("%s: missing '%s'." % (where, key))
+            continue
+        # bool is an int for isinstance, do not accept it where an int is expected
+        if not isinstance(values[key], types) or (isinstance(values[key], bool) and types == int):
+            errors.append("%s: invalid '%s': %r." % (where, key, values[key]))
+    for key in values:
+        if key not in schema:
+            logger.warning("%s: unknown option '%s', ignored." % (where, key))
+    return errors
+
+
+def validate_config(config):
+    # all errors, for all repositories
+    if not isinstance(config, dict) or not config:
+        return ["No repository defined."]
+    errors = []
+    for name, repository in config.items():
+        where = "Repository %s" % name
+        if not isinstance(repository, dict):
+            errors.append("%s: not a mapping of options." % where)
+            continue
+        errors.extend(check_keys(repository, REPOSITORY_SCHEMA, where))
+        if repository.get("backend") not in BACKENDS:
+            errors.append("%s: backend must be one of: %s." % (where, ", ".join(BACKENDS)))
+        if "kdb_file" not in repository and "passphrase" not in repository:
+            errors.append("%s: either 'kdb_file' or 'passphrase' is required." % where)
+        if repository.get("cloud_encryption", "encfs") not in ["encfs", "native"]:
+            errors.append("%s: cloud_encryption must be encfs or native." % where)
+        if isinstance(repository.get("verify_period"), int) and repository["verify_period"] < 1:
+            errors.append("%s: 'verify_period' must be positive." % where)
+        sources = repository.get("sources", {})
+        if isinstance(sources, dict):
+            if not sources:
+                errors.append("%s: no source defined." % where)
+            for source_name, source in sources.items():
+                source_where = "%s, source %s" % (where, source_name)
+                if not isinstance(source, dict):
+                    errors.append("%s: not a mapping of options." % source_where)
+                    continue
+                errors.extend(check_keys(source, SOURCE_SCHEMA, source_where))
+                # True == 1: booleans are not levels
+                compression = source.get("compression", "auto")
+                if isinstance(compression, bool) or compression not in ["auto"] + list(range(10)):
+                    errors.append("%s: compression must be 0 to 9, or auto." % source_where)
+        resources = repository.get("resources", {})
+        if isinstance(resources, dict):
+            errors.extend(check_keys(resources, RESOURCES_SCHEMA, "%s, resources" % where))
+            if resources.get("ionice", "idle") not in IONICE_CLASSES:
+                errors.append("%s: ionice must be one of: %s." % (where, ", ".join(IONICE_CLASSES)))
+        retention = repository.get("retention", {})
+        if isinstance(retention, dict):
+            errors.extend(check_keys(retention, RETENTION_SCHEMA, "%s, retention" % where))
+            if retention and not any([retention.get(key) for key in RETENTION_SCHEMA]):
+                errors.append("%s: retention must keep something." % where)
+        for remote in repository.get("remotes", []):
+            if not isinstance(remote, str):
+                errors.append("%s: invalid remote %r." % (where, remote))
+    return errors
+
+
+def in_config_dir(path):
+    # relative paths are in $XDG_CONFIG_HOME/grenier/
+    path = Path(path)
+    if not path.is_absolute():
+        path = Path(xdg.BaseDirectory.save_config_path("grenier"), path)
+    return str(path)
+
+
+def resolve_config(config):
+    # validated config, with defaults and resolved paths, without secrets
+    resolved = {}
+    default_rclone_config_file = "/home/%s/.rclone.conf" % getpass.getuser()
+    for name, repository in config.items():
+        r = dict(repository)
+        r["repository_path"] = str(Path(repository["repository_path"], "grenier_%s" % name))
+        r["temp_dir"] = repository.get("temp_dir", "/tmp/grenier_%s" % name)
+        r["rclone_config_file"] = in_config_dir(repository.get("rclone_config_file",
+                                                               default_rclone_config_file))
+        if "kdb_file" in repository:
+            r["kdb_file"] = in_config_dir(repository["kdb_file"])
+        r["inline_passphrase"] = "passphrase" in r
+        r.pop("passphrase", None)
+        r["remotes"] = repository.get("remotes", [])
+        r["sources"] = {s: dict(repository["sources"][s]) for s in repository["sources"]}
+        resolved[name] = r
+    return resolved
+
+
+def config_signature(config_file):
+    stat = config_file.stat()
+    # relative paths are kept as configured, they depend on the current directory
+    return {"path": str(config_file.resolve()),
+            "mtime": stat.st_mtime,
+            "size": stat.st_size,
+            "cwd": os.getcwd(),
+            "version": CACHE_VERSION}
+
+
+def save_config_cache(cache_file, config_file, resolved):
+    # with the binaries known to run, checked again only if they change
+    # several grenier processes may write it at the same time
+    temporary = Path("%s.%d.tmp" % (cache_file, os.getpid()))
+    with temporary.open("w") as f:
+        json.dump({"signature": config_signature(config_file), "config": resolved,
+                   "binaries": checks.known_binaries}, f)
+    temporary.replace(cache_file)
+
+
+def load_config(config_file, cache_file=None):
+    # returns the resolved config, and the raw config if it had to be read
+    signature = config_signature(config_file)
+    if cache_file is not None and cache_file.exists():
+        try:
+            with cache_file.open() as f:
+                cached = json.load(f)
+            if cached["signature"] == signature:
+                checks.known_binaries.update(cached.get("binaries", {}))
+                return cached["config"], None
+        except (ValueError, KeyError):
+            logger.debug("Ignoring invalid configuration cache %s." % cache_file)
+
+    config = load_yaml(config_file)
+    errors = validate_config(config)
+    if errors:
+        raise Exception("\n".join(errors))
+    resolved = resolve_config(config)
+    if cache_file is not None:
+        save_config_cache(cache_file, config_file, resolved)
+    return resolved, config
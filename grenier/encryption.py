@@ -0,0 +1,140 @@
+import hashlib
+import hmac
+import io
+import json
+import os
+import struct
+
+try:
+    # native encryption is optionnal
+    from cryptography.exceptions import InvalidTag
+    from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+    from cryptography.hazmat.primitives.kdf.scrypt import Scrypt
+except ImportError:
+    AESGCM = None
+
+MAGIC = b"GRENIER1"
+# plaintext bytes per chunk, each chunk gets its own 16 bytes tag
+CHUNK_SIZE = 1024 * 1024
+TAG_SIZE = 16
+PREFIX_SIZE = 8
+HEADER_SIZE = len(MAGIC) + PREFIX_SIZE
+# stored next to the encrypted files, needed with the passphrase to decrypt them
+KEY_FILE = "grenier_export.json"
+# encrypted {remote name: relative path} of the exported files
+NAMES_FILE = "grenier_names"
+SCRYPT_N = 2 ** 15
+
+
+def native_encryption_available():
+    return AESGCM is not None
+
+
+def new_key_parameters():
+    return {"version": 1, "salt": os.urandom(16).hex(), "n": SCRYPT_N, "chunk_size": CHUNK_SIZE}
+
+
+def derive_key(passphrase, parameters):
+    kdf = Scrypt(salt=bytes.fromhex(parameters["salt"]), length=32, n=parameters["n"], r=8, p=1)
+    return kdf.derive(passphrase.encode("utf8"))
+
+
+def _nonce(prefix, index):
+    return prefix + struct.pack(">I", index)
+
+
+def _associated_data(header, index, last, name):
+    # chunks cannot be reordered, removed or moved to another file, files cannot be swapped
+    return header + struct.pack(">I?", index, last) + name.encode("utf8")
+
+
+def remote_name(key, name):
+    # what a file of the repository is called on the remote, without revealing its name
+    name_key = hmac.new(key, b"grenier names", hashlib.sha256).digest()
+    digest = hmac.new(name_key, name.encode("utf8"), hashlib.sha256).hexdigest()
+    return "%s/%s" % (digest[:2], digest)
+
+
+def encrypt_chunks(key, f, chunk_size=CHUNK_SIZE, name=""):
+    # yields the header, then encrypted chunks of file object f, the last one marked as such.
+    # name: relative path of the file in the repository, authenticated with each chunk
+    aesgcm = AESGCM(key)
+    prefix = os.urandom(PREFIX_SIZE)
+    header = MAGIC + prefix
+    yield header
+    index = 0
+    chunk = f.read(chunk_size)
+    while True:
+        next_chunk = f.read(chunk_size)
+        last = not next_chunk
+        yield aesgcm.encrypt(_nonce(prefix, index), chunk, _associated_data(header, index, last, name))
+        if last:
+            break
+        chunk = next_chunk
+        index += 1
+
+
+def decrypt_chunks(key, f, chunk_size=CHUNK_SIZE, name=""):
+    aesgcm = AESGCM(key)
+    header = f.read(HEADER_SIZE)
+    if len(header) != HEADER_SIZE or not header.startswith(MAGIC):
+        raise ValueError("Not a grenier encrypted file.")
+    prefix = header[len(MAGIC):]
+    index = 0
+    chunk = f.read(chunk_size + TAG_SIZE)
+    while True:
+        next_chunk = f.read(chunk_size + TAG_SIZE)
+        last = not next_chunk
+        try:
+            yield aesgcm.decrypt(_nonce(prefix, index), chunk, _associated_data(header, index, last, name))
+        except InvalidTag:
+            raise ValueError("Corrupt or truncated chunk %d." % index)
+        if last:
+            break
+        chunk = next_chunk
+        index += 1
+
+
+def encrypted_stream(key, path, progress=None, name=""):
+    # opened only when read, for streaming uploads
+    with open(str(path), "rb") as f:
+        for chunk in encrypt_chunks(key, f, name=name):
+            if progress is not None:
+                progress.add(len(chunk))
+            yield chunk
+
+
+def encrypted_size(size, chunk_size=CHUNK_SIZE):
+    chunks = max(1, -(-size // chunk_size))
+    return HEADER_SIZE + size + chunks * TAG_SIZE
+
+
+def encrypt_file(key, source, target, name=""):
+    with open(str(source), "rb") as f_in, open(str(target), "wb") as f_out:
+        for chunk in encrypt_chunks(key, f_in, name=name):
+            f_out.write(chunk)
+
+
+def decrypt_file(key, source, target, chunk_size=CHUNK_SIZE, name=""):
+    with open(str(source), "rb") as f_in, open(str(target), "wb") as f_out:
+        for chunk in decrypt_chunks(key, f_in, chunk_size, name):
+            f_out.write(chunk)
+
+
+def encrypt_names(key, names):
+    return b"".join(encrypt_chunks(key, io.BytesIO(json.dumps(names).encode("utf8")), name=NAMES_FILE))
+
+
+def decrypt_names(key, path, chunk_size=CHUNK_SIZE):
+    with open(str(path), "rb") as f:
+        return json.loads(b"".join(decrypt_chunks(key, f, chunk_size, NAMES_FILE)).decode("utf8"))
+
+
+def read_key_parameters(path):
+    with open(str(path)) as f:
+        return json.load(f)
+
+
+def write_key_parameters(path, parameters):
+    with open(str(path), "w") as f:
+        json.dump(parameters, f)
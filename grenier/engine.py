@@ -0,0 +1,164 @@
+import asyncio
+import re
+import signal
+import threading
+from asyncio.subprocess import DEVNULL, PIPE
+
+from grenier.logger import logger
+
+MAX_COMMANDS = 8
+# rsync --info=progress2 ends its lines with \r
+LINE_SEPARATORS = re.compile(r"\r\n|\r|\n")
+READ_SIZE = 64 * 1024
+# between SIGTERM and SIGKILL
+KILL_DELAY = 5
+
+
+class CommandEngine(object):
+    # runs external commands on asyncio event loops, each reading stdout and stderr
+    # at the same time, with a limit on the number of commands running at once.
+    def __init__(self, max_commands=MAX_COMMANDS):
+        self.slots = threading.BoundedSemaphore(max_commands)
+        self.max_commands = max_commands
+        self.processes = set()
+        # temporary mount points, unmounted when cancelled
+        self.mounts = set()
+        self.lock = threading.Lock()
+
+    def set_limit(self, max_commands):
+        self.slots = threading.BoundedSemaphore(max_commands)
+        self.max_commands = max_commands
+
+    async def _acquire(self):
+        # the limit is shared by all event loops, waiting must not block this one
+        slots = self.slots
+        while not slots.acquire(blocking=False):
+            await asyncio.sleep(0.1)
+        return slots
+
+    async def run(self, cmd, env=None, input_data=None, timeout=None, on_line=None,
+                  capture_stdout=True, capture_stderr=True):
+        # on_line(line, stream) is called for each line, stream being "stdout" or "stderr".
+        # input_data is bytes, or an iterable of bytes streamed to stdin.
+        # returns the exit code, negative if killed.
+        slots = await self._acquire()
+        try:
+            p = await asyncio.create_subprocess_exec(*cmd,
+                                                     stdin=PIPE if input_data is not None else DEVNULL,
+                                                     stdout=PIPE if capture_stdout else None,
+                                                     stderr=PIPE if capture_stderr else None,
+                                                     env=env)
+            with self.lock:
+                self.processes.add(p)
+            try:
+                readers = []
+                if capture_stdout:
+                    readers.append(self._read_lines(p.stdout, "stdout", on_line))
+                if capture_stderr:
+                    readers.append(self._read_lines(p.stderr, "stderr", on_line))
+                if input_data is not None:
+                    readers.append(self._write_input(p.stdin, input_data))
+                try:
+                    await asyncio.wait_for(asyncio.gather(p.wait(), *readers), timeout)
+                except asyncio.TimeoutError:
+                    await self._kill(p)
+                    if on_line is not None:
+                        on_line("Timed out after %ss, killed." % timeout, "stderr")
+                except BaseException:
+                    # cancelled, or failing callback
+                    await self._kill(p)
+                    raise
+            finally:
+                with self.lock:
+                    self.processes.discard(p)
+            return p.returncode
+        finally:
+            slots.release()
+
+    async def _write_input(self, stdin, input_data):
+        if isinstance(input_data, bytes):
+            input_data = [input_data]
+        try:
+            for chunk in input_data:
+                stdin.write(chunk)
+                await stdin.drain()
+        except (BrokenPipeError, ConnectionResetError):
+            # exited without reading everything
+            pass
+        stdin.close()
+
+    async def _read_lines(self, stream, name, on_line):
+        pending = ""
+        while True:
+            chunk = await stream.read(READ_SIZE)
+            if not chunk:
+                break
+            lines = LINE_SEPARATORS.split(pending + chunk.decode("utf8", errors="replace"))
+            pending = lines.pop()
+            for line in lines:
+                if line and on_line is not None:
+                    on_line(line, name)
+        if pending and on_line is not None:
+            on_line(pending, name)
+
+    async def _kill(self, p):
+        if p.returncode is not None:
+            return
+        p.terminate()
+        try:
+            await asyncio.wait_for(p.wait(), KILL_DELAY)
+        except asyncio.TimeoutError:
+            p.kill()
+            await p.wait()
+
+    def run_sync(self, coroutine):
+        # for the synchronous parts of grenier, possibly from several threads
+        loop = asyncio.new_event_loop()
+        try:
+            return loop.run_until_complete(coroutine)
+        except KeyboardInterrupt:
+            # the loop stops there, the children go too
+            self.kill_all()
+            raise
+        finally:
+            loop.close()
+
+    def run_command(self, cmd, **kwargs):
+        return self.run_sync(self.run(cmd, **kwargs))
+
+    def run_commands(self, commands):
+        # commands: list of (cmd, kwargs), run concurrently within the limit. Returns exit codes.
+        async def run_all():
+            return await asyncio.gather(*[self.run(cmd, **kwargs) for (cmd, kwargs) in commands])
+        return self.run_sync(run_all())
+
+    def kill_all(self):
+        with self.lock:
+            processes = list(self.processes)
+        for p in processes:
+            if p.returncode is None:
+                try:
+                    p.send_signal(signal.SIGKILL)
+                except ProcessLookupError:
+                    pass
+
+    def track_mount(self, path):
+        with self.lock:
+            self.mounts.add(path)
+
+    def untrack_mount(self, path):
+        with self.lock:
+            self.mounts.discard(path)
+
+    def cancel(self, umount):
+        # kills running commands and unmounts temporary mount points
+        self.kill_all()
+        with self.lock:
+            mounts = list(self.mounts)
+            self.mounts.clear()
+        for path in mounts:
+            logger.debug("Unmounting %s." % path)
+            umount(path)
+
+
+engine = CommandEngine()
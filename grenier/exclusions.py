@@ -0,0 +1,181 @@
+import os
+import re
+from pathlib import Path
+
+IGNORE_FILE = ".grenierignore"
+CACHEDIR_TAG = "CACHEDIR.TAG"
+CACHEDIR_SIGNATURE = b"Signature: 8a477f597d28d172789f06886806bc55"
+SIZE_UNITS = {"": 1, "k": 1024, "m": 1024 ** 2, "g": 1024 ** 3, "t": 1024 ** 4}
+
+
+def parse_size(size):
+    # "500M" -> bytes
+    if size is None or isinstance(size, int):
+        return size
+    match = re.match(r"^\s*(\d+)\s*([kmgt]?)b?\s*$", str(size).lower())
+    if not match:
+        raise Exception("Invalid size: %s" % size)
+    return int(match.group(1)) * SIZE_UNITS[match.group(2)]
+
+
+def glob_to_regex(glob):
+    # * and ? do not cross directories, ** does
+    regex = ""
+    i = 0
+    while i < len(glob):
+        c = glob[i]
+        if glob[i:i+3] == "**/":
+            regex += "(.*/)?"
+            i += 3
+            continue
+        if glob[i:i+2] == "**":
+            regex += ".*"
+            i += 2
+            continue
+        if c == "*":
+            regex += "[^/]*"
+        elif c == "?":
+            regex += "[^/]"
+        elif c == "[":
+            end = glob.find("]", i + 1)
+            if end == -1:
+                regex += re.escape(c)
+            else:
+                regex += "[" + glob[i+1:end].replace("!", "^", 1) + "]"
+                i = end
+        else:
+            regex += re.escape(c)
+        i += 1
+    return regex
+
+
+def read_ignore_file(path):
+    patterns = []
+    if path.exists():
+        for line in path.read_text().split("\n"):
+            line = line.strip()
+            if line and not line.startswith("#"):
+                patterns.append(line)
+    return patterns
+
+
+def is_cache_directory(path):
+    tag = Path(path, CACHEDIR_TAG)
+    try:
+        with tag.open("rb") as f:
+            return f.read(len(CACHEDIR_SIGNATURE)) == CACHEDIR_SIGNATURE
+    except (FileNotFoundError, NotADirectoryError, PermissionError):
+        return False
+
+
+class ExclusionSpec(object):
+    def __init__(self, root, extensions=None, patterns=None, directories=None, max_size=None,
+                 exclude_caches=False):
+        self.root = Path(root)
+        self.extensions = extensions or []
+        self.directories = directories or []
+        self.max_size = parse_size(max_size)
+        self.exclude_caches = exclude_caches
+        # patterns without "/" match names anywhere, others are relative to the source
+        self.patterns = ["*.%s" % ext for ext in self.extensions]
+        self.patterns += patterns or []
+        self.patterns += read_ignore_file(Path(self.root, IGNORE_FILE))
+        self.patterns += ["%s/" % d.strip("/") for d in self.directories]
+        self.compile()
+
+    def compile(self):
+        real_root = re.escape(str(self.root.resolve()))
+        self.regexes = []
+        self.restic_patterns = []
+        for pattern in self.patterns:
+            # trailing "/": directories only
+            directory_only = pattern.endswith("/")
+            core = pattern.strip("/")
+            if "/" in pattern.rstrip("/"):
+                regex = "^%s/%s" % (real_root, glob_to_regex(core))
+                restic_pattern = "%s/%s" % (self.root.resolve(), core)
+            else:
+                regex = "^%s/(.*/)?%s" % (real_root, glob_to_regex(core))
+                restic_pattern = core
+            if directory_only:
+                # bup index lists directories with a trailing "/"
+                regex += "/"
+            else:
+                regex += "(/|$)"
+            self.regexes.append(regex)
+            self.restic_patterns.append(restic_pattern)
+        self.compiled = [re.compile(el) for el in self.regexes]
+
+    @property
+    def needs_scan(self):
+        return self.max_size is not None or self.exclude_caches
+
+    def is_excluded(self, path, is_dir=False):
+        path = str(path)
+        if is_dir:
+            path += "/"
+        return any([rx.search(path) for rx in self.compiled])
+
+    def scan(self):
+        # only for what bup cannot exclude itself: cache directories and large files.
+        # excluded directories are pruned, not walked.
+        excluded = []
+        if not self.needs_scan:
+            return excluded
+        for directory, dirs, files in os.walk(str(self.root.resolve())):
+            kept = []
+            for d in dirs:
+                path = os.path.join(directory, d)
+                if self.is_excluded(path, is_dir=True):
+                    continue
+                if self.exclude_caches and is_cache_directory(path):
+                    excluded.append(path)
+                    continue
+                kept.append(d)
+            dirs[:] = kept
+            if self.max_size is not None:
+                for f in files:
+                    path = os.path.join(directory, f)
+                    try:
+                        if not self.is_excluded(path) and os.lstat(path).st_size > self.max_size:
+                            excluded.append(path)
+                    except FileNotFoundError:
+                        pass
+        return excluded
+
+    def bup_arguments(self, directory):
+        # bup index options, exclude files are written to directory
+        arguments = []
+        if self.regexes:
+            rx_file = Path(directory, "exclude_rx")
+            with rx_file.open("a") as f:
+                f.write("\n".join(self.regexes) + "\n")
+            arguments.append("--exclude-rx-from=%s" % rx_file)
+        scanned = self.scan()
+        if scanned:
+            paths_file = Path(directory, "exclude_paths")
+            with paths_file.open("a") as f:
+                f.write("\n".join(scanned) + "\n")
+            arguments.append("--exclude-from=%s" % paths_file)
+        return arguments
+
+    def restic_arguments(self, directory):
+        arguments = []
+        if self.restic_patterns:
+            exclude_file = Path(directory, "exclude")
+            with exclude_file.open("w") as f:
+                f.write("\n".join(self.restic_patterns) + "\n")
+            arguments.append("--exclude-file=%s" % exclude_file)
+        if self.exclude_caches:
+            arguments.append("--exclude-caches")
+        if self.max_size is not None:
+            arguments.append("--exclude-larger-than=%d" % self.max_size)
+        return arguments
+
+    def __str__(self):
+        txt = ", ".join(self.patterns)
+        if self.max_size is not None:
+            txt += " [max size: %s]" % self.max_size
+        if self.exclude_caches:
+            txt += " [no caches]"
+        return txt
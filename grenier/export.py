@@ -0,0 +1,52 @@
+import json
+from pathlib import Path
+
+import xdg.BaseDirectory
+
+from grenier.encryption import KEY_FILE, new_key_parameters, read_key_parameters, write_key_parameters
+from grenier.manifest import list_files
+
+
+def export_dir():
+    path = Path(xdg.BaseDirectory.save_data_path("grenier"), "export")
+    if not path.exists():
+        path.mkdir(parents=True)
+    return path
+
+
+def key_parameters(repository_name):
+    # created once per repository, the same for all remotes
+    path = Path(export_dir(), "%s.%s" % (repository_name, KEY_FILE))
+    if not path.exists():
+        write_key_parameters(path, new_key_parameters())
+    return path, read_key_parameters(path)
+
+
+def state_path(repository_name, remote_name):
+    return Path(export_dir(), "%s_%s.json" % (repository_name, remote_name))
+
+
+def load_state(repository_name, remote_name):
+    # {relative path: [size, mtime_ns]} of the files already on the remote
+    path = state_path(repository_name, remote_name)
+    if not path.exists():
+        return {}
+    with path.open() as f:
+        return json.load(f)
+
+
+def save_state(repository_name, remote_name, state):
+    path = state_path(repository_name, remote_name)
+    temporary = Path(str(path) + ".tmp")
+    with temporary.open("w") as f:
+        json.dump(state, f)
+    temporary.replace(path)
+
+
+def changes(root, state):
+    # files to upload (new or modified), and files to delete from the remote
+    files = list_files(root)
+    to_upload = sorted([path for path, (size, mtime) in files.items()
+                        if state.get(path) != [size, mtime]])
+    to_delete = sorted([path for path in state if path not in files])
+    return files, to_upload, to_delete
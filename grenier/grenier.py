@@ -1,27 +1,43 @@
 #!/usr/env/python
-import getpass
 import argparse
+import json
 
 from grenier.checks import check_third_party_modules
 check_third_party_modules()
 # 3rd party modules
-import yaml
 import xdg.BaseDirectory
 
 # grenier modules
 from grenier.logger import *
 from grenier.repository import *
 from grenier.helpers import *
+from grenier.history import GrenierHistory
+from grenier.catalog import GrenierCatalog
+from grenier.resources import ResourcePolicy
+from grenier.progress import RunProgress
+from grenier.planner import ORDERS, TimeBudget, order_by_space, order_repositories, transfer_plan
+from grenier.probe import probe_remotes
+from grenier.config import load_config, load_yaml, save_config_cache
+from grenier import checks
+from grenier.locks import LockManager
+from grenier.engine import MAX_COMMANDS, engine
+from grenier.pipeline import LOCAL_JOBS, NETWORK_JOBS, StagePipeline
 
 
 # ---CONFIG---------------------------
 CONFIG_FILE = "grenier.yaml"
 LAST_SYNCED = "last_synced.yaml"
+HISTORY = "history.db"
+CONFIG_CACHE = "config_cache.json"
+LOCKS = "locks"
+CATALOG = "catalog.db"
+# files shown by --find
+FIND_LIMIT = 200
 
 
 # ---GRENIER---------------------------
 class Grenier(object):
-    def __init__(self, config_file):
+    def __init__(self, config_file, lock_wait=0):
         self.config_file = config_file
         self.repositories = []
         # dict to keep the keepassx kdb passwords, in case several repositories
@@ -30,93 +46,196 @@ class Grenier(object):
 
         self.data_path = xdg.BaseDirectory.save_data_path("grenier")
         self.last_synced_file_path = Path(self.data_path, LAST_SYNCED)
+        self.history = GrenierHistory(Path(self.data_path, HISTORY))
+        self.config_cache_path = Path(self.data_path, CONFIG_CACHE)
+        self.catalog = GrenierCatalog(Path(self.data_path, CATALOG))
+        # other grenier processes may be running
+        self.locks = LockManager(Path(self.data_path, LOCKS), wait=lock_wait)
+        # migrating from last_synced.yaml
+        if self.history.is_empty() and self.last_synced_file_path.exists():
+            self.import_last_synced(self.last_synced_file_path)
 
     def __enter__(self):
+        self.history.start_run(" ".join(sys.argv[1:]))
         return self
 
     def __exit__(self, exc_type, exc_value, traceback):
         if exc_type is not None:
             print("\nGot interrupted. Trying to clean up.")
+            # running commands, and temporary encfs mounts
+            engine.cancel(umount)
+        self.history.end_run()
+        self.history.close()
+        self.catalog.close()
 
     def open_config(self):
-        if self.config_file.exists():
-            try:
-                with self.config_file.open() as f:
-                    config = yaml.load(f)
-                    for p in config:
-                        backend = config[p]["backend"]
-                        repository_path = Path(config[p]["repository_path"], "grenier_%s" % p)
-                        temp_dir = Path(config[p].get("temp_dir", "/tmp/grenier_%s" % p))
-                        default_rclone_config_file = "/home/%s/.rclone.conf" % getpass.getuser()
-                        rclone_config_file = Path(config[p].get("rclone_config_file",
-                                                                default_rclone_config_file))
-                        if not rclone_config_file.is_absolute():
-                            rclone_config_file = Path(xdg.BaseDirectory.save_config_path("grenier"),
-                                                      rclone_config_file)
-
-                        kdb_file = config[p].get("kdb_file", None)
-                        if kdb_file:
-                            kdb_file = Path(kdb_file)
-                            if not kdb_file.is_absolute():
-                                kdb_file = Path(xdg.BaseDirectory.save_config_path("grenier"),
-                                                kdb_file)
-                            assert kdb_file.exists()
-
-                            # find out if kdb file was already opened
-                            master_password = None
-                            if kdb_file in self.master_passwords:
-                                master_password = self.master_passwords[kdb_file]
-
-                            # find repository password
-                            master_password, repository_password = find_password(kdb_file, p,
-                                                                                 kdb_password=master_password)
-                            if master_password and repository_password:
-                                self.master_passwords[kdb_file] = master_password
-                                passphrase = repository_password
-                        else:
-                            passphrase = config[p].get("passphrase", None)
-                        # we really should have the password by now
-                        assert passphrase
-
-                        assert rclone_config_file.exists()
-                        bp = GrenierRepository(p,
-                                               backend,
-                                               repository_path,
-                                               temp_dir,
-                                               rclone_config_file,
-                                               passphrase)
-                        sources_dict = config[p]["sources"]
-                        for s in sources_dict:
-                            bp.add_source(s,
-                                          sources_dict[s]["dir"],
-                                          sources_dict[s].get("excluded", []))
-
-                        bp.add_remotes(config[p].get("remotes", []))
-                        self.repositories.append(bp)
-                return True
-            except Exception as err:
-                print("Invalid configuration file!!")
-                print(err)
-                return False
-        else:
+        if not self.config_file.exists():
             print("No configuration file found!")
             return False
+        try:
+            config, raw_config = load_config(self.config_file, self.config_cache_path)
+            if raw_config is None and any([el["inline_passphrase"] for el in config.values()]):
+                # secrets are not cached: the yaml file is parsed again for them
+                raw_config = load_yaml(self.config_file)
+        except Exception as err:
+            print("Invalid configuration file!!")
+            print(err)
+            return False
 
-    def export_last_sync(self):
-        if self.last_synced_file_path.exists():
-            with self.last_synced_file_path.open() as f:
-                last_synced = yaml.load(f)
-        else:
-            last_synced = {}
-
-        for r in self.repositories:
-            if r.just_synced:
-                if r.name not in last_synced:
-                    last_synced[r.name] = {}
-                for sync in r.just_synced:
-                    last_synced[r.name].update(sync)
-        with self.last_synced_file_path.open("w") as f:
-            yaml.dump(last_synced, f, default_flow_style=False)
+        known_binaries = dict(checks.known_binaries)
+        errors = []
+        for p in config:
+            try:
+                self.repositories.append(self._open_repository(p, config[p], raw_config))
+            except Exception as err:
+                errors.append("Repository %s: %s" % (p, err))
+        if errors:
+            print("Invalid configuration file!!")
+            print("\n".join(errors))
+            return False
+        if checks.known_binaries != known_binaries:
+            save_config_cache(self.config_cache_path, self.config_file, config)
+        return True
+
+    def _open_repository(self, p, config, raw_config):
+        rclone_config_file = Path(config["rclone_config_file"])
+        if not rclone_config_file.exists():
+            raise Exception("rclone configuration file %s not found." % rclone_config_file)
+
+        passphrase = None
+        if config.get("kdb_file"):
+            kdb_file = Path(config["kdb_file"])
+            if not kdb_file.exists():
+                raise Exception("kdb file %s not found." % kdb_file)
+
+            # find out if kdb file was already opened
+            master_password = None
+            if kdb_file in self.master_passwords:
+                master_password = self.master_passwords[kdb_file]
+
+            # find repository password
+            master_password, repository_password = find_password(kdb_file, p,
+                                                                 kdb_password=master_password)
+            if master_password and repository_password:
+                self.master_passwords[kdb_file] = master_password
+                passphrase = repository_password
+        elif config["inline_passphrase"]:
+            passphrase = raw_config[p]["passphrase"]
+        # we really should have the password by now
+        if not passphrase:
+            raise Exception("no passphrase found.")
+
+        bp = GrenierRepository(p,
+                               config["backend"],
+                               Path(config["repository_path"]),
+                               Path(config["temp_dir"]),
+                               rclone_config_file,
+                               passphrase,
+                               history=self.history,
+                               verify_period=config.get("verify_period", 30),
+                               resources=ResourcePolicy.from_config(config.get("resources")),
+                               batch_save=config.get("batch_save", False),
+                               midx_threshold=config.get("midx_threshold", 100),
+                               priority=config.get("priority", 0),
+                               locks=self.locks,
+                               retention=config.get("retention"),
+                               cloud_encryption=config.get("cloud_encryption", "encfs"),
+                               cloud_staging=config.get("cloud_staging", False))
+        sources_dict = config["sources"]
+        for s in sources_dict:
+            bp.add_source(s,
+                          sources_dict[s]["dir"],
+                          sources_dict[s].get("excluded", []),
+                          sources_dict[s],
+                          sources_dict[s].get("compression"))
+
+        bp.add_remotes(config["remotes"])
+        return bp
+
+    def import_last_synced(self, yaml_file):
+        last_synced = load_yaml(yaml_file)
+        if last_synced:
+            imported = self.history.import_last_synced(last_synced)
+            logger.debug("+ Imported %s entries from %s." % (imported, yaml_file))
+
+
+def remotes_to_sync(repository, backup_target):
+    # finding what remotes to back up
+    if not backup_target:
+        return []
+    if backup_target == ["all"]:
+        return [el.name for el in repository.remotes]
+    remote_names = [el.name for el in repository.remotes]
+    return [d for d in backup_target if d in remote_names]
+
+
+def planned_jobs(repository, args):
+    jobs = []
+    if args.check:
+        jobs.append(("check", "repository"))
+    if args.sample_check:
+        jobs.append(("sample_check", "repository"))
+    if args.backup:
+        jobs.append(("save", "repository"))
+    if args.retention:
+        jobs.append(("retention", "repository"))
+    jobs.extend([("sync", remote) for remote in remotes_to_sync(repository, args.backup_target)])
+    return jobs
+
+
+def repository_stages(p, args, budget, catalog):
+    # everything before the syncs, in order. All the jobs of a repository are deferred together.
+    budget.allows_all(p, planned_jobs(p, args))
+
+    if args.check and budget.allows(p, "check", "repository"):
+        p.check_and_repair()
+
+    if args.sample_check and budget.allows(p, "sample_check", "repository"):
+        p.sample_check()
+
+    if args.backup and budget.allows(p, "save", "repository"):
+        p.save()
+
+    if args.retention_preview:
+        p.apply_retention(dry_run=True)
+
+    if args.retention and budget.allows(p, "retention", "repository"):
+        p.apply_retention()
+
+    if args.catalog:
+        p.update_catalog(catalog)
+
+
+def sync_stages(p, remotes, budget, display=True):
+    for remote in remotes:
+        if budget.allows(p, "sync", remote):
+            success = p.sync_remote(remote, display=display)
+            if not display:
+                # only this line is shown, the others would be mixed with the next repository
+                if success:
+                    green("+ %s synced with %s." % (p.name, remote))
+                else:
+                    red("!! %s: error syncing with %s, see the log." % (p.name, remote))
+
+
+def pipelined_stages(p, args, budget, catalog):
+    # disks and directories are synced with the save, cloud remotes in the background
+    remotes = remotes_to_sync(p, args.backup_target)
+    cloud = [el for el in remotes if p._find_remote_by_name(el).is_cloud]
+    local = [el for el in remotes if el not in cloud]
+
+    def local_stage():
+        log("\n+ %s +\n" % p.name, color="boldblue")
+        log(p, display=False)
+        repository_stages(p, args, budget, catalog)
+        if args.backup_target and not remotes:
+            red("Unknown remote(s): %s!!" % " ".join(args.backup_target))
+        sync_stages(p, local, budget)
+
+    stages = [("local", local_stage)]
+    if cloud:
+        stages.append(("network", lambda: sync_stages(p, cloud, budget, display=False)))
+    return stages
 
 
 def main():
@@ -163,12 +282,47 @@ def main():
                                 metavar="REMOTE",
                                 help='backup selected repositories to the cloud'
                                      ' or usb drives, or to "all".')
+    group_projects.add_argument('--verify-remote',
+                                dest='verify_remote',
+                                action='store',
+                                nargs="+",
+                                metavar="REMOTE",
+                                help='verify the copies of selected repositories on disks or '
+                                     'directories, or on "all" of them.')
     group_projects.add_argument('-c',
                                 '--check',
                                 dest='check',
                                 action='store_true',
                                 default=False,
                                 help='check and repair selected repositories.')
+    group_projects.add_argument('--sample-check',
+                                dest='sample_check',
+                                action='store_true',
+                                default=False,
+                                help='check a part of selected repositories, the whole '
+                                     'repository being covered every verify_period runs.')
+    group_projects.add_argument('--retention',
+                                dest='retention',
+                                action='store_true',
+                                default=False,
+                                help='remove snapshots according to the retention policy of '
+                                     'selected repositories.')
+    group_projects.add_argument('--retention-preview',
+                                dest='retention_preview',
+                                action='store_true',
+                                default=False,
+                                help='list snapshots the retention policy would remove.')
+    group_projects.add_argument('--catalog',
+                                dest='catalog',
+                                action='store_true',
+                                default=False,
+                                help='add the new snapshots of selected repositories to the file catalog.')
+    group_projects.add_argument('--find',
+                                dest='find',
+                                action='store',
+                                metavar="PATTERN",
+                                help='find files in the catalog, in selected repositories or in all of '
+                                     'them. Glob patterns match whole paths.')
     group_projects.add_argument('-f',
                                 '--fuse',
                                 dest='fuse',
@@ -189,6 +343,91 @@ def main():
                                 action='store_true',
                                 default=False,
                                 help='list when you last backed up repositories.')
+    group_projects.add_argument('--not-synced-since',
+                                dest='not_synced_since',
+                                action='store',
+                                type=int,
+                                metavar="DAYS",
+                                help='list repositories and remotes not synced in the last DAYS days.')
+    group_projects.add_argument('--trends',
+                                dest='trends',
+                                action='store_true',
+                                default=False,
+                                help='show recent save and sync durations of selected repositories.')
+    group_projects.add_argument('--statistics',
+                                dest='statistics',
+                                action='store_true',
+                                default=False,
+                                help='show what recent saves of selected repositories scanned and added, '
+                                     'per source, and what was uploaded to their remotes.')
+    group_projects.add_argument('--import-last-synced',
+                                dest='import_last_synced',
+                                action='store',
+                                metavar="YAML_FILE",
+                                nargs=1,
+                                help='import a last_synced.yaml file into the history.')
+    group_projects.add_argument('--no-probe',
+                                dest='probe',
+                                action='store_false',
+                                default=True,
+                                help='do not check that remotes are reachable before syncing.')
+    group_projects.add_argument('--order',
+                                dest='order',
+                                action='store',
+                                choices=ORDERS,
+                                default="config",
+                                help='order of the repositories: as in the configuration file, '
+                                     'shortest first, or by priority, from recorded durations.')
+    group_projects.add_argument('--time-budget',
+                                dest='time_budget',
+                                action='store',
+                                type=float,
+                                metavar="MINUTES",
+                                help='do not start jobs predicted to end after MINUTES.')
+    group_projects.add_argument('--plan',
+                                dest='plan',
+                                action='store',
+                                nargs='?',
+                                const=True,
+                                metavar="JSON_FILE",
+                                help='show what --backup and --sync would transfer, without '
+                                     'doing anything. Also saved to JSON_FILE, if given.')
+    group_projects.add_argument('--lock-wait',
+                                dest='lock_wait',
+                                action='store',
+                                type=float,
+                                default=0,
+                                metavar="MINUTES",
+                                help='wait up to MINUTES for repositories and remotes used '
+                                     'by another grenier process, instead of skipping them.')
+    group_projects.add_argument('--max-commands',
+                                dest='max_commands',
+                                action='store',
+                                type=int,
+                                default=MAX_COMMANDS,
+                                metavar="N",
+                                help='maximum number of external commands running at the same time.')
+    group_projects.add_argument('--pipeline',
+                                dest='pipeline',
+                                action='store_true',
+                                default=False,
+                                help='upload to cloud remotes in the background, while the next '
+                                     'repositories are saved.')
+    group_projects.add_argument('--local-jobs',
+                                dest='local_jobs',
+                                action='store',
+                                type=int,
+                                default=LOCAL_JOBS,
+                                metavar="N",
+                                help='with --pipeline, repositories checked, saved and synced to '
+                                     'disks at the same time.')
+    group_projects.add_argument('--network-jobs',
+                                dest='network_jobs',
+                                action='store',
+                                type=int,
+                                default=NETWORK_JOBS,
+                                metavar="N",
+                                help='with --pipeline, repositories uploaded at the same time.')
     group_projects.add_argument('--recover',
                                 dest='recover',
                                 action='store',
@@ -198,7 +437,8 @@ def main():
     args = parser.parse_args()
     logger.debug(args)
 
-    if args.names is None and args.last_synced is False and args.list_repositories is False:
+    if args.names is None and args.last_synced is False and args.list_repositories is False \
+            and args.not_synced_since is None and args.import_last_synced is None and args.find is None:
         log("No project selected. Nothing can be done.", color="red", save=False)
         sys.exit(-1)
 
@@ -229,60 +469,149 @@ def main():
             log("One project (and one only) must be specified with --name", color="red", save=False)
             sys.exit(-1)
 
+    engine.set_limit(max(1, args.max_commands))
+
     # This is where stuff actually gets done.
     overall_start = time.time()
     try:
-        with Grenier(configuration_file) as g:
+        with Grenier(configuration_file, lock_wait=args.lock_wait * 60) as g:
+
+            if args.import_last_synced:
+                g.import_last_synced(Path(args.import_last_synced[0]))
 
             if args.last_synced:
-                show_last_synced(g.last_synced_file_path)
+                show_last_synced(g.history)
 
             elif not g.open_config():
                 log("Invalid configuration. Exiting.", color="red", save=False)
                 sys.exit(-1)
-            for p in g.repositories:
+            if args.not_synced_since is not None:
+                show_not_synced_since(g.history, args.not_synced_since,
+                                      {r.name: ["repository"] + [el.name for el in r.remotes]
+                                       for r in g.repositories})
 
-                if args.list_repositories:
+            if args.list_repositories:
+                for p in g.repositories:
                     print(p)
 
-                if args.names is not None and p.name in args.names or args.names == ["all"]:
+            selected = [p for p in g.repositories
+                        if args.names is not None and p.name in args.names or args.names == ["all"]]
+            selected = order_repositories(selected, lambda r: planned_jobs(r, args), args.order)
+            if (args.backup or args.backup_target) and not args.plan:
+                selected = order_by_space(selected, lambda r: planned_jobs(r, args))
+            if args.time_budget is not None:
+                budget = TimeBudget(args.time_budget * 60)
+            else:
+                budget = TimeBudget()
+
+            if args.backup_target and args.probe:
+                # all remotes at once, before anything is mounted or uploaded
+                to_probe = []
+                for p in selected:
+                    for remote_name in remotes_to_sync(p, args.backup_target):
+                        remote = p._find_remote_by_name(remote_name)
+                        if remote.is_known:
+                            to_probe.append((remote, p.rclone_config_file, p.backend.resources))
+                if to_probe:
+                    yellow("+ Checking %s remotes." % len(to_probe))
+                    probe_remotes(to_probe, g.history)
+                    for remote, rclone_config_file, resources in to_probe:
+                        if not remote.reachable:
+                            red("!! %s unreachable: %s" % (remote.name, remote.probe_message))
+
+            if args.plan:
+                plans = []
+                for p in selected:
+                    repository_plans = transfer_plan(p, planned_jobs(p, args))
+                    logger.info("%s:" % p.name)
+                    show_plan(repository_plans)
+                    plans.extend(repository_plans)
+                if args.plan is not True:
+                    with open(args.plan, "w") as f:
+                        json.dump(plans, f, indent=2)
+                # nothing else is done
+                selected = []
+
+            # aggregate progress, from what was processed the last time
+            run_progress = RunProgress()
+            for p in selected:
+                p.run_progress = run_progress
+                for phase, target in planned_jobs(p, args):
+                    if phase in ["save", "sync"]:
+                        run_progress.expect(p.expected_bytes(phase, target))
+
+            if args.pipeline:
+                pipeline = StagePipeline(args.local_jobs, args.network_jobs)
+                for p in selected:
+                    pipeline.submit(p.name, pipelined_stages(p, args, budget, g.catalog))
+                failed = pipeline.wait()
+                if failed:
+                    red("!! Stopped early: %s." % ", ".join(failed))
+
+            for p in selected:
+                if args.pipeline:
+                    # saves and syncs are already done
+                    if not (args.verify_remote or args.trends or args.statistics or args.fuse or
+                            args.restore or args.recover):
+                        continue
+                    log("\n+ %s +\n" % p.name, color="boldblue")
+                else:
                     log("\n+ %s +\n" % p.name, color="boldblue")
                     log(p, display=False)
-
-                    if args.check:
-                        p.check_and_repair()
-
-                    if args.backup:
-                        p.save()
+                    repository_stages(p, args, budget, g.catalog)
 
                     if args.backup_target:
-                        # finding what remotes to back up
-                        if args.backup_target == ["all"]:
-                            remotes_to_backup = [el.name for el in p.remotes]
-                        else:
-                            remote_names = [el.name for el in p.remotes]
-                            remotes_to_backup = [d for d in args.backup_target
-                                                 if d in remote_names]
+                        remotes_to_backup = remotes_to_sync(p, args.backup_target)
                         if not remotes_to_backup:
                             red("Unknown remote(s): %s!!" % " ".join(args.backup_target))
-                        for remote in remotes_to_backup:
-                            p.sync_remote(remote)
-
-                    if p.just_synced:
-                        g.export_last_sync()
-
-                    if args.fuse:
-                        target = Path(args.fuse[0])
-                        if is_fuse_mounted(target):
-                            p.unfuse(target)
-                        else:
-                            p.fuse(target)
-
-                    if args.restore:
-                        p.restore(Path(args.restore[0]))
-
-                    if args.recover:
-                        p.recover(args.recover[0], args.recover[1])
+                        sync_stages(p, remotes_to_backup, budget)
+
+                if args.verify_remote:
+                    if args.verify_remote == ["all"]:
+                        to_verify = [el.name for el in p.remotes if el.is_disk or el.is_directory]
+                    else:
+                        to_verify = remotes_to_sync(p, args.verify_remote)
+                    for remote in to_verify:
+                        p.verify_remote(remote)
+
+                if args.trends:
+                    show_trends(g.history, p.name,
+                                [("save", "repository")] + [("sync", el.name) for el in p.remotes])
+
+                if args.statistics:
+                    show_statistics(g.history, p.name, [el.name for el in p.remotes])
+
+                if args.fuse:
+                    target = Path(args.fuse[0])
+                    if is_fuse_mounted(target):
+                        p.unfuse(target)
+                    else:
+                        p.fuse(target)
+
+                if args.restore:
+                    p.restore(Path(args.restore[0]))
+
+                if args.recover:
+                    p.recover(args.recover[0], args.recover[1])
+
+            if args.find:
+                repository_names = None
+                if args.names is not None and args.names != ["all"]:
+                    repository_names = args.names
+                matches = g.catalog.find(args.find, repository_names, limit=FIND_LIMIT)
+                show_found(matches)
+                if len(matches) == FIND_LIMIT:
+                    yellow("Only the first %s files are shown." % FIND_LIMIT)
+                elif not matches:
+                    yellow("Nothing found in the catalog.")
+
+            if budget.deferred:
+                red("\n!! Deferred, predicted to end after the time budget:")
+                for name, phase, target, predicted in budget.deferred:
+                    if predicted is None:
+                        red("\t%s: %s %s" % (name, phase, target))
+                    else:
+                        red("\t%s: %s %s (~%.0fs)" % (name, phase, target, predicted))
 
         overall_time = time.time() - overall_start
         log("\nEverything was done in %.2fs." % overall_time, color="boldgreen")
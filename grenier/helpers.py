@@ -1,5 +1,5 @@
 # standard library
-from subprocess import PIPE, Popen, STDOUT
+from subprocess import DEVNULL, PIPE, Popen, STDOUT
 import os
 from pathlib import Path
 import getpass
@@ -10,6 +10,8 @@ import yaml
 from progressbar import Bar, Counter, ETA, Percentage, ProgressBar
 # grenier
 from grenier.logger import *
+from grenier.history import format_timestamp
+from grenier.analytics import compression_ratio, save_rows, source_growth, upload_volume
 
 
 # Logging and notifications
@@ -122,6 +124,24 @@ def get_folder_size(path, excluded_extensions=None):
     return int(size)
 
 
+def existing_parent(path):
+    # path, or its closest parent that exists
+    path = absolute_path(Path(path))
+    while not path.exists() and path != path.parent:
+        path = path.parent
+    return path
+
+
+def free_space(path):
+    # available bytes on the filesystem where path is, or would be created
+    stats = os.statvfs(str(existing_parent(path)))
+    return stats.f_bavail * stats.f_frsize
+
+
+def filesystem(path):
+    return os.stat(str(existing_parent(path))).st_dev
+
+
 def create_or_check_if_empty(target):
     if not target.exists():
         target.mkdir(parents=True)
@@ -138,7 +158,8 @@ def list_fuse_mounts():
                bufsize=1) as p:
         for line in p.stdout:
             line = line.decode("utf8")
-            if "atticfs" in line or "fuse.bup-fuse" in line or "fuse.encfs" in line:
+            if "atticfs" in line or "fuse.bup-fuse" in line or "fuse.encfs" in line \
+                    or "fuse.restic" in line:
                 mounts.append(Path(line.split(" ")[2]))
     return mounts
 
@@ -186,7 +207,7 @@ def find_password(db_file, repository_name, kdb_password=None):
         return kdb_password, None
 
 
-# yaml operations save file
+# sync history
 # -------------------
 
 def update_or_create_sync_file(path, backup_name):
@@ -194,23 +215,107 @@ def update_or_create_sync_file(path, backup_name):
         synced = {}
     else:
         with open(path.as_posix(), 'r') as previous_version:
-            synced = yaml.load(previous_version)
+            synced = yaml.safe_load(previous_version)
     synced[backup_name] = time.strftime("%Y-%m-%d_%Hh%M")
     with open(path.as_posix(), 'w') as last_synced_file:
         yaml.dump(synced, last_synced_file, default_flow_style=False)
 
 
-def show_last_synced(last_synced_file_path):
-    if last_synced_file_path.exists():
-        with last_synced_file_path.open() as f:
-            last_synced = yaml.load(f)
-    else:
-        last_synced = {}
-
+def show_last_synced(history):
+    last_synced = history.last_synced()
     for r in last_synced:
         logger.info("%s:" % r)
         for dest in last_synced[r]:
-            logger.info("\t%s\t%s" % (dest+(20-len(dest))*" ", last_synced[r][dest]))
+            logger.info("\t%s\t%s" % (dest+(20-len(dest))*" ", format_timestamp(last_synced[r][dest])))
+
+
+def show_not_synced_since(history, days, repositories=None):
+    stale = history.not_synced_since(days, repositories)
+    if not stale:
+        logger.info("Everything was synced in the last %d days." % days)
+    for r in stale:
+        logger.info("%s:" % r)
+        for dest in stale[r]:
+            if stale[r][dest] is None:
+                last = "never"
+            else:
+                last = format_timestamp(stale[r][dest])
+            logger.info("\t%s\t%s" % (dest+(20-len(dest))*" ", last))
+
+
+def show_trends(history, repository, phases):
+    logger.info("%s:" % repository)
+    for phase, target in phases:
+        trend = history.duration_trend(repository, phase, target=target)
+        if trend:
+            durations = [d for (end, d) in trend]
+            logger.info("\t%s\t%s\tavg %.2fs (last: %s)" % (phase,
+                                                            target+(20-len(target))*" ",
+                                                            sum(durations) / len(durations),
+                                                            ", ".join(["%.0fs" % d for d in durations])))
+
+
+def show_statistics(history, repository, remotes, limit=10):
+    # what the last saves scanned and added, which sources make the repository grow
+    logger.info("%s:" % repository)
+    events = history.events(repository, "save", "repository", limit=limit)
+    if not events:
+        logger.info("\tNo save recorded.")
+        return
+
+    def size(value):
+        return "?" if value is None else readable_size(value)
+
+    def ratio(value):
+        return "?" if value is None else "%.2f" % value
+
+    logger.info("\tLast %s saves:" % len(events))
+    for row in save_rows(events):
+        logger.info("\t\t%s\tscanned %s, read %s, added %s, ratio %s, %.0fs" % (format_timestamp(row["end"]),
+                                                                               size(row["scanned"]),
+                                                                               size(row["processed"]),
+                                                                               size(row["added"]),
+                                                                               ratio(row["ratio"]),
+                                                                               row["duration"]))
+    growth = source_growth(events)
+    if growth:
+        logger.info("\tSources, by growth:")
+        for name, total in sorted(growth.items(), key=lambda el: el[1]["added"], reverse=True):
+            logger.info("\t\t%s\tsize %s, added %s (%.0f%%), ratio %s" % (name+(20-len(name))*" ",
+                                                                          size(total["scanned"]),
+                                                                          size(total["added"]),
+                                                                          100 * total["share"],
+                                                                          ratio(total["ratio"])))
+    repository_ratio = compression_ratio(events[0])
+    if repository_ratio is not None:
+        logger.info("\tRepository compression ratio: %.2f" % repository_ratio)
+    for remote in remotes:
+        syncs, uploaded = upload_volume(history.events(repository, "sync", remote, limit=limit))
+        if syncs:
+            logger.info("\t%s\t%s syncs, %s uploaded" % (remote+(20-len(remote))*" ", syncs,
+                                                           readable_size(uploaded)))
+
+
+def show_plan(plans):
+    for plan in plans:
+        files = "?" if plan["files"] is None else str(plan["files"])
+        size = "?" if plan["bytes"] is None else readable_size(plan["bytes"])
+        duration = "?" if plan["duration"] is None else "~%.0fs" % plan["duration"]
+        target = plan["target"]
+        logger.info("\t%s\t%s\t%s files, %s, %s" % (plan["phase"], target+(20-len(target))*" ",
+                                                      files, size, duration))
+
+
+def show_found(matches):
+    # one line per file version, with the snapshots containing it
+    for (repository, path, size), snapshots in matches.items():
+        logger.info("%s: %s (%s)" % (repository, path, readable_size(size or 0)))
+        if len(snapshots) == 1:
+            logger.info("\tin %s, %s" % (snapshots[0][0][:8], format_timestamp(snapshots[0][2])))
+        else:
+            logger.info("\tin %s snapshots, from %s to %s" % (len(snapshots),
+                                                               format_timestamp(snapshots[0][2]),
+                                                               format_timestamp(snapshots[-1][2])))
 
 
 # Other things
@@ -0,0 +1,325 @@
+import json
+import sqlite3
+import threading
+import time
+from pathlib import Path
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    start REAL NOT NULL,
+    end REAL,
+    arguments TEXT
+);
+CREATE TABLE IF NOT EXISTS events (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    run_id INTEGER REFERENCES runs(id),
+    repository TEXT NOT NULL,
+    phase TEXT NOT NULL,
+    target TEXT NOT NULL,
+    start REAL NOT NULL,
+    end REAL NOT NULL,
+    bytes INTEGER,
+    success INTEGER NOT NULL,
+    error_tail TEXT,
+    details TEXT
+);
+CREATE INDEX IF NOT EXISTS events_lookup ON events (repository, phase, target, end);
+CREATE TABLE IF NOT EXISTS sizes (
+    repository TEXT NOT NULL,
+    target TEXT NOT NULL,
+    bytes INTEGER NOT NULL,
+    measured REAL NOT NULL,
+    PRIMARY KEY (repository, target)
+);
+CREATE TABLE IF NOT EXISTS compression (
+    repository TEXT NOT NULL,
+    source TEXT NOT NULL,
+    level INTEGER NOT NULL,
+    sampled REAL NOT NULL,
+    PRIMARY KEY (repository, source)
+);
+CREATE TABLE IF NOT EXISTS probes (
+    remote TEXT PRIMARY KEY,
+    reachable INTEGER NOT NULL,
+    message TEXT,
+    probed REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS verification (
+    repository TEXT NOT NULL,
+    item TEXT NOT NULL,
+    verified REAL NOT NULL,
+    PRIMARY KEY (repository, item)
+);
+CREATE TABLE IF NOT EXISTS manifest (
+    repository TEXT NOT NULL,
+    path TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    mtime INTEGER NOT NULL,
+    hash TEXT NOT NULL,
+    PRIMARY KEY (repository, path)
+);
+CREATE TABLE IF NOT EXISTS synced_manifest (
+    repository TEXT NOT NULL,
+    remote TEXT NOT NULL,
+    path TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    mtime INTEGER NOT NULL,
+    hash TEXT NOT NULL,
+    PRIMARY KEY (repository, remote, path)
+);
+"""
+
+TIME_FORMAT = "%Y-%m-%d_%Hh%M"
+ERROR_TAIL_LENGTH = 2000
+
+
+def format_timestamp(timestamp):
+    return time.strftime(TIME_FORMAT, time.localtime(timestamp))
+
+
+class SQLiteDatabase(object):
+    # one connection per thread: stages of different repositories can run at the same time
+    def __init__(self, db_path):
+        self.db_path = Path(db_path)
+        if not self.db_path.parent.exists():
+            self.db_path.parent.mkdir(parents=True)
+        self.local = threading.local()
+        self.connections = []
+        self.connections_lock = threading.Lock()
+
+    @property
+    def db(self):
+        db = getattr(self.local, "db", None)
+        if db is None:
+            # autocommit mode, transactions are explicit. All connections are closed together.
+            db = sqlite3.connect(str(self.db_path), isolation_level=None, timeout=30, check_same_thread=False)
+            db.execute("PRAGMA synchronous=NORMAL")
+            self.local.db = db
+            with self.connections_lock:
+                self.connections.append(db)
+        return db
+
+    def close(self):
+        with self.connections_lock:
+            for db in self.connections:
+                db.close()
+            self.connections = []
+        self.local = threading.local()
+
+
+class GrenierHistory(SQLiteDatabase):
+    def __init__(self, db_path):
+        super().__init__(db_path)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.executescript(SCHEMA)
+        self.run_id = None
+
+    def _write(self, query, parameters=()):
+        with self.db:
+            self.db.execute("BEGIN IMMEDIATE")
+            return self.db.execute(query, parameters)
+
+    # runs
+    # -------------------
+
+    def start_run(self, arguments=""):
+        cursor = self._write("INSERT INTO runs (start, arguments) VALUES (?, ?)",
+                             (time.time(), arguments))
+        self.run_id = cursor.lastrowid
+        return self.run_id
+
+    def end_run(self):
+        if self.run_id is not None:
+            self._write("UPDATE runs SET end = ? WHERE id = ?", (time.time(), self.run_id))
+
+    # events
+    # -------------------
+
+    def record(self, repository, phase, target, start, end=None, success=True,
+               bytes_count=None, output="", details=None):
+        if end is None:
+            end = time.time()
+        error_tail = None
+        if not success and output:
+            error_tail = output[-ERROR_TAIL_LENGTH:]
+        if details is not None:
+            details = json.dumps(details, sort_keys=True)
+        self._write("INSERT INTO events (run_id, repository, phase, target, start, end, "
+                    "bytes, success, error_tail, details) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    (self.run_id, repository, phase, target, start, end,
+                     bytes_count, int(bool(success)), error_tail, details))
+
+    def events(self, repository, phase, target=None, successful_only=True, limit=None):
+        query = "SELECT id, start, end, bytes, success, error_tail, details FROM events " \
+                "WHERE repository = ? AND phase = ?"
+        parameters = [repository, phase]
+        if target is not None:
+            query += " AND target = ?"
+            parameters.append(target)
+        if successful_only:
+            query += " AND success = 1"
+        query += " ORDER BY end DESC"
+        if limit:
+            query += " LIMIT %d" % limit
+        events = []
+        for event_id, start, end, bytes_count, success, error_tail, details in self.db.execute(query,
+                                                                                                parameters):
+            events.append({"id": event_id,
+                           "start": start,
+                           "end": end,
+                           "duration": end - start,
+                           "bytes": bytes_count,
+                           "success": bool(success),
+                           "error_tail": error_tail,
+                           "details": json.loads(details) if details else {}})
+        return events
+
+    def update_details(self, event_id, details):
+        self._write("UPDATE events SET details = ? WHERE id = ?", (json.dumps(details, sort_keys=True), event_id))
+
+    def events_since(self, repository, phase, since, target=None):
+        return [e for e in self.events(repository, phase, target=target) if e["end"] > since]
+
+    # cached sizes
+    # -------------------
+
+    def cache_size(self, repository, target, bytes_count):
+        self._write("INSERT OR REPLACE INTO sizes (repository, target, bytes, measured) "
+                    "VALUES (?, ?, ?, ?)", (repository, target, bytes_count, time.time()))
+
+    def cached_size(self, repository, target, max_age=None):
+        query = "SELECT bytes, measured FROM sizes WHERE repository = ? AND target = ?"
+        row = self.db.execute(query, (repository, target)).fetchone()
+        if row is None or (max_age is not None and row[1] < time.time() - max_age):
+            return None
+        return row[0]
+
+    # auto compression levels
+    # -------------------
+
+    def cache_compression(self, repository, source, level):
+        self._write("INSERT OR REPLACE INTO compression (repository, source, level, sampled) "
+                    "VALUES (?, ?, ?, ?)", (repository, source, level, time.time()))
+
+    def cached_compression(self, repository, source, max_age=None):
+        query = "SELECT level, sampled FROM compression WHERE repository = ? AND source = ?"
+        row = self.db.execute(query, (repository, source)).fetchone()
+        if row is None or (max_age is not None and row[1] < time.time() - max_age):
+            return None
+        return row[0]
+
+    # remote probes
+    # -------------------
+
+    def cache_probe(self, remote, reachable, message):
+        self._write("INSERT OR REPLACE INTO probes (remote, reachable, message, probed) "
+                    "VALUES (?, ?, ?, ?)", (remote, int(bool(reachable)), message, time.time()))
+
+    def cached_probe(self, remote, ttl):
+        query = "SELECT reachable, message FROM probes WHERE remote = ? AND probed > ?"
+        row = self.db.execute(query, (remote, time.time() - ttl)).fetchone()
+        if row is None:
+            return None
+        return bool(row[0]), row[1]
+
+    # sampled verification coverage
+    # -------------------
+
+    def verified_items(self, repository):
+        query = "SELECT item FROM verification WHERE repository = ?"
+        return set([item for (item,) in self.db.execute(query, (repository,))])
+
+    def mark_verified(self, repository, items):
+        now = time.time()
+        with self.db:
+            self.db.execute("BEGIN IMMEDIATE")
+            self.db.executemany("INSERT OR REPLACE INTO verification (repository, item, verified) "
+                                "VALUES (?, ?, ?)", [(repository, item, now) for item in items])
+
+    def reset_verification(self, repository):
+        self._write("DELETE FROM verification WHERE repository = ?", (repository,))
+
+    # content hashes of repository files
+    # -------------------
+
+    def manifest(self, repository, remote=None):
+        # {relative path: (size, mtime_ns, hash)}, of the repository as it was last synced to remote
+        if remote is None:
+            query = "SELECT path, size, mtime, hash FROM manifest WHERE repository = ?"
+            parameters = (repository,)
+        else:
+            query = "SELECT path, size, mtime, hash FROM synced_manifest WHERE repository = ? AND remote = ?"
+            parameters = (repository, remote)
+        return {path: (size, mtime, file_hash)
+                for path, size, mtime, file_hash in self.db.execute(query, parameters)}
+
+    def save_manifest(self, repository, manifest, remote=None):
+        if remote is None:
+            delete = ("DELETE FROM manifest WHERE repository = ?", (repository,))
+            insert = "INSERT INTO manifest (repository, path, size, mtime, hash) VALUES (?, ?, ?, ?, ?)"
+            rows = [(repository, path, size, mtime, file_hash)
+                    for path, (size, mtime, file_hash) in manifest.items()]
+        else:
+            delete = ("DELETE FROM synced_manifest WHERE repository = ? AND remote = ?", (repository, remote))
+            insert = "INSERT INTO synced_manifest (repository, remote, path, size, mtime, hash) " \
+                     "VALUES (?, ?, ?, ?, ?, ?)"
+            rows = [(repository, remote, path, size, mtime, file_hash)
+                    for path, (size, mtime, file_hash) in manifest.items()]
+        with self.db:
+            self.db.execute("BEGIN IMMEDIATE")
+            self.db.execute(*delete)
+            self.db.executemany(insert, rows)
+
+    # reports
+    # -------------------
+
+    def last_synced(self):
+        # most recent successful save ("repository") or sync (remote name)
+        last = {}
+        query = "SELECT repository, target, MAX(end) FROM events " \
+                "WHERE success = 1 AND phase IN ('save', 'sync') " \
+                "GROUP BY repository, target ORDER BY repository, target"
+        for repository, target, end in self.db.execute(query):
+            last.setdefault(repository, {})[target] = end
+        return last
+
+    def not_synced_since(self, days, repositories=None):
+        # repositories or remotes without a successful save/sync in the last N days
+        limit = time.time() - days * 86400
+        stale = {}
+        last = self.last_synced()
+        if repositories is None:
+            repositories = {r: list(last[r].keys()) for r in last}
+        for repository, targets in repositories.items():
+            for target in targets:
+                last_time = last.get(repository, {}).get(target)
+                if last_time is None or last_time < limit:
+                    stale.setdefault(repository, {})[target] = last_time
+        return stale
+
+    def duration_trend(self, repository, phase, target=None, limit=10):
+        return [(e["end"], e["duration"])
+                for e in reversed(self.events(repository, phase, target=target, limit=limit))]
+
+    # migration
+    # -------------------
+
+    def is_empty(self):
+        return self.db.execute("SELECT COUNT(*) FROM events").fetchone()[0] == 0
+
+    def import_last_synced(self, last_synced):
+        # last_synced: {repository: {target: "%Y-%m-%d_%Hh%M"}}, as in last_synced.yaml
+        imported = 0
+        with self.db:
+            self.db.execute("BEGIN IMMEDIATE")
+            for repository in last_synced:
+                for target, date in last_synced[repository].items():
+                    timestamp = time.mktime(time.strptime(date, TIME_FORMAT))
+                    phase = "save" if target == "repository" else "sync"
+                    self.db.execute("INSERT INTO events (run_id, repository, phase, target, "
+                                    "start, end, success, details) VALUES (NULL, ?, ?, ?, ?, ?, 1, ?)",
+                                    (repository, phase, target, timestamp, timestamp,
+                                     json.dumps({"imported": True})))
+                    imported += 1
+        return imported
@@ -0,0 +1,112 @@
+import fcntl
+import hashlib
+import os
+import threading
+import time
+from contextlib import ExitStack, contextmanager
+from pathlib import Path
+
+# acquisition order, so that processes do not wait for each other in a loop
+LOCK_KINDS = ["repository", "temp_dir", "remote"]
+LOCK_POLL = 1.0
+
+
+class LockError(Exception):
+    pass
+
+
+class LockManager(object):
+    # advisory locks shared by all grenier processes, one file per locked resource
+    def __init__(self, lock_dir, wait=0):
+        self.lock_dir = Path(lock_dir)
+        if not self.lock_dir.exists():
+            self.lock_dir.mkdir(parents=True)
+        # seconds to wait for a busy resource
+        self.wait = wait
+        # locks held by this process: path -> {"file", "shared", "threads"}
+        self.held = {}
+        # threads of this process wait for each other, not for the lock file
+        self.held_lock = threading.Condition()
+
+    def lock_path(self, kind, key):
+        digest = hashlib.sha1(str(key).encode("utf8")).hexdigest()[:16]
+        return Path(self.lock_dir, "%s_%s.lock" % (kind, digest))
+
+    @contextmanager
+    def lock(self, kind, key, shared=False):
+        path = self.lock_path(kind, key)
+        thread = threading.get_ident()
+        with self.held_lock:
+            while True:
+                held = self.held.get(path)
+                if held is None:
+                    # the file lock is acquired below, other threads wait until then
+                    held = {"file": None, "shared": shared, "threads": [thread]}
+                    self.held[path] = held
+                    break
+                if thread in held["threads"]:
+                    if held["shared"] and not shared:
+                        raise LockError("%s %s is already locked for reading." % (kind, key))
+                    # reentrant in the same thread: exclusive covers shared
+                    held["threads"].append(thread)
+                    break
+                if held["shared"] and shared and held["file"] is not None:
+                    held["threads"].append(thread)
+                    break
+                self.held_lock.wait()
+
+        if held["file"] is None:
+            try:
+                f = self._acquire(path, kind, key, shared)
+            except LockError:
+                with self.held_lock:
+                    del self.held[path]
+                    self.held_lock.notify_all()
+                raise
+            with self.held_lock:
+                held["file"] = f
+                self.held_lock.notify_all()
+        try:
+            yield
+        finally:
+            with self.held_lock:
+                held["threads"].remove(thread)
+                if not held["threads"]:
+                    del self.held[path]
+                    if not held["shared"]:
+                        held["file"].truncate(0)
+                    fcntl.flock(held["file"], fcntl.LOCK_UN)
+                    held["file"].close()
+                    self.held_lock.notify_all()
+
+    def _acquire(self, path, kind, key, shared):
+        f = path.open("a+")
+        mode = fcntl.LOCK_SH if shared else fcntl.LOCK_EX
+        deadline = time.time() + self.wait
+        while True:
+            try:
+                fcntl.flock(f, mode | fcntl.LOCK_NB)
+                break
+            except BlockingIOError:
+                if time.time() >= deadline:
+                    f.seek(0)
+                    owner = f.read().strip()
+                    f.close()
+                    if owner:
+                        raise LockError("%s %s is used by another grenier process (%s)." % (kind, key, owner))
+                    raise LockError("%s %s is used by another grenier process." % (kind, key))
+                time.sleep(LOCK_POLL)
+        if not shared:
+            # for the error message of the others
+            f.truncate(0)
+            f.write("pid %d" % os.getpid())
+            f.flush()
+        return f
+
+    @contextmanager
+    def lock_all(self, locks):
+        # locks: list of (kind, key, shared)
+        with ExitStack() as stack:
+            for kind, key, shared in sorted(locks, key=lambda el: (LOCK_KINDS.index(el[0]), str(el[1]))):
+                stack.enter_context(self.lock(kind, key, shared))
+            yield
@@ -1,8 +1,78 @@
+import atexit
+import gzip
 import logging
+import logging.handlers
+import queue
+import shutil
 import time
 from pathlib import Path
 import xdg.BaseDirectory
 
+# old logs kept, compressed
+KEEP_LOGS = 50
+# logs more recent than that may belong to another running instance
+COMPRESS_AFTER = 24 * 3600
+# records buffered before writing to the log file
+FILE_BUFFER = 512
+MAX_LOG_SIZE = 50 * 1024 * 1024
+# console lines per second, for chatty child processes
+CONSOLE_RATE = 50
+
+
+class RateLimitHandler(logging.StreamHandler):
+    # console: drops INFO and below above max_lines per interval, says how many were dropped
+    def __init__(self, stream=None, max_lines=CONSOLE_RATE, interval=1.0):
+        super().__init__(stream)
+        self.max_lines = max_lines
+        self.interval = interval
+        self.window_start = 0
+        self.lines = 0
+        self.suppressed = 0
+
+    def emit(self, record):
+        if record.levelno <= logging.INFO:
+            now = time.monotonic()
+            if now - self.window_start >= self.interval:
+                self.window_start = now
+                self.lines = 0
+            self.lines += 1
+            if self.lines > self.max_lines:
+                self.suppressed += 1
+                return
+        if self.suppressed:
+            # a copy: the log file gets the same record, and every line
+            record = logging.makeLogRecord(record.__dict__)
+            record.msg = "[%d lines not shown] %s" % (self.suppressed, record.getMessage())
+            record.args = None
+            self.suppressed = 0
+        super().emit(record)
+
+    def flush_suppressed(self):
+        # when the output stops in the middle of a burst
+        with self.lock:
+            if self.suppressed:
+                super().emit(logging.makeLogRecord({"msg": "[%d lines not shown]" % self.suppressed,
+                                                    "levelno": logging.INFO, "levelname": "INFO"}))
+                self.suppressed = 0
+
+    def close(self):
+        self.flush_suppressed()
+        super().close()
+
+
+def compress_old_logs(log_dir, current_log, keep=KEEP_LOGS):
+    for log_file in sorted(log_dir.glob("*.log*")):
+        if log_file.suffix == ".gz" or log_file == current_log:
+            continue
+        if time.time() - log_file.stat().st_mtime < COMPRESS_AFTER:
+            continue
+        with log_file.open("rb") as f_in, gzip.open(str(log_file) + ".gz", "wb") as f_out:
+            shutil.copyfileobj(f_in, f_out)
+        log_file.unlink()
+    compressed = sorted(log_dir.glob("*.gz"), key=lambda el: el.stat().st_mtime)
+    for log_file in compressed[:max(0, len(compressed) - keep)]:
+        log_file.unlink()
+
 
 def set_up_logger(program):
     data_path = xdg.BaseDirectory.save_data_path(program)
@@ -14,13 +84,34 @@ def set_up_logger(program):
         log_path.parent.mkdir(parents=True)
     program_logger = logging.getLogger(program)
     program_logger.setLevel(logging.DEBUG)
-    ch = logging.StreamHandler()
+    # the console stays synchronous, to keep its order with print()
+    ch = RateLimitHandler()
     ch.setLevel(logging.INFO)
     program_logger.addHandler(ch)
 
-    fh = logging.FileHandler(log_path.as_posix())
+    # the log file is written in batches by a separate thread
+    fh = logging.handlers.RotatingFileHandler(log_path.as_posix(), maxBytes=MAX_LOG_SIZE,
+                                              backupCount=5, delay=True)
     fh.setLevel(logging.DEBUG)
-    program_logger.addHandler(fh)
+    buffered_fh = logging.handlers.MemoryHandler(FILE_BUFFER, flushLevel=logging.WARNING, target=fh)
+    log_queue = queue.Queue(-1)
+    qh = logging.handlers.QueueHandler(log_queue)
+    qh.setLevel(logging.DEBUG)
+    program_logger.addHandler(qh)
+    listener = logging.handlers.QueueListener(log_queue, buffered_fh)
+    listener.start()
+
+    def stop_logging():
+        ch.flush_suppressed()
+        listener.stop()
+        buffered_fh.close()
+        fh.close()
+    atexit.register(stop_logging)
+
+    try:
+        compress_old_logs(log_path.parent, log_path)
+    except OSError as err:
+        program_logger.debug("Could not compress old logs: %s" % err)
     return program_logger
 
 logger = set_up_logger("grenier")
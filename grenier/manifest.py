@@ -0,0 +1,83 @@
+import hashlib
+import mmap
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+READ_SIZE = 4 * 1024 * 1024
+
+
+def hash_file(path):
+    # hashlib releases the GIL on large buffers, files can be hashed in parallel threads
+    h = hashlib.blake2b(digest_size=20)
+    with open(path, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        if size == 0:
+            return h.hexdigest()
+        try:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                h.update(m)
+        except (OSError, ValueError):
+            # not mappable, large buffered reads instead
+            for chunk in iter(lambda: f.read(READ_SIZE), b""):
+                h.update(chunk)
+    return h.hexdigest()
+
+
+def list_files(root):
+    # {relative path: (size, mtime_ns)}
+    files = {}
+    root = str(root)
+    for directory, dirs, filenames in os.walk(root):
+        for name in filenames:
+            path = os.path.join(directory, name)
+            try:
+                stats = os.lstat(path)
+            except OSError:
+                continue
+            if os.path.islink(path):
+                continue
+            files[os.path.relpath(path, root)] = (stats.st_size, stats.st_mtime_ns)
+    return files
+
+
+def hash_files(root, paths, workers):
+    # {relative path: hash, or None if unreadable}
+    def safe_hash(path):
+        try:
+            return hash_file(os.path.join(str(root), path))
+        except OSError:
+            return None
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        return dict(zip(paths, executor.map(safe_hash, paths)))
+
+
+def update_manifest(root, previous, workers=4):
+    # only new files, or files with a different size or mtime, are hashed again
+    files = list_files(root)
+    manifest = {}
+    to_hash = []
+    for path, (size, mtime) in files.items():
+        known = previous.get(path)
+        if known is not None and known[0] == size and known[1] == mtime:
+            manifest[path] = known
+        else:
+            to_hash.append(path)
+    for path, file_hash in hash_files(root, to_hash, workers).items():
+        if file_hash is not None:
+            manifest[path] = (files[path][0], files[path][1], file_hash)
+    return manifest, len(to_hash)
+
+
+def verify_copy(manifest, copy_root, workers=4):
+    # returns missing, extra and corrupt relative paths of a copy
+    copy = list_files(copy_root)
+    missing = sorted([path for path in manifest if path not in copy])
+    extra = sorted([path for path in copy if path not in manifest])
+    common = [path for path in manifest if path in copy]
+    # different sizes do not need hashing
+    corrupt = [path for path in common if manifest[path][0] != copy[path][0]]
+    to_hash = [path for path in common if manifest[path][0] == copy[path][0]]
+    for path, file_hash in hash_files(copy_root, to_hash, workers).items():
+        if file_hash != manifest[path][2]:
+            corrupt.append(path)
+    return missing, extra, sorted(corrupt)
@@ -0,0 +1,76 @@
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from grenier.helpers import *
+
+LOCAL_JOBS = 1
+NETWORK_JOBS = 2
+
+
+class StagePipeline(object):
+    # stages of a repository run one after the other, stages of different repositories overlap:
+    # uploads of one repository while the next one is saved.
+    # local stages (disk, cpu) and network stages have their own number of jobs.
+    def __init__(self, local_jobs=LOCAL_JOBS, network_jobs=NETWORK_JOBS):
+        self.pools = {"local": ThreadPoolExecutor(max_workers=max(1, local_jobs),
+                                                  thread_name_prefix="grenier_local"),
+                      "network": ThreadPoolExecutor(max_workers=max(1, network_jobs),
+                                                    thread_name_prefix="grenier_network")}
+        self.submitted = []
+        self.cancelled = threading.Event()
+
+    def submit(self, name, stages):
+        # stages: list of (pool, function), returns a future done after the last stage
+        done = Future()
+        self.submitted.append((name, done))
+        self._next(name, list(stages), done)
+        return done
+
+    def _next(self, name, stages, done):
+        if not stages or self.cancelled.is_set():
+            done.set_result(not stages)
+            return
+        pool, function = stages.pop(0)
+
+        def chain(future):
+            if future.cancelled():
+                done.set_result(False)
+            elif future.exception() is not None:
+                done.set_exception(future.exception())
+            else:
+                self._next(name, stages, done)
+        try:
+            self.pools[pool].submit(self._run, function).add_done_callback(chain)
+        except RuntimeError:
+            # shut down after an interruption
+            done.set_result(False)
+
+    def _run(self, function):
+        # stages already queued when interrupted do not start
+        if not self.cancelled.is_set():
+            function()
+
+    def wait(self):
+        # returns the names of the repositories whose stages did not all run
+        failed = []
+        try:
+            for name, done in self.submitted:
+                try:
+                    if not done.result():
+                        failed.append(name)
+                except Exception as err:
+                    red("!! %s: %s" % (name, err))
+                    failed.append(name)
+        except KeyboardInterrupt:
+            self.cancel()
+            raise
+        finally:
+            for pool in self.pools.values():
+                pool.shutdown(wait=not self.cancelled.is_set())
+        return failed
+
+    def cancel(self):
+        # no new stage starts, running ones end when their commands are killed
+        self.cancelled.set()
+        for pool in self.pools.values():
+            pool.shutdown(wait=False)
@@ -0,0 +1,128 @@
+import time
+
+from grenier.helpers import filesystem, free_space
+
+ORDERS = ["config", "shortest", "priority"]
+# extra space required before saving or syncing, over the estimated size
+PREFLIGHT_MARGIN = 1.1
+
+
+def predicted_duration(repository, phase, target, history_size=5):
+    # mean duration of the last successful runs, None if never done
+    if repository.history is None:
+        return None
+    events = repository.history.events(repository.name, phase, target, limit=history_size)
+    if not events:
+        return None
+    return sum([e["duration"] for e in events]) / len(events)
+
+
+def predicted_total(repository, jobs):
+    total = 0
+    for phase, target in jobs:
+        duration = predicted_duration(repository, phase, target)
+        if duration is None:
+            return None
+        total += duration
+    return total
+
+
+def transfer_plan(repository, jobs):
+    # predicted files, bytes and duration of the save and sync jobs
+    plans = []
+    for phase, target in jobs:
+        if phase not in ["save", "sync"]:
+            continue
+        planned = repository.plan(phase, target)
+        plan = {"repository": repository.name, "phase": phase, "target": target,
+                "files": None, "bytes": None, "duration": None}
+        if planned is not None:
+            plan.update(planned)
+        rate = repository.historical_rate(phase, target)
+        if plan["bytes"] is not None and rate:
+            plan["duration"] = plan["bytes"] / rate
+        else:
+            plan["duration"] = predicted_duration(repository, phase, target)
+        plans.append(plan)
+    return plans
+
+
+def order_repositories(repositories, jobs_for, order="config"):
+    # jobs_for(repository) returns the (phase, target) list planned for it
+    if order == "config":
+        return list(repositories)
+    if order not in ORDERS:
+        raise Exception("Unknown order %s, expected one of: %s." % (order, ", ".join(ORDERS)))
+
+    def shortest_first(repository):
+        total = predicted_total(repository, jobs_for(repository))
+        # repositories never done before go last
+        return (total is None, total or 0)
+
+    if order == "shortest":
+        return sorted(repositories, key=shortest_first)
+    return sorted(repositories, key=lambda r: (-r.priority,) + shortest_first(r))
+
+
+def order_by_space(repositories, jobs_for):
+    # repositories whose saves and syncs fit in what the previous ones leave of the free space
+    # go first, the others are tried last
+    available = {}
+    fitting = []
+    later = []
+    for repository in repositories:
+        needed = {}
+        for phase, target in jobs_for(repository):
+            if phase not in ["save", "sync"]:
+                continue
+            for path, bytes_count in repository.space_needed(phase, target):
+                device = filesystem(path)
+                if device not in available:
+                    available[device] = free_space(path)
+                needed[device] = needed.get(device, 0) + bytes_count * PREFLIGHT_MARGIN
+        if all([available[device] >= bytes_count for device, bytes_count in needed.items()]):
+            for device, bytes_count in needed.items():
+                available[device] -= bytes_count
+            fitting.append(repository)
+        else:
+            later.append(repository)
+    return fitting + later
+
+
+class TimeBudget(object):
+    def __init__(self, seconds=None):
+        self.seconds = seconds
+        self.start = time.time()
+        self.deferred = []
+        # repositories with a deferred job: their next jobs are deferred too
+        self.deferred_repositories = set()
+
+    @property
+    def remaining(self):
+        if self.seconds is None:
+            return None
+        return self.seconds - (time.time() - self.start)
+
+    def allows_all(self, repository, jobs):
+        # not started at all if all its jobs are predicted to end after the budget
+        if self.seconds is None:
+            return True
+        predicted = [predicted_duration(repository, phase, target) for phase, target in jobs]
+        if self.remaining <= 0 or sum([el for el in predicted if el is not None]) > self.remaining:
+            self.deferred_repositories.add(repository.name)
+            return False
+        return True
+
+    def allows(self, repository, phase, target):
+        # do not start jobs predicted to end after the budget, nor the jobs of a repository after
+        # a deferred one: no sync of a repository whose save was deferred
+        if self.seconds is None:
+            return True
+        predicted = predicted_duration(repository, phase, target)
+        remaining = self.remaining
+        if repository.name in self.deferred_repositories or remaining <= 0 or \
+                (predicted is not None and predicted > remaining):
+            self.deferred_repositories.add(repository.name)
+            self.deferred.append((repository.name, phase, target, predicted))
+            return False
+        return True
@@ -0,0 +1,89 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from grenier.engine import engine
+from grenier.helpers import free_space, log_cmd
+
+PROBE_TIMEOUT = 30
+PROBE_TTL = 300
+PROBE_WORKERS = 8
+
+
+def probe_key(remote, rclone_config_file):
+    if remote.is_cloud:
+        return "%s:%s" % (rclone_config_file, remote.name)
+    return str(remote.full_path)
+
+
+def probe_local(path):
+    # nearest existing directory must be writable, with some free space
+    existing = path
+    while not existing.exists() and existing != existing.parent:
+        existing = existing.parent
+    if not os.access(str(existing), os.W_OK):
+        return False, "%s is not writable." % existing
+    if free_space(existing) == 0:
+        return False, "%s is full." % existing
+    return True, "OK"
+
+
+def probe_cloud(name, rclone_config_file, timeout=PROBE_TIMEOUT, resources=None):
+    # "about" is cheap, but not supported everywhere: fall back to listing the root
+    for operation in [["about"], ["lsd", "--max-depth=1"]]:
+        cmd = ["rclone", "--config=%s" % str(rclone_config_file)] + operation + ["%s:" % name]
+        if resources:
+            cmd = resources.wrap(cmd)
+        log_cmd(cmd)
+        errors = []
+        returncode = engine.run_command(cmd, timeout=timeout,
+                                        on_line=lambda line, stream: stream == "stderr" and errors.append(line))
+        if returncode == 0:
+            return True, "OK"
+        error = "\n".join(errors).strip()
+        if "doesn't support about" not in error and "not supported" not in error:
+            return False, error
+    return False, error
+
+
+def probe_remote(remote, rclone_config_file, timeout=PROBE_TIMEOUT, resources=None):
+    if remote.is_disk:
+        if not remote.full_path.exists():
+            return False, "%s is not mounted." % remote.full_path
+        return probe_local(remote.full_path)
+    elif remote.is_directory:
+        return probe_local(remote.full_path)
+    elif remote.is_cloud:
+        return probe_cloud(remote.name, rclone_config_file, timeout, resources)
+    return False, "Unknown remote."
+
+
+def probe_remotes(remotes, history=None, timeout=PROBE_TIMEOUT, ttl=PROBE_TTL):
+    # remotes: list of (GrenierRemote, rclone_config_file, ResourcePolicy). Sets remote.reachable.
+    # only successful probes are cached: a remote which is back is not skipped.
+    results = {}
+    to_probe = {}
+    for remote, rclone_config_file, resources in remotes:
+        key = probe_key(remote, rclone_config_file)
+        cached = None
+        if history is not None:
+            cached = history.cached_probe(key, ttl)
+        if cached is not None and cached[0]:
+            results[key] = cached
+        else:
+            to_probe[key] = (remote, rclone_config_file, resources)
+
+    if to_probe:
+        with ThreadPoolExecutor(max_workers=min(PROBE_WORKERS, len(to_probe))) as executor:
+            futures = {key: executor.submit(probe_remote, remote, rclone_config_file, timeout, resources)
+                       for key, (remote, rclone_config_file, resources) in to_probe.items()}
+            for key, future in futures.items():
+                try:
+                    results[key] = future.result()
+                except Exception as err:
+                    results[key] = (False, str(err))
+                if history is not None and results[key][0]:
+                    history.cache_probe(key, results[key][0], results[key][1])
+
+    for remote, rclone_config_file, resources in remotes:
+        remote.reachable, remote.probe_message = results[probe_key(remote, rclone_config_file)]
+    return results
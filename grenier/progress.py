@@ -0,0 +1,154 @@
+import re
+
+import math
+
+from progressbar import Bar, FileTransferSpeed, Percentage, ProgressBar, Timer, UnknownLength, Widget
+
+# weight of the observed rate vs the historical one, over the first seconds
+RATE_WARMUP = 30.0
+SIZE_MULTIPLIERS = {"": 1, "b": 1, "k": 1024, "m": 1024 ** 2, "g": 1024 ** 3, "t": 1024 ** 4}
+
+
+def parse_human_size(text):
+    # "1.23M", "1,234,567", "10.5 MiB" -> bytes
+    match = re.match(r"^([\d.,]+)\s*([kmgt]?)(i?b|bytes)?$", text.strip().lower())
+    if not match:
+        return None
+    number = match.group(1)
+    if match.group(2) or match.group(3):
+        number = number.replace(",", ".")
+        try:
+            value = float(number)
+        except ValueError:
+            return None
+    else:
+        value = float(number.replace(",", "").replace(".", ""))
+    return int(value * SIZE_MULTIPLIERS[match.group(2)])
+
+
+class HistoricalETA(Timer):
+    # ETA from the observed rate, seeded with the rate of previous runs
+    TIME_SENSITIVE = True
+
+    def __init__(self, historical_rate=None):
+        self.historical_rate = historical_rate
+
+    def update(self, pbar):
+        if pbar.finished:
+            return 'Time: %s' % self.format_time(pbar.seconds_elapsed)
+        elapsed = pbar.seconds_elapsed
+        rate = None
+        if elapsed > 0 and pbar.currval > 0:
+            rate = pbar.currval / elapsed
+        if self.historical_rate:
+            if rate is None:
+                rate = self.historical_rate
+            else:
+                weight = min(1.0, elapsed / RATE_WARMUP)
+                rate = weight * rate + (1 - weight) * self.historical_rate
+        if not rate:
+            return 'ETA:  --:--:--'
+        return 'ETA:  %s' % self.format_time(max(0, pbar.maxval - pbar.currval) / rate)
+
+
+class BytesWidget(Widget):
+    # bytes done, when the total is not known
+    PREFIXES = " kMGTPEZY"
+
+    def update(self, pbar):
+        if pbar.currval < 1:
+            return "     0 B"
+        power = min(len(self.PREFIXES) - 1, int(math.log(pbar.currval, 1000)))
+        return "%6.2f %sB" % (pbar.currval / 1000. ** power, self.PREFIXES[power])
+
+
+class RunWidget(Widget):
+    def __init__(self, run):
+        self.run = run
+
+    def update(self, pbar):
+        return self.run.summary()
+
+
+class RunProgress(object):
+    # progress across all repositories of a run
+    def __init__(self):
+        self.expected = 0
+        self.done = 0
+
+    def expect(self, bytes_count):
+        if bytes_count:
+            self.expected += bytes_count
+
+    def advance(self, bytes_count):
+        self.done += bytes_count
+
+    def summary(self):
+        if not self.expected:
+            return ""
+        return " [run: %d%%]" % min(100, 100 * self.done / self.expected)
+
+
+class ByteProgress(object):
+    def __init__(self, title, total=None, rate=None, run=None, display=True):
+        self.title = title
+        self.display = display
+        self.rate = rate
+        self.run = run
+        # without a total, only bytes and rate are shown
+        self.total = int(total) if total else None
+        self.done = 0
+        self.pbar = None
+
+    def _widgets(self):
+        if self.total is None:
+            widgets = [self.title, BytesWidget(), ' ', FileTransferSpeed(), ' ', Timer()]
+        else:
+            widgets = [self.title,
+                       Percentage(),
+                       ' ',
+                       Bar(left='[', right=']', fill='-'),
+                       ' ',
+                       FileTransferSpeed(),
+                       ' ',
+                       HistoricalETA(self.rate)]
+        if self.run is not None:
+            widgets.append(RunWidget(self.run))
+        return widgets
+
+    def start(self):
+        if not self.display:
+            return self
+        self.pbar = ProgressBar(widgets=self._widgets(), maxval=self.total or UnknownLength).start()
+        return self
+
+    def update(self, done):
+        if done is None or done < self.done:
+            return
+        if self.run is not None:
+            self.run.advance(done - self.done)
+        self.done = done
+        if self.total is not None and self.done > self.total:
+            self.set_total(self.done)
+        if self.pbar is not None:
+            self.pbar.update(self.done)
+
+    def add(self, bytes_count):
+        self.update(self.done + bytes_count)
+
+    def set_total(self, total):
+        if total and total >= self.done:
+            known = self.total is not None
+            self.total = total
+            if self.pbar is not None:
+                self.pbar.maxval = total
+                self.pbar.update_interval = total / self.pbar.num_intervals
+                if not known:
+                    # percentage and ETA from now on
+                    self.pbar.widgets = self._widgets()
+                    self.pbar._update_widgets()
+
+    def finish(self):
+        if self.pbar is not None:
+            self.pbar.finish()
+        return self.done
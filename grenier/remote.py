@@ -10,6 +10,9 @@ class GrenierRemote(object):
         self.is_disk = False
         self.is_cloud = False
         self.full_path = None
+        # set by probing, None if not probed
+        self.reachable = None
+        self.probe_message = ""
 
         if Path(name).is_absolute():
             self.full_path = Path(name)
@@ -1,4 +1,6 @@
 import sys
+import math
+import random
 from grenier.logger import logger
 from grenier.checks import external_binaries_available
 from grenier.helpers import *
@@ -6,11 +8,32 @@ from grenier.remote import GrenierRemote
 from grenier.source import GrenierSource
 from grenier.backend_bup import BupBackend
 from grenier.backend_restic import ResticBackend
+from grenier.locks import LockError
+from grenier.retention import describe
+from grenier.manifest import update_manifest, verify_copy
+from grenier.encryption import native_encryption_available
+from grenier.planner import PREFLIGHT_MARGIN
+from grenier.compression import compression_level
+
+# cached source sizes older than this are measured again
+SOURCE_SIZE_MAX_AGE = 7 * 24 * 3600
+# auto compression levels are sampled again after this long
+COMPRESSION_MAX_AGE = 30 * 24 * 3600
+# files listed by remote verification, for each problem
+REPORTED_FILES = 20
 
 
 class GrenierRepository(object):
-    def __init__(self, name, backend, repository_path, temp_dir, rclone_config_file, passphrase=None):
+    def __init__(self, name, backend, repository_path, temp_dir, rclone_config_file, passphrase=None,
+                 history=None, verify_period=30, resources=None, batch_save=False,
+                 midx_threshold=100, priority=0, locks=None, retention=None,
+                 cloud_encryption="encfs", cloud_staging=False):
         self.name = name
+        self.locks = locks
+        self.retention = retention or {}
+        self.verify_period = verify_period
+        self.priority = priority
+        self.history = history
         self.rclone_config_file = rclone_config_file
         self.temp_dir = temp_dir
         if not self.temp_dir.exists():
@@ -24,18 +47,24 @@ class GrenierRepository(object):
         self.sources = []
         self.remotes = []
         self.passphrase = passphrase
-        self.just_synced = []
+        self.run_progress = None
 
         # check that the backend is available...
-        if backend == "bup" and external_binaries_available("bup") and external_binaries_available("encfs"):
-            self.backend = BupBackend(self.repository_path)
+        if backend == "bup" and cloud_encryption == "native" and not native_encryption_available():
+            raise Exception("cloud_encryption: native requires the cryptography module.")
+        if backend == "bup" and external_binaries_available("bup") and \
+                (cloud_encryption == "native" or external_binaries_available("encfs")):
+            self.backend = BupBackend(self.repository_path, resources=resources, batch_save=batch_save,
+                                      midx_threshold=midx_threshold, cloud_encryption=cloud_encryption,
+                                      cloud_staging=cloud_staging)
         elif backend == "restic" and external_binaries_available("restic"):
-            self.backend = ResticBackend(self.repository_path, self.passphrase)
+            self.backend = ResticBackend(self.repository_path, self.passphrase, resources=resources,
+                                         mount_state=Path("%s.mount.json" % absolute_path(self.temp_dir)))
         else:
             raise Exception("Unknown backend %s, or missing dependancies." % backend)
 
-    def add_source(self, name, target_dir, excluded=None):
-        self.sources.append(GrenierSource(name, target_dir, excluded))
+    def add_source(self, name, target_dir, excluded=None, exclusions=None, compression=None):
+        self.sources.append(GrenierSource(name, target_dir, excluded, exclusions, compression))
 
     def add_remotes(self, remote_list):
         for remote in remote_list:
@@ -49,11 +78,133 @@ class GrenierRepository(object):
             return True, "Repository already exists."
 
     def check_and_repair(self, display=True):
+        return self._locked([self._repository_lock(shared=True)],
+                            lambda: self._check_and_repair(display),
+                            display)
+
+    def _check_and_repair(self, display=True):
         yellow("+ Checking and repairing repository.", display)
-        return self.backend.check(display=display)
+        start = time.time()
+        success, output = self.backend.check(display=display)
+        self._record("check", "repository", start, success, output)
+        return success, output
+
+    def sample_check(self, display=True):
+        return self._locked([self._repository_lock(shared=True)],
+                            lambda: self._sample_check(display),
+                            display)
+
+    def _sample_check(self, display=True):
+        # verify a part of the repository, so that it is fully covered every verify_period runs
+        start = time.time()
+        all_items = self.backend.verification_items(self.verify_period)
+        if not all_items:
+            return self.check_and_repair(display)
+        covered = set()
+        if self.history is not None:
+            covered = self.history.verified_items(self.name)
+        remaining = [el for el in all_items if el not in covered]
+        if not remaining:
+            yellow("+ Repository fully verified, starting a new cycle.", display)
+            if self.history is not None:
+                self.history.reset_verification(self.name)
+            remaining = all_items
+        sample_size = int(math.ceil(len(all_items) / float(self.verify_period)))
+        sample = sorted(random.sample(remaining, min(sample_size, len(remaining))))
+
+        yellow("+ Checking %s/%s parts of the repository (%s not verified in this cycle)." % (len(sample),
+                                                                                            len(all_items),
+                                                                                            len(remaining)),
+               display)
+        success, output = self.backend.verify_items(sample, display=display)
+        self._record("sample_check", "repository", start, success, output,
+                     details={"verified": len(sample), "remaining": len(remaining) - len(sample),
+                              "total": len(all_items)})
+        if success:
+            if self.history is not None:
+                self.history.mark_verified(self.name, sample)
+            green("+ Sample checked in %.2fs." % (time.time() - start), display)
+        else:
+            red("!!! Error checking repository: %s" % output, display)
+        return success, output
+
+    def estimate_save_bytes(self):
+        # bytes the next save should add, from recent growth or cached source sizes
+        if self.history is None:
+            return None
+        growth = [e["bytes"] for e in self.history.events(self.name, "save", "repository", limit=5)
+                  if e["bytes"] is not None]
+        if growth:
+            return max(growth)
+        total = 0
+        for source in self.sources:
+            size = self.history.cached_size(self.name, source.name, max_age=SOURCE_SIZE_MAX_AGE)
+            if size is None:
+                size = get_folder_size(source.target_dir, source.excluded_extensions)
+                self.history.cache_size(self.name, source.name, size)
+            total += size
+        return total
+
+    def estimate_sync_bytes(self, remote):
+        # bytes to copy to a remote: everything saved since the last sync there
+        stored = self.backend.stored_bytes()
+        if stored is None:
+            stored = get_folder_size(self.repository_path)
+        if self.history is None:
+            return stored
+        last_synced = self.history.last_synced().get(self.name, {}).get(remote.name)
+        if last_synced is None:
+            return stored
+        saved = [e["bytes"] for e in self.history.events_since(self.name, "save", last_synced, "repository")]
+        if None in saved:
+            return stored
+        return min(sum(saved), stored)
+
+    def space_needed(self, phase, target):
+        # [(path, bytes)]: what a save or a sync would write, and where
+        if phase == "save":
+            needed = self.estimate_save_bytes()
+            if needed is None:
+                return []
+            return [(self.repository_path, needed)]
+        remote = self._find_remote_by_name(target)
+        if phase != "sync" or remote is None:
+            return []
+        if remote.is_disk or remote.is_directory:
+            return [(remote.full_path, self.estimate_sync_bytes(remote))]
+        if remote.is_cloud:
+            # encfs mounts in reverse mode do not use local space, staged exports do
+            staged = self.backend.staged_bytes(self.name, remote)
+            if staged:
+                return [(self.temp_dir, staged)]
+        return []
+
+    def _preflight(self, phase, target, display=True):
+        for path, needed in self.space_needed(phase, target):
+            available = free_space(path)
+            if available < needed * PREFLIGHT_MARGIN:
+                red("!!! Not enough space on %s: %s needed, %s available." % (path,
+                                                                             readable_size(needed),
+                                                                             readable_size(available)),
+                    display)
+                return False
+        return True
+
+    def preflight_save(self, display=True):
+        return self._preflight("save", "repository", display)
+
+    def preflight_sync(self, remote, display=True):
+        return self._preflight("sync", remote.name, display)
 
     def save(self, check_before=False, display=True):
+        return self._locked([self._repository_lock()],
+                            lambda: self._save(check_before, display),
+                            display)
+
+    def _save(self, check_before=False, display=True):
         starting_time = time.time()
+        if not self.preflight_save(display):
+            return False, "Not enough space to save %s." % self.name
         init_success, errlog = self.init(display)
         if not init_success:
             red("!!! %s " % errlog, display)
@@ -61,28 +212,148 @@ class GrenierRepository(object):
         else:
             if check_before:
                 self.check_and_repair(display)
-            # original_size = get_folder_size(self.repository_path)
+            original_size = self.backend.stored_bytes()
+            self._prepare_progress("save", "repository")
+            self.backend.compression_levels = self._compression_levels()
             success, errlog = self.backend.save(self.sources, display)
+            duration = time.time() - starting_time
+            added = None
+            details = {"processed_bytes": self.backend.processed_bytes}
+            if self.backend.source_stats:
+                details["sources"] = self.backend.source_stats
+            if original_size is not None:
+                new_size = self.backend.stored_bytes()
+                added = new_size - original_size
+                details.update({"stored_bytes": new_size, "throughput": added / max(duration, 0.001)})
             if success:
-                self.just_synced.append({"repository": time.strftime("%Y-%m-%d_%Hh%M")})
-                # new_size = get_folder_size(self.repository_path)
-                # delta = new_size - original_size
-                # green("+ Final repository size: %s (+%s)." % (readable_size(new_size),
-                #                                               readable_size(delta)), display)
-                green("+ Backup done in %.2fs." % (time.time() - starting_time), display)
-
+                repository_stats = self.backend.repository_stats()
+                if repository_stats is not None:
+                    details["repository"] = repository_stats
+            self._record("save", "repository", starting_time, success, errlog,
+                         bytes_count=added, details=details)
+            if success:
+                self._measure_maintenance(details.get("throughput"))
+                self._cache_source_sizes()
+                if added is not None:
+                    green("+ Final repository size: %s (+%s)." % (readable_size(new_size),
+                                                                  readable_size(added)), display)
+                green("+ Backup done in %.2fs." % duration, display)
+                self.maintain(display)
             else:
                 red("!!! Error saving repository, stopping.", display)
             return success, errlog
 
+    def maintain(self, display=True):
+        start = time.time()
+        success, output, details = self.backend.maintain(display)
+        if details is not None:
+            if self.history is not None:
+                last_saves = self.history.events(self.name, "save", "repository", limit=1)
+                if last_saves:
+                    details["save_throughput_before"] = last_saves[0]["details"].get("throughput")
+            self._record("maintenance", "repository", start, success, output, details=details)
+            if success:
+                green("+ Maintenance done in %.2fs." % (time.time() - start), display)
+            else:
+                red("!!! Error during maintenance: %s" % output, display)
+        return success, output
+
+    def _compression_levels(self):
+        # sampling walks the whole source, the level is kept for a while
+        levels = {}
+        for source in self.sources:
+            if source.compression != "auto":
+                continue
+            level = None
+            if self.history is not None:
+                level = self.history.cached_compression(self.name, source.name, max_age=COMPRESSION_MAX_AGE)
+            if level is None:
+                level = compression_level(source.compression, source.exclusions)
+                if self.history is not None:
+                    self.history.cache_compression(self.name, source.name, level)
+            levels[source.name] = level
+        return levels
+
+    def _cache_source_sizes(self):
+        # sizes seen by the save, for the next free space estimates
+        if self.history is None:
+            return
+        for name, stats in self.backend.source_stats.items():
+            if stats.get("scanned_bytes") is not None:
+                self.history.cache_size(self.name, name, stats["scanned_bytes"])
+
+    def _measure_maintenance(self, throughput):
+        # the first save after a midx/bloom rebuild, compared to the save before it
+        if self.history is None or throughput is None:
+            return
+        last_maintenance = self.history.events(self.name, "maintenance", "repository", limit=1)
+        if last_maintenance:
+            details = last_maintenance[0]["details"]
+            if "save_throughput_before" in details and "save_throughput_after" not in details:
+                details["save_throughput_after"] = throughput
+                self.history.update_details(last_maintenance[0]["id"], details)
+
+    def apply_retention(self, dry_run=False, display=True):
+        if not self.retention:
+            yellow("+ No retention policy defined.", display)
+            return True, ""
+        return self._locked([self._repository_lock()],
+                            lambda: self._apply_retention(dry_run, display),
+                            display)
+
+    def _apply_retention(self, dry_run=False, display=True):
+        if dry_run:
+            yellow("+ Snapshots removed by the retention policy (%s):" % describe(self.retention), display)
+        else:
+            yellow("+ Applying retention policy (%s)." % describe(self.retention), display)
+        start = time.time()
+        original_size = self.backend.stored_bytes()
+        if original_size is None:
+            original_size = get_folder_size(self.repository_path)
+        success, output, removed = self.backend.apply_retention(self.sources, self.retention,
+                                                                dry_run=dry_run, display=display)
+        if dry_run:
+            return success, output
+        new_size = self.backend.stored_bytes()
+        if new_size is None:
+            new_size = get_folder_size(self.repository_path)
+        reclaimed = original_size - new_size
+        self._record("retention", "repository", start, success, output, bytes_count=reclaimed,
+                     details={"removed": len(removed), "stored_bytes": new_size})
+        if success:
+            green("+ Removed %s snapshots, reclaimed %s in %.2fs." % (len(removed),
+                                                                    readable_size(reclaimed),
+                                                                    time.time() - start), display)
+        else:
+            red("!!! Error applying retention policy: %s" % output, display)
+        return success, output
+
     def sync_remote(self, remote_name, display=True):
+        remote = self._find_remote_by_name(remote_name)
+        if remote is None or not remote.is_known:
+            return self._sync_remote(remote_name, display)
+        # the repository is only read, the remote and the encfs mount point are not shared
+        locks = [self._repository_lock(shared=True), self._remote_lock(remote)]
+        if remote.is_cloud:
+            locks.append(("temp_dir", absolute_path(self.temp_dir), False))
+        success, output = self._locked(locks, lambda: (self._sync_remote(remote_name, display), ""),
+                                       display)
+        return success
+
+    def _sync_remote(self, remote_name, display=True):
         remote = self._find_remote_by_name(remote_name)
         save_success = False
         err_log = ""
         if remote and remote.is_known:
+            if remote.reachable is False:
+                red("Remote %s unreachable, skipping: %s" % (remote.name, remote.probe_message), display)
+                return False
+            if not self.preflight_sync(remote, display):
+                return False
             yellow("+ Syncing with %s." % remote.name, display)
             start = time.time()
 
+            self._prepare_progress("sync", remote.name)
             if remote.is_cloud:
                 save_success, err_log = self.backend.sync_to_cloud(self.name, remote,
                                                                    self.rclone_config_file,
@@ -96,8 +367,12 @@ class GrenierRepository(object):
                 red("Unknown remote %s, maybe unmounted disk. Not doing anything." % remote.name,
                     display)
 
+            self._record("sync", remote.name, start, save_success, err_log,
+                         details={"processed_bytes": self.backend.processed_bytes})
             if save_success:
-                self.just_synced.append({remote.name: time.strftime("%Y-%m-%d_%Hh%M")})
+                if (remote.is_disk or remote.is_directory) and self.history is not None:
+                    # what the copy should contain, for --verify-remote
+                    self.history.save_manifest(self.name, self.update_manifest(display), remote=remote.name)
                 green("+ Synced in %.2fs." % (time.time() - start), display)
             else:
                 red("!! Error! %s" % err_log, display)
@@ -109,7 +384,132 @@ class GrenierRepository(object):
 
         return remote and remote.is_known and save_success
 
+    def plan(self, phase, target):
+        # files and bytes a save or sync would transfer, None if unknown
+        if phase == "save":
+            # bup plans on a copy of its index, a save must not change it meanwhile
+            success, plan = self._locked([self._repository_lock(shared=True)],
+                                         lambda: (True, self.backend.plan_save(self.sources)))
+            if not success:
+                # locked by another grenier process
+                return None
+            return plan
+        remote = self._find_remote_by_name(target)
+        if remote is None or not remote.is_known or remote.reachable is False:
+            return None
+        if remote.is_cloud:
+            locks = [self._repository_lock(shared=True),
+                     ("temp_dir", absolute_path(self.temp_dir), False)]
+            success, plan = self._locked(locks, lambda: (True, self._plan_sync(remote)))
+            if not success:
+                return None
+            return plan
+        return self._plan_sync(remote)
+
+    def _plan_sync(self, remote):
+        if remote.is_cloud:
+            return self.backend.plan_sync_to_cloud(self.name, remote, self.rclone_config_file,
+                                                   encfs_mount=self.temp_dir,
+                                                   password=self.passphrase)
+        if not remote.full_path.exists():
+            return {"files": None, "bytes": self.estimate_sync_bytes(remote)}
+        return self.backend.plan_sync_to_folder(remote)
+
+    def update_manifest(self, display=True):
+        previous = {}
+        if self.history is not None:
+            previous = self.history.manifest(self.name)
+        manifest, hashed = update_manifest(self.repository_path, previous, self.backend.resources.jobs)
+        if self.history is not None:
+            self.history.save_manifest(self.name, manifest)
+        yellow("+ Repository manifest: %s files, %s hashed again." % (len(manifest), hashed), display)
+        return manifest
+
+    def update_catalog(self, catalog, display=True):
+        return self._locked([self._repository_lock(shared=True)],
+                            lambda: self._update_catalog(catalog, display),
+                            display)
+
+    def _update_catalog(self, catalog, display=True):
+        # only the snapshots saved since the last update are listed
+        start = time.time()
+        success, output, snapshots = self.backend.catalog_snapshots(self.sources)
+        if not success:
+            red("!!! Could not list snapshots: %s" % output, display)
+            self._record("catalog", "repository", start, False, output)
+            return False, output
+        removed = catalog.remove_missing(self.name, [el[0] for el in snapshots])
+        indexed = catalog.indexed_snapshots(self.name)
+        new = [el for el in snapshots if el[0] not in indexed]
+        yellow("+ Catalog: %s new snapshots, %s removed." % (len(new), len(removed)), display)
+        roots = {el.name: absolute_path(el.target_dir) for el in self.sources}
+        overall_success = True
+        overall_output = ""
+        files = 0
+        for snapshot, source_name, timestamp in new:
+            success, output, snapshot_files = self.backend.catalog_files(snapshot, roots.get(source_name, "/"))
+            if not success:
+                red("!!! Could not list snapshot %s: %s" % (snapshot, output), display)
+                overall_success = False
+                overall_output += output
+                continue
+            catalog.add_snapshot(self.name, snapshot, source_name, timestamp, snapshot_files)
+            files += len(snapshot_files)
+        self._record("catalog", "repository", start, overall_success, overall_output,
+                     details={"snapshots": len(new), "removed": len(removed), "files": files})
+        if overall_success:
+            green("+ %s files indexed in %.2fs." % (files, time.time() - start), display)
+        return overall_success, overall_output
+
+    def verify_remote(self, remote_name, display=True):
+        remote = self._find_remote_by_name(remote_name)
+        if remote is None or not (remote.is_disk or remote.is_directory):
+            red("Remote %s is not a disk or directory, cannot verify it." % remote_name, display)
+            return False, "Unsupported remote."
+        return self._locked([self._repository_lock(shared=True), self._remote_lock(remote, shared=True)],
+                            lambda: self._verify_remote(remote, display),
+                            display)
+
+    def _verify_remote(self, remote, display=True):
+        # the copy is where rsync puts it, compared with the repository as it was synced: saves
+        # since then are not missing files
+        copy_path = Path(remote.full_path, self.repository_path.name)
+        if not copy_path.exists():
+            red("No copy of %s on %s." % (self.name, remote.name), display)
+            return False, "No copy found."
+        manifest = {}
+        if self.history is not None:
+            manifest = self.history.manifest(self.name, remote=remote.name)
+        if not manifest:
+            red("No manifest of %s recorded when syncing to %s, sync it first." % (self.name, remote.name),
+                display)
+            return False, "No manifest recorded."
+        yellow("+ Verifying %s on %s." % (self.name, remote.name), display)
+        start = time.time()
+        missing, extra, corrupt = verify_copy(manifest, copy_path, self.backend.resources.jobs)
+        success = not (missing or extra or corrupt)
+        output = ""
+        for title, paths in [("Missing", missing), ("Extra", extra), ("Corrupt", corrupt)]:
+            if paths:
+                output += "%s files on %s (%s):\n" % (title, remote.name, len(paths))
+                output += "".join(["\t%s\n" % el for el in paths[:REPORTED_FILES]])
+                if len(paths) > REPORTED_FILES:
+                    output += "\t...\n"
+        self._record("verify_remote", remote.name, start, success, output,
+                     details={"files": len(manifest), "missing": len(missing), "extra": len(extra),
+                              "corrupt": len(corrupt)})
+        if success:
+            green("+ %s files verified in %.2fs." % (len(manifest), time.time() - start), display)
+        else:
+            red("!!! %s" % output.rstrip(), display)
+        return success, output
+
     def restore(self, target, display=True):
+        return self._locked([self._repository_lock(shared=True)],
+                            lambda: self._restore(target, display),
+                            display)
+
+    def _restore(self, target, display=True):
         if not create_or_check_if_empty(target):
             red("Directory %s is not empty, not doing anything." % target, display)
             return False, "Could not restore!"
@@ -128,6 +528,17 @@ class GrenierRepository(object):
         self.backend.unfuse(mount_path)
 
     def recover(self, remote_info, target, display=True):
+        remote = self._find_remote_by_name(remote_info)
+        if remote is None:
+            remote = self._find_remote_by_path(remote_info)
+        if remote is None:
+            return self._recover(remote_info, target, display)
+        locks = [self._remote_lock(remote, shared=True)]
+        if remote.is_cloud:
+            locks.append(("temp_dir", absolute_path(self.temp_dir), False))
+        return self._locked(locks, lambda: self._recover(remote_info, target, display), display)
+
+    def _recover(self, remote_info, target, display=True):
         start = time.time()
         remote = self._find_remote_by_name(remote_info)
         if remote:
@@ -159,6 +570,63 @@ class GrenierRepository(object):
             red("!! Error! %s" % err_log, display)
         return success, err_log
 
+    def historical_rate(self, phase, target):
+        # processed bytes per second in recent runs
+        if self.history is None:
+            return None
+        events = [e for e in self.history.events(self.name, phase, target, limit=5)
+                  if e["details"].get("processed_bytes")]
+        duration = sum([e["duration"] for e in events])
+        if not events or duration <= 0:
+            return None
+        return sum([e["details"]["processed_bytes"] for e in events]) / duration
+
+    def expected_bytes(self, phase, target):
+        # processed bytes in the last run
+        if self.history is None:
+            return None
+        events = [e for e in self.history.events(self.name, phase, target, limit=5)
+                  if e["details"].get("processed_bytes")]
+        if not events:
+            return None
+        return events[0]["details"]["processed_bytes"]
+
+    def _prepare_progress(self, phase, target):
+        self.backend.run_progress = self.run_progress
+        self.backend.progress_rate = self.historical_rate(phase, target)
+        self.backend.progress_total = self.expected_bytes(phase, target)
+        self.backend.last_success = None
+        if self.history is not None:
+            last = self.history.events(self.name, phase, target, limit=1)
+            if last:
+                self.backend.last_success = last[0]["start"]
+        self.backend.processed_bytes = 0
+        self.backend.source_stats = {}
+
+    def _repository_lock(self, shared=False):
+        return "repository", absolute_path(self.repository_path), shared
+
+    def _remote_lock(self, remote, shared=False):
+        if remote.is_cloud:
+            return "remote", "%s:%s" % (self.rclone_config_file, remote.name), shared
+        return "remote", absolute_path(remote.full_path), shared
+
+    def _locked(self, locks, action, display=True):
+        # runs action with the locks held, fails if another grenier process has them
+        if self.locks is None:
+            return action()
+        try:
+            with self.locks.lock_all(locks):
+                return action()
+        except LockError as err:
+            red("!!! %s" % err, display)
+            return False, str(err)
+
+    def _record(self, phase, target, start, success, output="", bytes_count=None, details=None):
+        if self.history is not None:
+            self.history.record(self.name, phase, target, start, success=success,
+                                bytes_count=bytes_count, output=output, details=details)
+
     def _find_remote_by_name(self, remote_name):
         for remote in self.remotes:
             if remote.name == remote_name:
@@ -174,12 +642,15 @@ class GrenierRepository(object):
     def __str__(self):
         txt = "++ Repository %s\n" % self.name
         txt += "\tRepository path: %s\n" % self.repository_path
+        txt += "\tResources: %s\n" % self.backend.resources
+        if self.retention:
+            txt += "\tRetention: %s\n" % describe(self.retention)
         txt += "\tSources:\n"
         for source in self.sources:
-            if source.excluded_extensions:
-                txt += "\t\t%s (%s) [exluded: %s]\n" % (source.name,
-                                                        source.target_dir,
-                                                        source.excluded_extensions)
+            if source.exclusions.patterns or source.exclusions.needs_scan:
+                txt += "\t\t%s (%s) [excluded: %s]\n" % (source.name,
+                                                         source.target_dir,
+                                                         source.exclusions)
             else:
                 txt += "\t\t%s (%s)\n" % (source.name,
                                           source.target_dir)
@@ -0,0 +1,100 @@
+import os
+import shutil
+from pathlib import Path
+
+from grenier.logger import logger
+
+IONICE_CLASSES = {"realtime": "1", "best-effort": "2", "idle": "3"}
+# needed by nice/ionice/systemd-run when the child environment is restricted
+WRAPPER_ENVIRONMENT = ["PATH", "HOME", "XDG_RUNTIME_DIR", "DBUS_SESSION_BUS_ADDRESS"]
+CGROUP2_CONTROLLERS = Path("/sys/fs/cgroup/cgroup.controllers")
+RETRIES = 3
+
+
+def cgroup2_available():
+    return CGROUP2_CONTROLLERS.exists() and shutil.which("systemd-run") is not None
+
+
+class ResourcePolicy(object):
+    def __init__(self, nice=None, ionice=None, ionice_level=None, jobs=None,
+                 cpu_quota=None, memory_max=None, timeout=None, retries=None):
+        self.nice = nice
+        if ionice is not None and ionice not in IONICE_CLASSES:
+            raise Exception("Unknown ionice class %s, expected one of: %s." % (ionice,
+                                                                               ", ".join(IONICE_CLASSES)))
+        self.ionice = ionice
+        self.ionice_level = ionice_level
+        self.max_jobs = jobs
+        self.cpu_quota = cpu_quota
+        self.memory_max = memory_max
+        # seconds, for each external command
+        self.timeout = timeout
+        # of cloud transfers failing with transient errors
+        self.retries = RETRIES if retries is None else retries
+
+    @classmethod
+    def from_config(cls, config):
+        if not config:
+            return cls()
+        return cls(nice=config.get("nice"),
+                   ionice=config.get("ionice"),
+                   ionice_level=config.get("ionice_level"),
+                   jobs=config.get("jobs"),
+                   cpu_quota=config.get("cpu_quota"),
+                   memory_max=config.get("memory_max"),
+                   timeout=config.get("timeout"),
+                   retries=config.get("retries"))
+
+    @property
+    def jobs(self):
+        # parallelism for fsck/restic: number of cpus, capped by configuration
+        cpus = os.cpu_count() or 1
+        if self.max_jobs:
+            return max(1, min(cpus, int(self.max_jobs)))
+        return cpus
+
+    def wrap(self, cmd):
+        # prefix a command so that it runs with this policy
+        prefix = []
+        if self.cpu_quota or self.memory_max:
+            if cgroup2_available():
+                prefix.extend(["systemd-run", "--user", "--scope", "--quiet", "--collect"])
+                if self.cpu_quota:
+                    prefix.extend(["-p", "CPUQuota=%s" % self.cpu_quota])
+                if self.memory_max:
+                    prefix.extend(["-p", "MemoryMax=%s" % self.memory_max])
+            else:
+                logger.debug("cgroup v2 not available, ignoring cpu_quota and memory_max.")
+        if self.nice is not None:
+            prefix.extend(["nice", "-n", str(self.nice)])
+        if self.ionice is not None:
+            if shutil.which("ionice"):
+                prefix.extend(["ionice", "-c", IONICE_CLASSES[self.ionice]])
+                if self.ionice_level is not None and self.ionice != "idle":
+                    prefix.extend(["-n", str(self.ionice_level)])
+            else:
+                logger.debug("ionice not available, ignoring ionice class.")
+        return prefix + list(cmd)
+
+    def environment(self, env):
+        if env is None or self.wrap([]) == []:
+            return env
+        env = dict(env)
+        for variable in WRAPPER_ENVIRONMENT:
+            if variable not in env and variable in os.environ:
+                env[variable] = os.environ[variable]
+        return env
+
+    def __str__(self):
+        txt = "jobs: %s" % self.jobs
+        if self.nice is not None:
+            txt += ", nice: %s" % self.nice
+        if self.ionice is not None:
+            txt += ", ionice: %s" % self.ionice
+        if self.cpu_quota:
+            txt += ", cpu quota: %s" % self.cpu_quota
+        if self.memory_max:
+            txt += ", memory max: %s" % self.memory_max
+        if self.timeout:
+            txt += ", timeout: %ss" % self.timeout
+        return txt
@@ -0,0 +1,38 @@
+import time
+
+RETENTION_KEYS = ["keep_last", "keep_daily", "keep_weekly", "keep_monthly"]
+# what makes two snapshots fall in the same day/week/month
+PERIODS = {"keep_daily": "%Y-%m-%d",
+           "keep_weekly": "%G-%V",
+           "keep_monthly": "%Y-%m"}
+
+
+def select_snapshots(snapshots, policy):
+    # snapshots: list of (id, timestamp). Returns the ids to keep, and to remove.
+    # keep_daily: N keeps the most recent snapshot of each of the N last days with snapshots, etc.
+    ordered = sorted(snapshots, key=lambda el: el[1], reverse=True)
+    if not any([policy.get(key) for key in RETENTION_KEYS]):
+        # no policy, nothing goes
+        return [el[0] for el in ordered], []
+    keep = set([el[0] for el in ordered[:policy.get("keep_last", 0)]])
+    for key, period_format in PERIODS.items():
+        remaining = policy.get(key, 0)
+        last_period = None
+        for snapshot_id, timestamp in ordered:
+            if remaining <= 0:
+                break
+            period = time.strftime(period_format, time.localtime(timestamp))
+            if period != last_period:
+                keep.add(snapshot_id)
+                last_period = period
+                remaining -= 1
+    return [el[0] for el in ordered if el[0] in keep], [el[0] for el in ordered if el[0] not in keep]
+
+
+def restic_arguments(policy):
+    return ["--%s=%d" % (key.replace("_", "-"), policy[key]) for key in RETENTION_KEYS
+            if policy.get(key)]
+
+
+def describe(policy):
+    return ", ".join(["%s: %s" % (key, policy[key]) for key in RETENTION_KEYS if policy.get(key)])
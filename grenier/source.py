@@ -1,18 +1,31 @@
 from pathlib import Path
 
+from grenier.exclusions import ExclusionSpec
+
 
 class GrenierSource(object):
-    def __init__(self, name, target_dir, format_list=None):
+    def __init__(self, name, target_dir, format_list=None, exclusions=None, compression=None):
         self.name = name
         self.target_dir = Path(target_dir)
         if format_list:
             self.excluded_extensions = format_list
         else:
             self.excluded_extensions = []
+        if not exclusions:
+            exclusions = {}
+        # compiled once, shared by all backends
+        self.exclusions = ExclusionSpec(self.target_dir,
+                                        extensions=self.excluded_extensions,
+                                        patterns=exclusions.get("exclude", []),
+                                        directories=exclusions.get("exclude_dirs", []),
+                                        max_size=exclusions.get("max_size", None),
+                                        exclude_caches=exclusions.get("exclude_caches", False))
+        # zlib level, "auto", or None for the backend default
+        self.compression = compression
 
     def __str__(self):
-        return "Source %s: \n\tPath: %s\n\tExluded extensions: %s" % (self.name,
-                                                                      self.target_dir,
-                                                                      " ".join(self.excluded_extensions))
+        return "Source %s: \n\tPath: %s\n\tExcluded: %s" % (self.name,
+                                                            self.target_dir,
+                                                            self.exclusions)
 
     # TODO : get when last synced, etc
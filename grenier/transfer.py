@@ -0,0 +1,114 @@
+import random
+import re
+import time
+from pathlib import Path
+
+import xdg.BaseDirectory
+
+from grenier.helpers import yellow
+
+# rclone -v, one line per transferred file. Deleted files are not transferred, not checkpointed.
+RCLONE_DONE = re.compile(r"INFO\s*:\s*(.+?): (?:Copied|Moved)")
+RCLONE_FILE_ERROR = re.compile(r"ERROR\s*:\s*(.+?): (.+)$")
+# first match wins: some providers answer 403 when rate limiting
+ERROR_TYPES = [("transient", re.compile(r"rate ?limit|too many requests|\b429\b", re.I)),
+               ("auth", re.compile(r"\b40[13]\b|unauthori[sz]ed|forbidden|invalid_grant|invalid_client|"
+                                   r"token (has )?expired|couldn't fetch token|authenticat|access denied|"
+                                   r"permission denied", re.I)),
+               ("transient", re.compile(r"time(d)? ?out|connection (reset|refused|closed)|broken pipe|"
+                                        r"\bEOF\b|no such host|temporar|try again|\b50[0234]\b|"
+                                        r"network is unreachable|TLS handshake", re.I))]
+# seconds, doubled after each failed attempt
+BACKOFF_BASE = 10
+BACKOFF_MAX = 600
+REPORTED_FILES = 20
+
+
+def classify_error(output):
+    # transient errors are worth retrying, auth and other errors will fail again
+    for kind, regex in ERROR_TYPES:
+        if regex.search(output):
+            return kind
+    return "permanent"
+
+
+def backoff(attempt, base=BACKOFF_BASE, maximum=BACKOFF_MAX):
+    # with jitter, so that remotes failing together do not retry together
+    return min(maximum, base * 2 ** attempt) * random.uniform(0.5, 1)
+
+
+def retry(action, retries, display=True, sleep=time.sleep):
+    # action returns success and output. Returns success, output and the type of the last error.
+    for attempt in range(retries + 1):
+        success, output = action()
+        if success:
+            return True, output, None
+        kind = classify_error(output)
+        if kind != "transient" or attempt == retries:
+            return False, output, kind
+        delay = backoff(attempt)
+        yellow("+ Transient error, retrying in %.0fs (%s/%s)." % (delay, attempt + 1, retries), display)
+        sleep(delay)
+
+
+def file_errors(output):
+    # rclone errors per file, and the other lines
+    errors = {}
+    other = []
+    for line in output.split("\n"):
+        match = RCLONE_FILE_ERROR.search(line)
+        if match and not match.group(1).startswith("Attempt "):
+            errors[match.group(1)] = match.group(2)
+        elif line.strip():
+            other.append(line)
+    return errors, other
+
+
+def error_report(output, kind=None):
+    # one line per failed file, instead of the whole rclone log
+    errors, other = file_errors(output)
+    report = ""
+    if kind is not None:
+        report += "%s error.\n" % kind.capitalize()
+    if errors:
+        report += "%s files failed:\n" % len(errors)
+        report += "".join(["\t%s: %s\n" % (path, errors[path]) for path in sorted(errors)[:REPORTED_FILES]])
+        if len(errors) > REPORTED_FILES:
+            report += "\t...\n"
+    report += "".join(["%s\n" % el for el in other[-REPORTED_FILES:]])
+    return report
+
+
+class Checkpoint(object):
+    # files already transferred by a sync which did not finish, one path per line
+    def __init__(self, repository_name, remote_name):
+        # one directory per repository: names may contain any separator
+        directory = Path(xdg.BaseDirectory.save_data_path("grenier"), "checkpoints", repository_name)
+        if not directory.exists():
+            directory.mkdir(parents=True)
+        self.path = Path(directory, "%s.txt" % remote_name)
+        self.completed = set()
+        if self.path.exists():
+            self.completed = set(self.path.read_text().splitlines())
+        self.file = None
+
+    def add(self, path):
+        if path in self.completed:
+            return
+        if self.file is None:
+            self.file = self.path.open("a")
+        # appended as it goes, to survive an interruption
+        self.file.write(path + "\n")
+        self.file.flush()
+        self.completed.add(path)
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def clear(self):
+        self.close()
+        if self.path.exists():
+            self.path.unlink()
+        self.completed = set()
@@ -1,8 +1,39 @@
 import unittest
+from unittest import mock
 import getpass
+import io
+import json
+import logging
 import shutil
+import sys
+import threading
+import time
 from grenier.helpers import *
 from grenier.grenier import Grenier
+from grenier.history import GrenierHistory
+from grenier.exclusions import ExclusionSpec
+from grenier.locks import LockError, LockManager
+from grenier.compression import byte_entropy, choose_level, is_compressible
+from grenier.retention import select_snapshots
+from grenier.engine import CommandEngine
+from grenier.manifest import list_files, update_manifest, verify_copy
+from grenier.encryption import decrypt_file, decrypt_names, derive_key, encrypt_file, encrypt_names, \
+    native_encryption_available, new_key_parameters, remote_name
+from grenier.catalog import GrenierCatalog
+from grenier.backend_bup import demangle_bup_path, lines_under
+from grenier.backend_restic import ResticBackend
+from grenier.backend_default import RSYNC_PROGRESS, pending_uploads
+from grenier.transfer import RCLONE_DONE, Checkpoint, classify_error, error_report, retry
+from grenier.analytics import save_rows, source_growth
+from grenier.pipeline import StagePipeline
+from grenier.resources import RETRIES, ResourcePolicy
+from grenier.progress import ByteProgress, HistoricalETA, parse_human_size
+from grenier.planner import TimeBudget, order_by_space, order_repositories, transfer_plan
+from grenier.probe import probe_key, probe_remotes
+from grenier.remote import GrenierRemote
+from grenier.logger import RateLimitHandler, compress_old_logs
+from grenier.config import load_config, validate_config
+from dataset import Dataset
 
 
 class TestClass(unittest.TestCase):
@@ -100,6 +131,16 @@ class TestClass(unittest.TestCase):
             self.assertTrue(success)
             # TODO corrupt one file and check again!!
 
+    def test_055_sample_check(self):
+        for r in self.grenier.repositories:
+            print("Sample checking %s" % r.name)
+            r.history.reset_verification(r.name)
+            all_items = r.backend.verification_items(r.verify_period)
+            success, out = r.sample_check(display=False)
+            self.assertTrue(success)
+            self.assertNotEqual(len(r.history.verified_items(r.name)), 0)
+            self.assertTrue(r.history.verified_items(r.name).issubset(set(all_items)))
+
     def test_060_sync_to_folder(self):
         for r in self.grenier.repositories:
             self.assertFalse(r.sync_remote("pof", display=False))
@@ -231,6 +272,583 @@ class TestClass(unittest.TestCase):
         # TODO!
         pass
 
+    def test_140_history(self):
+        history = GrenierHistory(Path("test_files", "history.db"))
+        history.start_run("test")
+        self.assertTrue(history.is_empty())
+        self.assertEqual(history.import_last_synced({"test1": {"repository": "2016-01-01_12h00",
+                                                                "DISK1": "2016-01-02_12h00"}}), 2)
+        history.record("test1", "sync", "DISK1", time.time() - 10, success=True)
+        history.record("test1", "sync", "hubic", time.time() - 10, success=False, output="oops")
+        last_synced = history.last_synced()
+        self.assertEqual(sorted(last_synced["test1"].keys()), ["DISK1", "repository"])
+        self.assertEqual(list(history.not_synced_since(30, {"test1": ["repository", "DISK1", "hubic"]})["test1"].keys()),
+                         ["repository", "hubic"])
+        self.assertEqual(history.events("test1", "sync", "hubic", successful_only=False)[0]["error_tail"], "oops")
+        self.assertEqual(len(history.duration_trend("test1", "sync", "DISK1")), 2)
+        history.end_run()
+        history.close()
+
+        # cleanup
+        for db_file in Path("test_files").glob("history.db*"):
+            db_file.unlink()
+
+    def test_150_exclusions(self):
+        spec = ExclusionSpec(Path("test_files"), extensions=["ignored"], patterns=["folder2/*.txt"],
+                             directories=["backup"], max_size=500)
+        root = Path("test_files").resolve()
+        self.assertTrue(spec.is_excluded(Path(root, "folder1", "test2.ignored")))
+        self.assertFalse(spec.is_excluded(Path(root, "folder1", "test1.txt")))
+        self.assertTrue(spec.is_excluded(Path(root, "folder2", "test3.txt")))
+        self.assertTrue(spec.is_excluded(Path(root, "backup", "grenier_test1"), is_dir=True))
+        self.assertIn(str(Path(root, "secret.kdb")), spec.scan())
+        self.assertIn("*.ignored", spec.restic_patterns)
+
+    def test_160_locks(self):
+        lock_dir = Path("test_files", "locks")
+        # two managers, as two grenier processes
+        first = LockManager(lock_dir)
+        second = LockManager(lock_dir)
+        with first.lock("repository", "test1", shared=True):
+            with second.lock("repository", "test1", shared=True):
+                pass
+        with first.lock("repository", "test1"):
+            # reentrant in the same process
+            with first.lock("repository", "test1", shared=True):
+                pass
+            with self.assertRaises(LockError):
+                with second.lock("repository", "test1", shared=True):
+                    pass
+            with second.lock("repository", "test2"):
+                pass
+        with second.lock("repository", "test1"):
+            pass
+        shutil.rmtree(str(lock_dir))
+
+    def test_170_compression(self):
+        self.assertEqual(byte_entropy(b"aaaa"), 0.0)
+        self.assertEqual(byte_entropy(bytes(range(256))), 8.0)
+        self.assertTrue(is_compressible(str(Path("test_files", "folder1", "test1.txt"))))
+        self.assertFalse(is_compressible("photo.jpg"))
+        self.assertEqual(choose_level(0.05), 0)
+        self.assertEqual(choose_level(0.3), 1)
+        self.assertEqual(choose_level(0.9), 6)
+
+    def test_180_retention(self):
+        # two snapshots a day, from 2016-03-31 back to 2016-02-01
+        last = time.mktime((2016, 3, 31, 12, 0, 0, 0, 0, -1))
+        snapshots = [("%02d_%d" % (i, j), last - i * 24 * 3600 - j * 3600) for i in range(60) for j in range(2)]
+        keep, remove = select_snapshots(snapshots, {"keep_last": 3, "keep_daily": 7, "keep_monthly": 3})
+        self.assertEqual(keep, ["00_0", "00_1", "01_0", "02_0", "03_0", "04_0", "05_0", "06_0", "31_0"])
+        self.assertEqual(len(remove), 111)
+        # without policy, everything is kept
+        self.assertEqual(select_snapshots(snapshots, {})[1], [])
+
+    def test_190_engine(self):
+        engine = CommandEngine(2)
+        lines = []
+        # both streams read at the same time, \r also ends lines
+        returncode = engine.run_command(["sh", "-c", "printf 'a\\rb\\n'; echo error >&2"],
+                                        on_line=lambda line, stream: lines.append((stream, line)))
+        self.assertEqual(returncode, 0)
+        self.assertEqual(sorted(lines), [("stderr", "error"), ("stdout", "a"), ("stdout", "b")])
+        self.assertNotEqual(engine.run_command(["sleep", "10"], timeout=1), 0)
+        start = time.time()
+        self.assertEqual(engine.run_commands([(["sleep", "1"], {}) for i in range(4)]), [0, 0, 0, 0])
+        self.assertGreaterEqual(time.time() - start, 2)
+
+    def test_200_manifest(self):
+        source = Path("test_files", "folder1")
+        copy = Path("test_files", "folder1_copy")
+        shutil.copytree(str(source), str(copy))
+        manifest, hashed = update_manifest(source, {})
+        self.assertEqual(hashed, 2)
+        # unchanged files are not hashed again
+        self.assertEqual(update_manifest(source, manifest), (manifest, 0))
+        self.assertEqual(verify_copy(manifest, copy), ([], [], []))
+        Path(copy, "test1.txt").write_text("corrupted")
+        Path(copy, "test2.ignored").unlink()
+        Path(copy, "extra.txt").write_text("extra")
+        self.assertEqual(verify_copy(manifest, copy), (["test2.ignored"], ["extra.txt"], ["test1.txt"]))
+        shutil.rmtree(str(copy))
+
+    @unittest.skipUnless(native_encryption_available(), "cryptography is not installed")
+    def test_210_encryption(self):
+        key = derive_key("passphrase", new_key_parameters())
+        source = Path("test_files", "secret.kdb")
+        encrypted = Path("test_files", "secret.kdb.encrypted")
+        decrypted = Path("test_files", "secret.kdb.decrypted")
+        encrypt_file(key, source, encrypted)
+        self.assertNotEqual(encrypted.read_bytes()[-100:], source.read_bytes()[-100:])
+        decrypt_file(key, encrypted, decrypted)
+        self.assertEqual(decrypted.read_bytes(), source.read_bytes())
+        # authenticated with its path
+        encrypt_file(key, source, encrypted, name="objects/pack/a.pack")
+        with self.assertRaises(ValueError):
+            decrypt_file(key, encrypted, decrypted, name="objects/pack/b.pack")
+        decrypt_file(key, encrypted, decrypted, name="objects/pack/a.pack")
+        self.assertEqual(decrypted.read_bytes(), source.read_bytes())
+        # truncated
+        encrypted.write_bytes(encrypted.read_bytes()[:-1])
+        with self.assertRaises(ValueError):
+            decrypt_file(key, encrypted, decrypted, name="objects/pack/a.pack")
+        # remote names
+        name = remote_name(key, "refs/heads/documents")
+        self.assertEqual(name, remote_name(key, "refs/heads/documents"))
+        self.assertNotIn("documents", name)
+        encrypted.write_bytes(encrypt_names(key, {name: "refs/heads/documents"}))
+        self.assertEqual(decrypt_names(key, encrypted), {name: "refs/heads/documents"})
+        encrypted.unlink()
+        decrypted.unlink()
+
+    def test_220_catalog(self):
+        self.assertEqual(demangle_bup_path("docs/big.iso.bup/0a1b"), ("docs/big.iso", True))
+        self.assertEqual(demangle_bup_path("docs/x.bup.bupl/notes.txt"), ("docs/x.bup/notes.txt", False))
+        self.assertEqual(demangle_bup_path("docs/.bupm"), (None, False))
+        db = Path("test_files", "catalog.db")
+        catalog = GrenierCatalog(db)
+        catalog.add_snapshot("repo", "s1", "docs", 1000, [("/home/docs/report.pdf", 10), ("/home/docs/a.txt", 1)])
+        catalog.add_snapshot("repo", "s2", "docs", 2000, [("/home/docs/report.pdf", 10)])
+        self.assertEqual(catalog.find("REPORT"), {("repo", "/home/docs/report.pdf", 10): [("s1", "docs", 1000),
+                                                                                           ("s2", "docs", 2000)]})
+        self.assertEqual(list(catalog.find("*.txt").keys()), [("repo", "/home/docs/a.txt", 1)])
+        # indexed again: its old files are not left behind
+        catalog.add_snapshot("repo", "s1", "docs", 1000, [("/home/docs/report.pdf", 10)])
+        self.assertEqual(catalog.find("*.txt"), {})
+        self.assertEqual(catalog.db.execute("SELECT COUNT(*) FROM files").fetchone()[0], 2)
+        self.assertEqual(catalog.remove_missing("repo", ["s2"]), ["s1"])
+        self.assertEqual(list(catalog.find("REPORT").values()), [[("s2", "docs", 2000)]])
+        catalog.close()
+        for path in Path("test_files").glob("catalog.db*"):
+            path.unlink()
+
+    def test_230_transfer_retry(self):
+        self.assertEqual(classify_error("Failed to copy: read tcp: i/o timeout"), "transient")
+        self.assertEqual(classify_error("googleapi: Error 403: User Rate Limit Exceeded"), "transient")
+        self.assertEqual(classify_error("couldn't fetch token - maybe it has expired?"), "auth")
+        self.assertEqual(classify_error("directory not found"), "permanent")
+        outputs = ["ERROR : a.pack: Failed to copy: connection reset by peer",
+                   "ERROR : a.pack: Failed to copy: connection reset by peer",
+                   ""]
+        delays = []
+        action = lambda: (outputs[0] == "", outputs.pop(0))
+        self.assertEqual(retry(action, 3, display=False, sleep=delays.append), (True, "", None))
+        self.assertEqual(len(delays), 2)
+        # auth errors are not retried
+        outputs = ["Error 401: unauthorized", ""]
+        self.assertEqual(retry(action, 3, display=False, sleep=delays.append)[2], "auth")
+        self.assertEqual(len(delays), 2)
+        report = error_report("ERROR : a.pack: Failed to copy: EOF\nERROR : b.pack: Failed to copy: EOF\n")
+        self.assertIn("2 files failed", report)
+        self.assertIn("\ta.pack: Failed to copy: EOF", report)
+        self.assertEqual(RCLONE_DONE.search("INFO  : a.pack: Copied (new)").group(1), "a.pack")
+        self.assertIsNone(RCLONE_DONE.search("INFO  : b.pack: Deleted"))
+        # not in the real data directory
+        data_home = Path("test_files", "xdg")
+        with mock.patch.object(xdg.BaseDirectory, "xdg_data_home", str(data_home)):
+            checkpoint = Checkpoint("test", "remote")
+            checkpoint.add("a.pack")
+            checkpoint.close()
+            self.assertEqual(Checkpoint("test", "remote").completed, {"a.pack"})
+            # only files modified since the last successful sync are uploaded before the sync
+            folder = Path("test_files", "folder1")
+            now = time.time()
+            os.utime(str(Path(folder, "test1.txt")), (now - 100, now - 100))
+            os.utime(str(Path(folder, "test2.ignored")), (now, now))
+            self.assertEqual(pending_uploads(folder, checkpoint), ["test1.txt", "test2.ignored"])
+            self.assertEqual(pending_uploads(folder, checkpoint, since=now - 10), ["test2.ignored"])
+            checkpoint.add("test2.ignored")
+            self.assertEqual(pending_uploads(folder, checkpoint, since=now - 10), [])
+            checkpoint.clear()
+            self.assertEqual(Checkpoint("test", "remote").completed, set())
+            # not shared by a_b/c and a/b_c
+            Checkpoint("a_b", "c").add("a.pack")
+            self.assertEqual(Checkpoint("a", "b_c").completed, set())
+        shutil.rmtree(str(data_home))
+
+    def test_240_analytics(self):
+        history = GrenierHistory(Path("test_files", "analytics.db"))
+        for i, (photos, documents) in enumerate([(1000, 10), (3000, 10)]):
+            history.record("repo", "save", "repository", 100 * i, 100 * i + 10, bytes_count=photos + documents,
+                           details={"sources": {"photos": {"scanned_bytes": 5000, "processed_bytes": 4000,
+                                                           "stored_bytes": photos},
+                                                "documents": {"scanned_bytes": 50, "processed_bytes": 20,
+                                                              "stored_bytes": documents}}})
+        events = history.events("repo", "save", "repository")
+        rows = save_rows(events)
+        self.assertEqual([el["added"] for el in rows], [1010, 3010])
+        self.assertEqual(rows[0]["scanned"], 5050)
+        self.assertAlmostEqual(rows[1]["ratio"], 3010 / 4020.0)
+        growth = source_growth(events)
+        self.assertEqual(growth["photos"]["added"], 4000)
+        self.assertAlmostEqual(growth["photos"]["share"], 4000 / 4020.0)
+        self.assertEqual(growth["documents"]["ratio"], 0.5)
+        history.close()
+        for path in Path("test_files").glob("analytics.db*"):
+            path.unlink()
+
+    def test_250_dataset(self):
+        first = Dataset(Path("test_files", "dataset1"), files=200, distribution="small")
+        second = Dataset(Path("test_files", "dataset2"), files=200, distribution="small")
+        self.assertEqual(first.generate(), second.generate())
+        self.assertEqual(len(list_files(first.data)), 200)
+        self.assertEqual(first.path(17).read_bytes(), second.path(17).read_bytes())
+        modified, deleted, added, written = first.churn()
+        self.assertEqual((modified, deleted, added), (10, 2, 4))
+        self.assertEqual(len(list_files(first.data)), 202)
+        self.assertEqual(Dataset.load(first.root).runs, 1)
+        shutil.rmtree(str(first.root))
+        shutil.rmtree(str(second.root))
+
+    def test_260_pipeline(self):
+        events = []
+
+        def upload(name):
+            time.sleep(0.2)
+            events.append(("sync", name))
+
+        def broken():
+            raise Exception("save failed")
+        pipeline = StagePipeline(local_jobs=1, network_jobs=2)
+        for name in ["a", "b"]:
+            pipeline.submit(name, [("local", lambda name=name: events.append(("save", name))),
+                                   ("network", lambda name=name: upload(name))])
+        pipeline.submit("c", [("local", broken), ("network", lambda: upload("c"))])
+        self.assertEqual(pipeline.wait(), ["c"])
+        # b is saved while a is uploaded, c is not uploaded
+        self.assertEqual(events[:2], [("save", "a"), ("save", "b")])
+        self.assertEqual(sorted(events[2:]), [("sync", "a"), ("sync", "b")])
+
+        # threads of the same process wait for each other
+        lock_dir = Path("test_files", "locks")
+        locks = LockManager(lock_dir)
+        order = []
+
+        def other():
+            with locks.lock("remote", "test1"):
+                order.append("other")
+        with locks.lock("remote", "test1"):
+            thread = threading.Thread(target=other)
+            thread.start()
+            time.sleep(0.2)
+            order.append("first")
+        thread.join()
+        self.assertEqual(order, ["first", "other"])
+        shutil.rmtree(str(lock_dir))
+
+    def test_270_resources(self):
+        policy = ResourcePolicy(nice=10, jobs=1000)
+        self.assertEqual(policy.wrap(["bup", "save"]), ["nice", "-n", "10", "bup", "save"])
+        # capped by the number of cpus
+        self.assertEqual(policy.jobs, os.cpu_count())
+        self.assertEqual(ResourcePolicy(jobs=1).jobs, 1)
+        self.assertEqual(ResourcePolicy().wrap(["ls"]), ["ls"])
+        self.assertEqual(ResourcePolicy().environment({"A": "1"}), {"A": "1"})
+        self.assertIn("PATH", policy.environment({"A": "1"}))
+        if shutil.which("ionice"):
+            # no level for the idle class
+            self.assertEqual(ResourcePolicy(ionice="idle", ionice_level=4).wrap(["ls"]),
+                             ["ionice", "-c", "3", "ls"])
+        with self.assertRaises(Exception):
+            ResourcePolicy(ionice="fast")
+        self.assertEqual(ResourcePolicy.from_config({"nice": 5, "retries": 1}).retries, 1)
+        self.assertEqual(ResourcePolicy.from_config(None).retries, RETRIES)
+
+    def test_280_preflight(self):
+        class Repository(object):
+            def __init__(self, name, needed):
+                self.name = name
+                self.needed = needed
+
+            def space_needed(self, phase, target):
+                return [(Path("test_files"), self.needed)]
+        available = free_space(Path("test_files"))
+        self.assertEqual(free_space(Path("test_files", "not", "created")), available)
+        self.assertEqual(filesystem(Path("test_files", "not", "created")), filesystem(Path("test_files")))
+        # the second does not fit in what the first leaves, the third does
+        repositories = [Repository("first", available // 2), Repository("second", available // 2),
+                        Repository("third", 0)]
+        ordered = order_by_space(repositories, lambda r: [("save", "repository")])
+        self.assertEqual([el.name for el in ordered], ["first", "third", "second"])
+        # nothing is needed for checks
+        ordered = order_by_space(repositories, lambda r: [("check", "repository")])
+        self.assertEqual([el.name for el in ordered], ["first", "second", "third"])
+
+    def test_290_progress(self):
+        self.assertEqual(parse_human_size("1.5M"), 1572864)
+        self.assertEqual(parse_human_size("10,5 MiB"), 11010048)
+        self.assertEqual(parse_human_size("1,234,567"), 1234567)
+        self.assertEqual(parse_human_size("2 Bytes"), 2)
+        self.assertIsNone(parse_human_size("fast"))
+        # rsync progress, with exact byte counts
+        line = "      1,234,567  45%   10.00MB/s    0:00:01 (xfr#1, to-chk=0/3)"
+        self.assertEqual(parse_human_size(RSYNC_PROGRESS.match(line).group(1)), 1234567)
+        self.assertIsNone(RSYNC_PROGRESS.match("          1.23M  45%   10.00MB/s    0:00:01"))
+
+        class Bar(object):
+            finished = False
+            seconds_elapsed = 0
+            currval = 0
+            maxval = 1000
+        # nothing transferred yet: from the rate of previous runs
+        self.assertEqual(HistoricalETA(10).update(Bar()), "ETA:  0:01:40")
+        self.assertEqual(HistoricalETA().update(Bar()), "ETA:  --:--:--")
+        # without a total, no percentage or ETA
+        progress = ByteProgress("test", rate=10, display=False)
+        progress.add(100)
+        self.assertIsNone(progress.total)
+        progress.set_total(1000)
+        progress.add(2000)
+        self.assertEqual((progress.total, progress.finish()), (2100, 2100))
+
+    def test_300_planner(self):
+        class History(object):
+            def __init__(self, durations):
+                self.durations = durations
+
+            def events(self, repository, phase, target=None, limit=None):
+                return [{"duration": el} for el in self.durations.get((phase, target), [])]
+
+        class Repository(object):
+            def __init__(self, name, priority, durations):
+                self.name = name
+                self.priority = priority
+                self.history = History(durations)
+        jobs = [("save", "repository"), ("sync", "disk")]
+        long = Repository("long", 0, {("save", "repository"): [100, 300], ("sync", "disk"): [50]})
+        short = Repository("short", 0, {("save", "repository"): [10], ("sync", "disk"): [5]})
+        new = Repository("new", 1, {})
+        repositories = [long, new, short]
+        self.assertEqual(order_repositories(repositories, lambda r: jobs), repositories)
+        self.assertEqual([el.name for el in order_repositories(repositories, lambda r: jobs, "shortest")],
+                         ["short", "long", "new"])
+        self.assertEqual([el.name for el in order_repositories(repositories, lambda r: jobs, "priority")],
+                         ["new", "short", "long"])
+
+        budget = TimeBudget()
+        self.assertTrue(budget.allows_all(long, jobs) and budget.allows(long, "save", "repository"))
+        budget = TimeBudget(120)
+        self.assertTrue(budget.allows_all(short, jobs))
+        self.assertTrue(budget.allows(short, "save", "repository"))
+        # never done: allowed
+        self.assertTrue(budget.allows(new, "save", "repository"))
+        # the save would end too late, the sync is deferred with it
+        self.assertFalse(budget.allows(long, "save", "repository"))
+        self.assertFalse(budget.allows(long, "sync", "disk"))
+        self.assertEqual([el[:3] for el in budget.deferred], [("long", "save", "repository"),
+                                                              ("long", "sync", "disk")])
+        budget = TimeBudget(220)
+        # 200 + 50: not started at all
+        self.assertFalse(budget.allows_all(long, jobs))
+        self.assertFalse(budget.allows(long, "save", "repository"))
+
+    def test_310_probe(self):
+        history = GrenierHistory(Path("test_files", "history.db"))
+        directory = GrenierRemote(str(Path("test_files", "folder1").resolve()), None)
+        unknown = GrenierRemote("nowhere", Path("test_files", "missing.conf"))
+        remotes = [(directory, None, None), (unknown, None, None)]
+        probe_remotes(remotes, history)
+        self.assertEqual((directory.reachable, unknown.reachable), (True, False))
+        # successes are cached, failures are not
+        self.assertEqual(history.cached_probe(probe_key(directory, None), 300), (True, "OK"))
+        self.assertIsNone(history.cached_probe(probe_key(unknown, None), 300))
+        history.cache_probe(probe_key(directory, None), True, "cached")
+        probe_remotes(remotes, history)
+        self.assertEqual(directory.probe_message, "cached")
+        history.close()
+        for db_file in Path("test_files").glob("history.db*"):
+            db_file.unlink()
+
+    def test_320_logger(self):
+        class Capture(logging.Handler):
+            # as the log file: every record, as logged
+            def __init__(self):
+                super().__init__()
+                self.messages = []
+
+            def emit(self, record):
+                self.messages.append(self.format(record))
+        console = io.StringIO()
+        handler = RateLimitHandler(console, max_lines=2, interval=60)
+        capture = Capture()
+        test_logger = logging.getLogger("grenier_test")
+        test_logger.propagate = False
+        test_logger.setLevel(logging.INFO)
+        test_logger.addHandler(handler)
+        test_logger.addHandler(capture)
+        for i in range(5):
+            test_logger.info("line %d" % i)
+        test_logger.warning("warning")
+        test_logger.info("line 5")
+        # the end of a burst is reported when the console is closed
+        handler.close()
+        test_logger.removeHandler(handler)
+        test_logger.removeHandler(capture)
+        self.assertEqual(console.getvalue().splitlines(),
+                         ["line 0", "line 1", "[3 lines not shown] warning", "[1 lines not shown]"])
+        self.assertEqual(capture.messages, ["line %d" % i for i in range(5)] + ["warning", "line 5"])
+
+        log_dir = Path("test_files", "log")
+        log_dir.mkdir()
+        old = time.time() - 2 * 24 * 3600
+        for name in ["old.log", "current.log", "recent.log"]:
+            Path(log_dir, name).write_text(name)
+        for name in ["old.log", "current.log"]:
+            os.utime(str(Path(log_dir, name)), (old, old))
+        compress_old_logs(log_dir, Path(log_dir, "current.log"))
+        self.assertEqual(sorted([el.name for el in log_dir.iterdir()]),
+                         ["current.log", "old.log.gz", "recent.log"])
+        compress_old_logs(log_dir, Path(log_dir, "current.log"), keep=0)
+        self.assertEqual(sorted([el.name for el in log_dir.iterdir()]), ["current.log", "recent.log"])
+        shutil.rmtree(str(log_dir))
+
+    def test_330_config(self):
+        self.assertEqual(validate_config({}), ["No repository defined."])
+        errors = validate_config({"test": {"backend": "borg", "repository_path": 1, "passphrase": "p",
+                                           "sources": {"s": {"dir": "d", "compression": 12},
+                                                       "t": {"dir": "d", "compression": True}},
+                                           "resources": {"ionice": "fast"},
+                                           "retention": {"keep_last": 0}}})
+        self.assertEqual(sorted(errors), sorted(["Repository test: invalid 'repository_path': 1.",
+                                                 "Repository test: backend must be one of: bup, restic.",
+                                                 "Repository test, source s: compression must be 0 to 9, "
+                                                 "or auto.",
+                                                 "Repository test, source t: compression must be 0 to 9, "
+                                                 "or auto.",
+                                                 "Repository test: ionice must be one of: realtime, "
+                                                 "best-effort, idle.",
+                                                 "Repository test: retention must keep something."]))
+
+        config_file = Path("test_files", "config_test.yaml")
+        cache_file = Path("test_files", "config_cache.json")
+        config_file.write_text("test:\n  backend: restic\n  repository_path: backup\n  passphrase: p\n"
+                               "  sources:\n    s:\n      dir: test_files/folder1\n")
+        config, raw_config = load_config(config_file, cache_file)
+        self.assertEqual(raw_config["test"]["passphrase"], "p")
+        self.assertNotIn("passphrase", config["test"])
+        # paths as configured
+        self.assertEqual(config["test"]["sources"]["s"]["dir"], "test_files/folder1")
+        self.assertEqual(config["test"]["repository_path"], "backup/grenier_test")
+        # from the cache, without the secrets
+        self.assertEqual(load_config(config_file, cache_file), (config, None))
+        # modified: read again
+        config_file.write_text(config_file.read_text().replace("backup", "other_backup"))
+        config, raw_config = load_config(config_file, cache_file)
+        self.assertIsNotNone(raw_config)
+        self.assertEqual(config["test"]["repository_path"], "other_backup/grenier_test")
+        cache_file.write_text("not json")
+        self.assertIsNotNone(load_config(config_file, cache_file)[1])
+        config_file.unlink()
+        cache_file.unlink()
+
+    def test_340_plan(self):
+        class Repository(object):
+            name = "test"
+            history = None
+
+            def plan(self, phase, target):
+                return {"files": 3, "bytes": 3000} if phase == "save" else None
+
+            def historical_rate(self, phase, target):
+                return 100 if phase == "save" else None
+        plans = transfer_plan(Repository(), [("check", "repository"), ("save", "repository"),
+                                             ("sync", "disk")])
+        # only saves and syncs, the duration from the bytes and the recorded rate
+        self.assertEqual(plans, [{"repository": "test", "phase": "save", "target": "repository",
+                                  "files": 3, "bytes": 3000, "duration": 30},
+                                 {"repository": "test", "phase": "sync", "target": "disk",
+                                  "files": None, "bytes": None, "duration": None}])
+
+    def test_350_plan_locked(self):
+        lock_dir = Path("test_files", "locks")
+        other = LockManager(lock_dir)
+        for r in self.grenier.repositories:
+            r.locks = LockManager(lock_dir)
+            # another grenier process is saving: no plan, but no crash either
+            with other.lock(*r._repository_lock()):
+                self.assertIsNone(r.plan("save", "repository"))
+                plans = transfer_plan(r, [("save", "repository")])
+                self.assertEqual(len(plans), 1)
+                self.assertIsNone(plans[0]["bytes"])
+        shutil.rmtree(str(lock_dir))
+
+    def test_360_compression_cache(self):
+        history = GrenierHistory(Path("test_files", "history.db"))
+        r = self.grenier.repositories[0]
+        r.history = history
+        folder1 = [s for s in r.sources if s.name == "folder1"][0]
+        folder1.compression = "auto"
+        # sampled once, then kept
+        level = r._compression_levels()["folder1"]
+        self.assertEqual(history.cached_compression(r.name, "folder1"), level)
+        self.assertEqual(list(r._compression_levels().keys()), ["folder1"])
+        history.cache_compression(r.name, "folder1", 42)
+        self.assertEqual(r._compression_levels()["folder1"], 42)
+        # too old
+        self.assertIsNone(history.cached_compression(r.name, "folder1", max_age=-1))
+        history.close()
+
+        # cleanup
+        for db_file in Path("test_files").glob("history.db*"):
+            db_file.unlink()
+
+    def test_370_synced_manifest(self):
+        history = GrenierHistory(Path("test_files", "history.db"))
+        source = Path("test_files", "folder1")
+        copy = Path("test_files", "folder1_copy")
+        shutil.copytree(str(source), str(copy))
+        # recorded when syncing to the copy
+        synced, hashed = update_manifest(source, {})
+        history.save_manifest("test1", synced, remote="DISK1")
+        # saved since then
+        Path(source, "new.txt").write_text("new")
+        current, hashed = update_manifest(source, synced)
+        history.save_manifest("test1", current)
+        self.assertEqual(history.manifest("test1"), current)
+        self.assertEqual(history.manifest("test1", remote="DISK1"), synced)
+        self.assertEqual(history.manifest("test1", remote="hubic"), {})
+        # the new file is not missing from the copy
+        self.assertEqual(verify_copy(history.manifest("test1", remote="DISK1"), copy), ([], [], []))
+        self.assertEqual(verify_copy(current, copy), (["new.txt"], [], []))
+        Path(source, "new.txt").unlink()
+        shutil.rmtree(str(copy))
+        history.close()
+
+        # cleanup
+        for db_file in Path("test_files").glob("history.db*"):
+            db_file.unlink()
+
+    def test_380_restic_mount(self):
+        mount_state = Path("test_files", "mount.json")
+        mount_path = Path("test_files", "mount")
+        backend = ResticBackend(Path("test_files", "backup"), "test", mount_state=mount_state)
+        # stale: the process is gone, or its pid is used by another program
+        dead = Popen(["true"])
+        dead.wait()
+        other = Popen(["sleep", "30"])
+        for pid in [dead.pid, other.pid]:
+            mount_state.write_text(json.dumps({"pid": pid, "mount_path": str(absolute_path(mount_path))}))
+            self.assertFalse(backend._mount_process_alive(backend._read_mount_state()))
+        other.kill()
+        other.wait()
+        # a running restic mount is not started again
+        mounted = Popen([sys.executable, "-c", "import time; time.sleep(30)", "restic", "mount"])
+        mount_state.write_text(json.dumps({"pid": mounted.pid, "mount_path": str(absolute_path(mount_path))}))
+        self.assertTrue(backend._mount_process_alive(backend._read_mount_state()))
+        success, output = backend.fuse(mount_path)
+        self.assertFalse(success)
+        self.assertIn("Already mounted", output)
+        # interrupted, and forgotten
+        backend.unfuse(mount_path)
+        self.assertIsNotNone(mounted.wait(timeout=5))
+        self.assertFalse(mount_state.exists())
+
+    def test_390_bup_index_lines(self):
+        lines = ["  /x/folder1/a.txt", "A /x/folder1/", "  /x/folder10/b.txt", "M /y/x/folder1/c.txt",
+                 "  /x/folder1"]
+        self.assertEqual(lines_under(lines, "/x/folder1"), ["  /x/folder1/a.txt", "A /x/folder1/", "  /x/folder1"])
+        self.assertEqual(lines_under(lines, "/x/folder10"), ["  /x/folder10/b.txt"])
+
 
 if __name__ == '__main__':
     unittest.main()